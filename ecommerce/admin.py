@@ -2,7 +2,8 @@ from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
 from django.contrib.auth.models import User
 from django.utils.html import format_html
-from .models import Customer, Product, ProductImage, Order, OrderItem, Payment, Debt, Category, Brand, Supplier, Consignment, ConsignmentItem, Expense
+from .models import ApiRateLimit, BackgroundJob, Customer, CustomerStats, DeadJob, EmailOutbox, MpesaCallback, InventorySnapshot, Product, ProductImage, Order, OrderItem, Payment, Debt, Category, Brand, Supplier, Consignment, ConsignmentItem, Expense
+from .jobs import requeue_dead_jobs
 from .widgets import DragDropFileInput
 
 # --- Category & Brand ---
@@ -43,6 +44,12 @@ class ExpenseAdmin(admin.ModelAdmin):
     list_filter = ('category', 'date')
     search_fields = ('description',)
 
+# --- Inventory Snapshot ---
+@admin.register(InventorySnapshot)
+class InventorySnapshotAdmin(admin.ModelAdmin):
+    list_display = ('snapshot_date', 'product_count', 'total_units', 'total_cost_value', 'total_retail_value')
+    date_hierarchy = 'snapshot_date'
+
 # --- User (Auth) ---
 class UserAdmin(BaseUserAdmin):
     list_display = ('username', 'email', 'is_staff', 'is_active', 'date_joined')
@@ -70,6 +77,12 @@ class CustomerAdmin(admin.ModelAdmin):
     list_display = ('user', 'phone_number', 'address')
     search_fields = ('user__username',)
 
+@admin.register(CustomerStats)
+class CustomerStatsAdmin(admin.ModelAdmin):
+    list_display = ('customer', 'order_count', 'lifetime_spend', 'outstanding', 'pending_count', 'last_order_date')
+    search_fields = ('customer__user__username',)
+    readonly_fields = ('order_count', 'lifetime_spend', 'outstanding', 'pending_count', 'last_order_date', 'updated_at')
+
 # --- Product Images Inline ---
 class ProductImageInline(admin.TabularInline):
     model = ProductImage
@@ -129,4 +142,52 @@ class OrderAdmin(admin.ModelAdmin):
 class DebtAdmin(admin.ModelAdmin):
     list_display = ('customer', 'order', 'outstanding_balance', 'is_paid', 'paid_at')
     list_filter = ('is_paid',)
-    search_fields = ('customer__user__username',)
\ No newline at end of file
+    search_fields = ('customer__user__username',)
+
+# --- Email Outbox ---
+@admin.register(EmailOutbox)
+class EmailOutboxAdmin(admin.ModelAdmin):
+    list_display = ('to_email', 'subject', 'status', 'attempts', 'next_attempt_at', 'sent_at')
+    list_filter = ('status',)
+    search_fields = ('to_email', 'subject')
+    readonly_fields = ('created_at', 'sent_at', 'last_error')
+
+
+@admin.register(BackgroundJob)
+class BackgroundJobAdmin(admin.ModelAdmin):
+    list_display = ('name', 'args', 'attempts', 'run_at', 'created_at')
+    search_fields = ('name',)
+    readonly_fields = ('created_at', 'last_error')
+
+
+@admin.register(DeadJob)
+class DeadJobAdmin(admin.ModelAdmin):
+    list_display = ('name', 'args', 'attempts', 'failed_at')
+    search_fields = ('name', 'last_error')
+    readonly_fields = ('name', 'args', 'kwargs', 'attempts', 'last_error', 'created_at', 'failed_at')
+    actions = ['requeue']
+
+    @admin.action(description='Requeue selected jobs')
+    def requeue(self, request, queryset):
+        jobs = list(queryset)
+        requeue_dead_jobs(jobs)
+        self.message_user(request, f"Requeued {len(jobs)} jobs.")
+
+
+@admin.register(MpesaCallback)
+class MpesaCallbackAdmin(admin.ModelAdmin):
+    list_display = ('receipt_number', 'kind', 'amount', 'phone_number', 'account_reference', 'result_code', 'received_at')
+    list_filter = ('kind', 'result_code')
+    search_fields = ('receipt_number', 'phone_number', 'account_reference')
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+
+@admin.register(ApiRateLimit)
+class ApiRateLimitAdmin(admin.ModelAdmin):
+    list_display = ('user', 'scope', 'rate')
+    search_fields = ('user__username',)
@@ -0,0 +1,48 @@
+import hashlib
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.utils.translation import gettext_lazy as _
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+
+# User columns kept in the cache: everything the API reads off request.user.
+# Anything else (password, last_login) is left deferred and loads on access.
+CACHED_USER_FIELDS = ('id', 'username', 'email', 'first_name', 'last_name', 'is_active', 'is_staff', 'is_superuser')
+
+
+def token_cache_key(key):
+    # Hashed so the cache never holds usable tokens
+    return f"api-token:{hashlib.sha256(key.encode()).hexdigest()}"
+
+
+def forget_tokens(keys):
+    cache.delete_many([token_cache_key(key) for key in keys])
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    # TokenAuthentication with the token -> user lookup kept in the cache for
+    # API_TOKEN_CACHE_SECONDS, so warm requests make no auth query. Entries are
+    # dropped when the token is deleted or its user or customer changes.
+    def authenticate_credentials(self, key):
+        cache_key = token_cache_key(key)
+        entry = cache.get(cache_key)
+        if entry is None:
+            entry = Token.objects.filter(key=key).values(
+                *[f'user__{field}' for field in CACHED_USER_FIELDS], 'user__customer__id',
+            ).first()
+            if entry is None:
+                raise exceptions.AuthenticationFailed(_('Invalid token.'))
+            cache.set(cache_key, entry, getattr(settings, 'API_TOKEN_CACHE_SECONDS', 60))
+
+        User = get_user_model()
+        # from_db takes loaded values in field order and defers the rest
+        names = [field.attname for field in User._meta.concrete_fields if field.attname in CACHED_USER_FIELDS]
+        user = User.from_db('default', names, [entry[f'user__{name}'] for name in names])
+        if not user.is_active:
+            raise exceptions.AuthenticationFailed(_('User inactive or deleted.'))
+        user.api_customer_id = entry['user__customer__id']
+        # request.auth is only compared with None and used for its key
+        return user, Token(key=key, user=user)
@@ -0,0 +1,165 @@
+import inspect
+
+from django.utils.functional import cached_property
+
+from .customer_stats import get_customer_stats
+from .models import CartItem, Customer, Notification, Order, Product
+from .notifications_util import get_unread_count
+from .pagination import keyset_page
+from .realtime import notification_payload
+from .serializers import CustomerStatsSerializer, OrderSerializer
+
+
+class BatchQueryError(ValueError):
+    pass
+
+
+class Loader:
+    # DataLoader-style batching: resolvers call want() with the keys they will
+    # need, yield, and read load()'s result once every resolver has had its turn,
+    # so keys asked for by all of them are fetched with one query
+    def __init__(self, fetch):
+        self.fetch = fetch
+        self.pending = set()
+        self.loaded = {}
+
+    def want(self, keys):
+        self.pending.update(keys)
+
+    def load(self):
+        missing = self.pending - self.loaded.keys()
+        if missing:
+            self.loaded.update(self.fetch(missing))
+        self.pending = set()
+        return self.loaded
+
+
+class BatchContext:
+    def __init__(self, request):
+        self.request = request
+        self.user = request.user
+        self.products = Loader(lambda ids: {
+            row['id']: row for row in Product.objects.filter(pk__in=ids).values('id', 'name', 'price', 'stock')
+        })
+
+    @cached_property
+    def customer_id(self):
+        # Looked up once for every sub-query; token requests already carry it
+        if hasattr(self.user, 'api_customer_id'):
+            return self.user.api_customer_id
+        return Customer.objects.filter(user=self.user).values_list('pk', flat=True).first()
+
+    def param(self, query, name, default=None):
+        # ?recent_orders.limit=10 is the limit param of the recent_orders sub-query
+        return self.request.query_params.get(f'{query}.{name}', default)
+
+    def limit(self, query, default, maximum):
+        value = self.param(query, 'limit', default)
+        try:
+            value = int(value)
+        except (TypeError, ValueError):
+            raise BatchQueryError('limit must be a number.')
+        if not 1 <= value <= maximum:
+            raise BatchQueryError(f'limit must be between 1 and {maximum}.')
+        return value
+
+
+def profile_data(user):
+    return {
+        "id": user.id,
+        "username": user.username,
+        "email": user.email,
+        "date_of_birth": getattr(user, "date_of_birth", None),
+        "profile_photo": getattr(user, "profile_photo", None),
+    }
+
+
+def resolve_profile(ctx):
+    return profile_data(ctx.user)
+
+
+def resolve_stats(ctx):
+    if ctx.customer_id is None:
+        return None
+    return CustomerStatsSerializer(get_customer_stats(Customer(pk=ctx.customer_id))).data
+
+
+def resolve_cart(ctx):
+    items = list(CartItem.objects.filter(cart__customer_id=ctx.customer_id).order_by('added_at', 'pk')
+                 .values('id', 'product_id', 'quantity'))
+    ctx.products.want(item['product_id'] for item in items)
+    products = yield
+    rows = []
+    for item in items:
+        price = products[item['product_id']]['price']
+        rows.append({'id': item['id'], 'product': item['product_id'], 'quantity': item['quantity'],
+                     'subtotal': price * item['quantity']})
+    total = sum(row['subtotal'] for row in rows)
+    for row in rows:
+        row['subtotal'] = str(row['subtotal'])
+    return {'items': rows, 'item_count': sum(row['quantity'] for row in rows), 'total': str(total or '0.00')}
+
+
+def resolve_recent_orders(ctx):
+    limit = ctx.limit('recent_orders', 5, 20)
+    orders = list(Order.objects.for_api(totals=True, items=True, payments=False)
+                  .filter(customer_id=ctx.customer_id).order_by('-order_date')[:limit])
+    ctx.products.want(item.product_id for order in orders for item in order.items.all())
+    yield
+    return OrderSerializer(orders, many=True, context={'nested': {'items'}}).data
+
+
+def resolve_notifications(ctx):
+    notifications = Notification.objects.all() if ctx.user.is_staff else Notification.objects.filter(user=ctx.user)
+    rows, next_cursor = keyset_page(
+        notifications, ctx.param('notifications', 'before'), page_size=ctx.limit('notifications', 10, 50),
+    )
+    return {
+        'results': [notification_payload(notification) for notification in rows],
+        'next': next_cursor,
+        'unread_count': get_unread_count(ctx.user.pk),
+    }
+
+
+# Sub-queries a client can name in ?q=; each may be a generator that yields once
+# after asking the context's loaders for what it needs
+BATCH_QUERIES = {
+    'profile': resolve_profile,
+    'stats': resolve_stats,
+    'cart': resolve_cart,
+    'recent_orders': resolve_recent_orders,
+    'notifications': resolve_notifications,
+}
+
+
+def run_batch(request, names):
+    ctx = BatchContext(request)
+    data, errors, waiting = {}, {}, {}
+    for name in names:
+        resolver = BATCH_QUERIES.get(name)
+        if resolver is None:
+            errors[name] = 'Unknown query.'
+            continue
+        try:
+            result = resolver(ctx)
+            if inspect.isgenerator(result):
+                next(result)
+                waiting[name] = result
+                data[name] = None  # keeps the requested order
+            else:
+                data[name] = result
+        except BatchQueryError as exc:
+            errors[name] = str(exc)
+
+    products = ctx.products.load()
+    for name, resolver in waiting.items():
+        try:
+            resolver.send(products)
+        except StopIteration as done:
+            data[name] = done.value
+    if products:
+        # Decimals as strings, the way the serializers render them
+        data['products'] = [{**products[pk], 'price': str(products[pk]['price'])} for pk in sorted(products)]
+    if errors:
+        data['errors'] = errors
+    return data
@@ -0,0 +1,197 @@
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Sum
+from django.utils import timezone
+
+from .customer_stats import refresh_customer_stats
+from .models import Order, OrderItem, Payment, Product
+from .product_feed import refresh_product_feed
+from .serializers import BulkOrderItemRowSerializer, BulkPaymentRowSerializer
+from .stock_alerts import check_stock_level
+from .tasks import recalculate_order_debt
+
+
+class BulkRequestError(ValueError):
+    pass
+
+
+def parse_rows(rows, row_serializer, noun):
+    if not isinstance(rows, list) or not rows:
+        raise BulkRequestError('Expected a non-empty list of rows.')
+    limit = getattr(settings, 'API_BULK_MAX_ROWS', 500)
+    if len(rows) > limit:
+        raise BulkRequestError(f'At most {limit} rows per request.')
+    parsed, errors, seen = [], {}, set()
+    for index, row in enumerate(rows):
+        serializer = row_serializer(data=row)
+        row_id = serializer.validated_data.get('id') if serializer.is_valid() else None
+        if serializer.errors:
+            errors[index] = serializer.errors
+        elif row_id is not None and row_id in seen:
+            errors[index] = {'id': [f'The same {noun} appears more than once.']}
+        else:
+            seen.add(row_id)
+            parsed.append(serializer.validated_data)
+            continue
+        parsed.append(None)
+    return parsed, errors
+
+
+def _credit_pending(order):
+    # Same rule as OrderItem.save: credit orders awaiting approval hold no stock
+    return order.payment_type == 'credit' and order.status == 'pending_approval'
+
+
+def orders_changed(orders):
+    # What the per-row OrderItem/Payment signals do, once per order. Debts are
+    # recalculated inside the batch's transaction so the response reflects them.
+    Order.objects.filter(pk__in=[order.pk for order in orders]).update(updated_at=timezone.now())
+    for order in orders:
+        recalculate_order_debt(order.pk)
+    for customer_id in {order.customer_id for order in orders}:
+        refresh_customer_stats.delay(customer_id)
+
+
+def bulk_write_order_items(rows, orders):
+    # orders is the queryset of orders the caller may write to. Every row is
+    # validated against locked stock before anything is written; on any error
+    # nothing is applied and the errors come back keyed by row index.
+    parsed, errors = parse_rows(rows, BulkOrderItemRowSerializer, 'order item')
+    valid = [(index, row) for index, row in enumerate(parsed) if row is not None]
+
+    with transaction.atomic():
+        # Items before products, the order OrderItem.save takes them in, so a
+        # concurrent edit can't change a quantity after it was read here
+        items = OrderItem.objects.select_for_update().filter(order__in=orders).in_bulk(
+            [row['id'] for _, row in valid if 'id' in row]
+        )
+        order_ids = {row['order'] for _, row in valid if 'id' not in row} | {item.order_id for item in items.values()}
+        orders_by_id = orders.in_bulk(order_ids)
+        product_ids = {row['product'] for _, row in valid if 'id' not in row} | {item.product_id for item in items.values()}
+        products = Product.objects.select_for_update().in_bulk(product_ids)
+        previous_stock = {pk: product.stock for pk, product in products.items()}
+
+        pending = []
+        for index, row in valid:
+            if 'id' in row:
+                item = items.get(row['id'])
+                if item is None:
+                    errors[index] = {'id': ['No such order item.']}
+                    continue
+                order, product, old_quantity = orders_by_id[item.order_id], products[item.product_id], item.quantity
+            else:
+                order, product, old_quantity = orders_by_id.get(row['order']), products.get(row['product']), 0
+                if order is None or product is None:
+                    errors[index] = {name: ['Not found.'] for name, found in (('order', order), ('product', product)) if found is None}
+                    continue
+            available = product.stock + old_quantity
+            if row['quantity'] > available:
+                errors[index] = {'quantity': [f"Only {available} items left in stock."]}
+                continue
+            if not _credit_pending(order):
+                product.stock = available - row['quantity']
+            pending.append((index, row, order, product))
+
+        if errors:
+            transaction.set_rollback(True)
+            return errors, []
+
+        written, created, updated = [], [], []
+        for index, row, order, product in pending:
+            if 'id' in row:
+                item = items[row['id']]
+                item.quantity, item.price = row['quantity'], product.price
+                updated.append(item)
+                written.append(('updated', item))
+            else:
+                item = OrderItem(order=order, product=product, quantity=row['quantity'], price=product.price)
+                created.append(item)
+                written.append(('created', item))
+        OrderItem.objects.bulk_create(created)
+        OrderItem.objects.bulk_update(updated, ['quantity', 'price'])
+
+        now = timezone.now()
+        changed = [product for pk, product in products.items() if product.stock != previous_stock[pk]]
+        for product in changed:
+            product.updated_at = now
+        Product.objects.bulk_update(changed, ['stock', 'updated_at'])
+        for product in changed:
+            check_stock_level(product, previous_stock[product.pk])
+        # The feed only shows whether a product is in stock
+        restocked_or_sold_out = [product.pk for product in changed if (product.stock > 0) != (previous_stock[product.pk] > 0)]
+        if restocked_or_sold_out:
+            refresh_product_feed.delay(restocked_or_sold_out)
+        orders_changed({order.pk: order for _, _, order, _ in pending}.values())
+    return {}, written
+
+
+def bulk_write_payments(rows, orders, user):
+    # Same all-or-nothing contract as bulk_write_order_items. Each order's payments
+    # may not add up to more than its total, as in Payment.clean.
+    parsed, errors = parse_rows(rows, BulkPaymentRowSerializer, 'payment')
+    valid = [(index, row) for index, row in enumerate(parsed) if row is not None]
+
+    with transaction.atomic():
+        payment_ids = [row['id'] for _, row in valid if 'id' in row]
+        order_ids = {row['order'] for _, row in valid if 'id' not in row} | set(
+            Payment.objects.filter(order__in=orders, pk__in=payment_ids).values_list('order_id', flat=True)
+        )
+        # Locking the orders serialises concurrent payment writes against the same total
+        locked = list(orders.select_for_update(of=('self',)).filter(pk__in=order_ids).values_list('pk', flat=True))
+        # Read under those locks, so the amounts being replaced can't change before the check
+        payments = Payment.objects.select_for_update().filter(order_id__in=locked).in_bulk(payment_ids)
+        orders_by_id = Order.objects.with_totals().in_bulk(locked)
+        paid = defaultdict(int, Payment.objects.filter(order_id__in=locked).values('order').annotate(
+            total=Sum('amount')).values_list('order', 'total'))
+
+        pending = []
+        for index, row in valid:
+            payment = payments.get(row['id']) if 'id' in row else None
+            if 'id' in row and payment is None:
+                errors[index] = {'id': ['No such payment.']}
+                continue
+            order = orders_by_id.get(payment.order_id if payment else row['order'])
+            if order is None:
+                errors[index] = {'order': ['Not found.']}
+                continue
+            previous = payment.amount if payment else 0
+            new_paid = paid[order.pk] - previous + row.get('amount', previous)
+            if new_paid > order.total_amount:
+                max_allowed = order.total_amount - (paid[order.pk] - previous)
+                errors[index] = {'amount': [
+                    f"Payment exceeds order total ({order.total_amount}). Max allowed is {max_allowed}."
+                ]}
+                continue
+            paid[order.pk] = new_paid
+            pending.append((index, row, order, payment))
+
+        if errors:
+            transaction.set_rollback(True)
+            return errors, []
+
+        written, created, updated = [], [], []
+        for index, row, order, payment in pending:
+            if payment is None:
+                payment = Payment(order=order, amount=row['amount'], created_by=user,
+                                  payment_method=row.get('payment_method', 'cash'), notes=row.get('notes', ''))
+                created.append(payment)
+                written.append(('created', payment))
+            else:
+                for field in ('amount', 'payment_method', 'notes'):
+                    if field in row:
+                        setattr(payment, field, row[field])
+                payment.updated_at = timezone.now()
+                updated.append(payment)
+                written.append(('updated', payment))
+        Payment.objects.bulk_create(created)
+        Payment.objects.bulk_update(updated, ['amount', 'payment_method', 'notes', 'updated_at'])
+
+        # Payment.save's status rule, applied per order instead of per payment
+        touched = {order.pk: order for _, _, order, _ in pending}
+        for order in touched.values():
+            status = 'completed' if paid[order.pk] >= order.total_amount else 'pending'
+            order.payments.exclude(status=status).update(status=status, updated_at=timezone.now())
+        orders_changed(touched.values())
+    return {}, written
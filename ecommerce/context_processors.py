@@ -1,11 +1,20 @@
-from .models import Notification
+from functools import lru_cache
+
+from .notifications_util import get_unread_count
+from .realtime import staff_events_url
 
 
 def notifications(request):
     if request.user.is_authenticated:
-        unread_count = Notification.objects.filter(
-            user=request.user, is_read=False
-        ).count()
-        return {"unread_count": unread_count}
-    return {"unread_count": 0}
+        user_id = request.user.pk
 
+        # Templates call this only when they render unread_count
+        @lru_cache(maxsize=None)
+        def unread_count():
+            return get_unread_count(user_id)
+
+        context = {"unread_count": unread_count}
+        if request.user.is_staff:
+            context["staff_events_url"] = staff_events_url(request.user)
+        return context
+    return {"unread_count": 0}
@@ -0,0 +1,61 @@
+from decimal import Decimal
+
+from django.db.models import Count, Max, Q, Sum
+
+from .jobs import background_job
+from .models import Customer, CustomerStats, Order
+
+
+def _aggregate_orders(orders):
+    # One grouped query: a row of totals per customer
+    return orders.with_totals().order_by().values('customer_id').annotate(
+        order_count=Count('id'),
+        lifetime_spend=Sum('total_amount'),
+        outstanding=Sum('outstanding_balance'),
+        pending_count=Count('id', filter=Q(status='pending')),
+        last_order_date=Max('order_date'),
+    )
+
+
+def _stats_from_row(customer_id, row):
+    return CustomerStats(
+        customer_id=customer_id,
+        order_count=row['order_count'] if row else 0,
+        lifetime_spend=(row['lifetime_spend'] if row else None) or Decimal('0'),
+        outstanding=(row['outstanding'] if row else None) or Decimal('0'),
+        pending_count=row['pending_count'] if row else 0,
+        last_order_date=row['last_order_date'] if row else None,
+    )
+
+
+@background_job
+def refresh_customer_stats(customer_id):
+    if not Customer.objects.filter(pk=customer_id).exists():
+        return None
+    row = next(iter(_aggregate_orders(Order.objects.filter(customer_id=customer_id))), None)
+    stats = _stats_from_row(customer_id, row)
+    stats.save()
+    return stats
+
+
+def get_customer_stats(customer):
+    try:
+        return CustomerStats.objects.get(customer=customer)
+    except CustomerStats.DoesNotExist:
+        return refresh_customer_stats(customer.pk)
+
+
+def rebuild_all_customer_stats(batch_size=500):
+    rows = {row['customer_id']: row for row in _aggregate_orders(Order.objects.all())}
+    stats = [
+        _stats_from_row(customer_id, rows.get(customer_id))
+        for customer_id in Customer.objects.values_list('pk', flat=True)
+    ]
+    CustomerStats.objects.bulk_create(
+        stats,
+        batch_size=batch_size,
+        update_conflicts=True,
+        unique_fields=['customer'],
+        update_fields=['order_count', 'lifetime_spend', 'outstanding', 'pending_count', 'last_order_date', 'updated_at'],
+    )
+    return len(stats)
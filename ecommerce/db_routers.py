@@ -0,0 +1,100 @@
+import logging
+import time
+from contextvars import ContextVar
+from functools import wraps
+from itertools import islice
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import DatabaseError, connections
+
+logger = logging.getLogger(__name__)
+
+REPORTING_ALIAS = 'reporting'
+
+_read_alias = ContextVar('ecommerce_read_alias', default=None)
+_lag_checks = {}
+
+
+def replica_lag_seconds(alias):
+    connection = connections[alias]
+    if connection.vendor != 'postgresql':
+        return 0.0
+    with connection.cursor() as cursor:
+        # A caught-up standby (or a primary used as the reporting URL) reports no lag
+        cursor.execute(
+            "SELECT CASE WHEN NOT pg_is_in_recovery() "
+            "OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+            "ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END"
+        )
+        return float(cursor.fetchone()[0])
+
+
+def reporting_db_available():
+    if REPORTING_ALIAS not in settings.DATABASES:
+        return False
+    now = time.monotonic()
+    checked_at, healthy = _lag_checks.get(REPORTING_ALIAS, (None, False))
+    if checked_at is not None and now - checked_at < getattr(settings, 'REPORTING_LAG_CHECK_INTERVAL', 10):
+        return healthy
+    try:
+        lag = replica_lag_seconds(REPORTING_ALIAS)
+        healthy = lag <= getattr(settings, 'REPORTING_MAX_LAG_SECONDS', 30)
+        if not healthy:
+            logger.warning('Reporting database is %.1fs behind, reading from primary', lag)
+    except DatabaseError:
+        logger.exception('Reporting database unavailable, reading from primary')
+        healthy = False
+    _lag_checks[REPORTING_ALIAS] = (now, healthy)
+    return healthy
+
+
+# Sends ORM reads to the reporting replica while active, if it is healthy
+class pinned_to_reporting:
+    def __enter__(self):
+        alias = REPORTING_ALIAS if reporting_db_available() else None
+        self._token = _read_alias.set(alias)
+        return alias or 'default'
+
+    def __exit__(self, *exc_info):
+        _read_alias.reset(self._token)
+
+
+def use_reporting_db(view_func):
+    @wraps(view_func)
+    def wrapper(request, *args, **kwargs):
+        with pinned_to_reporting():
+            return view_func(request, *args, **kwargs)
+    return wrapper
+
+
+def reporting_stream(rows):
+    # Streaming responses are consumed after the view returns, so pin again while iterating
+    with pinned_to_reporting():
+        yield from rows
+
+
+async def reporting_astream(rows, chunk_size=200):
+    # Under ASGI Django reads a synchronous streaming body into memory before sending
+    # any of it. This pulls rows a chunk at a time on the sync thread that owns the
+    # database connection and yields them as they arrive.
+    rows = iter(rows)
+
+    def next_chunk():
+        with pinned_to_reporting():
+            return list(islice(rows, chunk_size))
+
+    while chunk := await sync_to_async(next_chunk)():
+        for row in chunk:
+            yield row
+
+
+class ReportingRouter:
+    def db_for_read(self, model, **hints):
+        return _read_alias.get()
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
@@ -0,0 +1,99 @@
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import EmailOutbox
+
+logger = logging.getLogger(__name__)
+
+
+def enqueue_email(to_email, subject, body_text, body_html=''):
+    # Written on the caller's connection, so it commits or rolls back with the order change
+    return EmailOutbox.objects.create(
+        to_email=to_email, subject=subject, body_text=body_text, body_html=body_html,
+    )
+
+
+def _retry_delay(attempts):
+    base = getattr(settings, 'EMAIL_OUTBOX_RETRY_BASE_SECONDS', 60)
+    return timedelta(seconds=min(base * 2 ** (attempts - 1), 6 * 60 * 60))
+
+
+def claim_batch(batch_size, lease_seconds=300):
+    now = timezone.now()
+    with transaction.atomic():
+        batch = list(
+            EmailOutbox.objects.select_for_update(skip_locked=True)
+            .filter(status='pending', next_attempt_at__lte=now)
+            .order_by('next_attempt_at')[:batch_size]
+        )
+        # Push the rows out of reach of other workers; if this worker dies
+        # mid-batch they become due again once the lease runs out.
+        EmailOutbox.objects.filter(pk__in=[m.pk for m in batch]).update(
+            next_attempt_at=now + timedelta(seconds=lease_seconds),
+        )
+    return batch
+
+
+def _back_off(outbox, exc, max_attempts):
+    attempts = outbox.attempts + 1
+    logger.warning('Email %s to %s failed (attempt %s): %s', outbox.pk, outbox.to_email, attempts, exc)
+    EmailOutbox.objects.filter(pk=outbox.pk).update(
+        attempts=F('attempts') + 1,
+        last_error=str(exc)[:1000],
+        status='failed' if attempts >= max_attempts else 'pending',
+        next_attempt_at=timezone.now() + _retry_delay(attempts),
+    )
+
+
+def send_batch(batch, connection=None):
+    max_attempts = getattr(settings, 'EMAIL_OUTBOX_MAX_ATTEMPTS', 5)
+    connection = connection or get_connection(fail_silently=False)
+    sent = 0
+    try:
+        connection.open()
+    except Exception as exc:
+        # SMTP is down: the whole batch retries later instead of the worker dying
+        for outbox in batch:
+            _back_off(outbox, exc, max_attempts)
+        return 0
+    try:
+        for outbox in batch:
+            message = EmailMultiAlternatives(
+                subject=outbox.subject,
+                body=outbox.body_text,
+                from_email=settings.DEFAULT_FROM_EMAIL,
+                to=[outbox.to_email],
+                connection=connection,
+            )
+            if outbox.body_html:
+                message.attach_alternative(outbox.body_html, 'text/html')
+            try:
+                connection.send_messages([message])
+            except Exception as exc:
+                _back_off(outbox, exc, max_attempts)
+                continue
+            EmailOutbox.objects.filter(pk=outbox.pk).update(
+                status='sent', sent_at=timezone.now(), attempts=F('attempts') + 1, last_error='',
+            )
+            sent += 1
+    finally:
+        connection.close()
+    return sent
+
+
+def drain_outbox(batch_size=None):
+    batch_size = batch_size or getattr(settings, 'EMAIL_OUTBOX_BATCH_SIZE', 50)
+    total = 0
+    while batch := claim_batch(batch_size):
+        sent = send_batch(batch)
+        total += sent
+        # A batch that sent nothing (SMTP down) leaves the rest for the next poll
+        if len(batch) < batch_size or not sent:
+            break
+    return total
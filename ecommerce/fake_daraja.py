@@ -0,0 +1,107 @@
+# A stand-in for Safaricom's Daraja sandbox, for local development and tests.
+# It builds callbacks shaped like the real ones and can serve the two sandbox
+# endpoints that trigger them (C2B simulate and STK push).
+import json
+import random
+import string
+import threading
+import urllib.request
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def fake_receipt():
+    return ''.join(random.choices(string.ascii_uppercase + string.digits, k=10))
+
+
+def _timestamp():
+    return datetime.now().strftime('%Y%m%d%H%M%S')
+
+
+def c2b_confirmation(amount, account_reference='', receipt=None, msisdn='254708374149', short_code='600638'):
+    return {
+        'TransactionType': 'Pay Bill',
+        'TransID': receipt or fake_receipt(),
+        'TransTime': _timestamp(),
+        'TransAmount': str(amount),
+        'BusinessShortCode': short_code,
+        'BillRefNumber': str(account_reference),
+        'InvoiceNumber': '',
+        'OrgAccountBalance': '',
+        'ThirdPartyTransID': '',
+        'MSISDN': msisdn,
+        'FirstName': 'John',
+    }
+
+
+def stk_callback(amount, receipt=None, phone_number=254708374149, result_code=0, checkout_request_id=None):
+    callback = {
+        'MerchantRequestID': f'{random.randint(10000, 99999)}-{random.randint(1000000, 9999999)}-1',
+        'CheckoutRequestID': checkout_request_id or f'ws_CO_{_timestamp()}{random.randint(100, 999)}',
+        'ResultCode': result_code,
+        'ResultDesc': 'The service request is processed successfully.' if result_code == 0 else 'Request cancelled by user',
+    }
+    if result_code == 0:
+        callback['CallbackMetadata'] = {'Item': [
+            {'Name': 'Amount', 'Value': float(amount)},
+            {'Name': 'MpesaReceiptNumber', 'Value': receipt or fake_receipt()},
+            {'Name': 'TransactionDate', 'Value': int(_timestamp())},
+            {'Name': 'PhoneNumber', 'Value': phone_number},
+        ]}
+    return {'Body': {'stkCallback': callback}}
+
+
+def post_callback(url, payload, timeout=10):
+    request = urllib.request.Request(
+        url, data=json.dumps(payload).encode(), headers={'Content-Type': 'application/json'}, method='POST',
+    )
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return response.status, json.loads(response.read() or b'{}')
+
+
+class FakeDarajaHandler(BaseHTTPRequestHandler):
+    # Set on the server: where C2B confirmations go (STK requests name their own CallBackURL)
+    callback_url = None
+
+    def _reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)) or b'{}')
+        except ValueError:
+            return self._reply(400, {'errorMessage': 'Invalid JSON'})
+
+        if self.path == '/mpesa/c2b/v1/simulate':
+            payload = c2b_confirmation(body.get('Amount', 0), body.get('BillRefNumber', ''), msisdn=str(body.get('Msisdn', '254708374149')))
+            url = self.server.callback_url
+            reply = {'ConversationID': f'AG_{_timestamp()}', 'ResponseDescription': 'Accept the service request successfully.'}
+        elif self.path == '/mpesa/stkpush/v1/processrequest':
+            payload = stk_callback(body.get('Amount', 0), phone_number=body.get('PhoneNumber', 254708374149))
+            url = body.get('CallBackURL') or self.server.callback_url
+            reply = {
+                'MerchantRequestID': payload['Body']['stkCallback']['MerchantRequestID'],
+                'CheckoutRequestID': payload['Body']['stkCallback']['CheckoutRequestID'],
+                'ResponseCode': '0',
+                'ResponseDescription': 'Success. Request accepted for processing',
+            }
+        else:
+            return self._reply(404, {'errorMessage': 'Unknown endpoint'})
+
+        self._reply(200, reply)
+        # Like Daraja, the callback arrives after the request has been answered
+        threading.Thread(target=post_callback, args=(url, payload), daemon=True).start()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_server(callback_url, host='127.0.0.1', port=8001):
+    server = ThreadingHTTPServer((host, port), FakeDarajaHandler)
+    server.callback_url = callback_url
+    return server
@@ -94,7 +94,7 @@ class PaymentForm(forms.ModelForm):
 class ProductForm(forms.ModelForm):
     class Meta:
         model = Product
-        fields = ["name", "description", "sku", "price", "cost_price", "stock", "featured", "category", "brand"]
+        fields = ["name", "description", "sku", "price", "cost_price", "stock", "low_stock_threshold", "featured", "category", "brand"]
         widgets = {
             "name": forms.TextInput(attrs={'class': 'form-control', 'placeholder': 'e.g Samsung Galaxy S22'}),
             "description": forms.Textarea(attrs={'class': 'form-control', 'rows': 4, 'placeholder': 'Describe the product'}),
@@ -102,6 +102,7 @@ class ProductForm(forms.ModelForm):
             "price": forms.NumberInput(attrs={'class': 'form-control', 'placeholder': '0.00', 'step': '0.01', 'min': '0'}),
             "cost_price": forms.NumberInput(attrs={'class': 'form-control', 'placeholder': '0.00', 'step': '0.01', 'min': '0'}),
             "stock": forms.NumberInput(attrs={'class': 'form-control', 'placeholder': '0', 'min': '0'}),
+            "low_stock_threshold": forms.NumberInput(attrs={'class': 'form-control', 'placeholder': 'Automatic', 'min': '0'}),
             "featured": forms.CheckboxInput(attrs={'class': 'form-check-input'}),
             "category": forms.Select(attrs={'class': 'form-select'}),
             "brand": forms.Select(attrs={'class': 'form-select'}),
@@ -111,10 +112,11 @@ class ProductForm(forms.ModelForm):
 class ConsignmentForm(forms.ModelForm):
     class Meta:
         model = Consignment
-        fields = ['reference_number', 'supplier', 'date_received', 'freight_cost', 'customs_tax', 'other_expenses']
+        fields = ['reference_number', 'supplier', 'date_ordered', 'date_received', 'freight_cost', 'customs_tax', 'other_expenses']
         widgets = {
             'reference_number': forms.TextInput(attrs={'class': 'form-control', 'placeholder': 'e.g CON-2024-001'}),
             'supplier': forms.Select(attrs={'class': 'form-select'}),
+            'date_ordered': forms.DateInput(attrs={'class': 'form-control', 'type': 'date'}),
             'date_received': forms.DateInput(attrs={'class': 'form-control', 'type': 'date'}),
             'freight_cost': forms.NumberInput(attrs={'class': 'form-control', 'step': '0.01', 'min': '0'}),
             'customs_tax': forms.NumberInput(attrs={'class': 'form-control', 'step': '0.01', 'min': '0'}),
@@ -150,13 +152,14 @@ class ExpenseForm(forms.ModelForm):
 class SupplierForm(forms.ModelForm):
     class Meta:
         model = Supplier
-        fields = ['name', 'contact_person', 'phone', 'email', 'address']
+        fields = ['name', 'contact_person', 'phone', 'email', 'address', 'lead_time_days']
         widgets = {
             'name': forms.TextInput(attrs={'class': 'form-control', 'placeholder': 'Supplier name'}),
             'contact_person': forms.TextInput(attrs={'class': 'form-control', 'placeholder': 'Contact person'}),
             'phone': forms.TextInput(attrs={'class': 'form-control', 'placeholder': '+254 700 000 000'}),
             'email': forms.EmailInput(attrs={'class': 'form-control', 'placeholder': 'email@example.com'}),
             'address': forms.Textarea(attrs={'class': 'form-control', 'rows': 2, 'placeholder': 'Address'}),
+            'lead_time_days': forms.NumberInput(attrs={'class': 'form-control', 'min': '0', 'placeholder': 'e.g. 14'}),
         }
 
 
@@ -0,0 +1,198 @@
+import hashlib
+from datetime import timedelta
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.http import HttpResponse, JsonResponse
+from django.utils import timezone
+from rest_framework import exceptions
+
+from .models import IdempotencyKey
+
+# Form fields that differ between otherwise identical submissions of the same form
+_UNSIGNED_FIELDS = {'csrfmiddlewaretoken', 'idempotency_key'}
+_FORM_TYPES = ('application/x-www-form-urlencoded', 'multipart/form-data')
+
+
+class IdempotencyConflict(exceptions.APIException):
+    status_code = 409
+    default_detail = 'A request with this Idempotency-Key is still being processed.'
+    default_code = 'idempotency_conflict'
+
+    def __init__(self, wait):
+        super().__init__()
+        # DRF's exception handler sends this as Retry-After
+        self.wait = wait
+
+
+class IdempotencyKeyReused(exceptions.APIException):
+    status_code = 422
+    default_detail = 'This Idempotency-Key was already used for a different request.'
+    default_code = 'idempotency_key_reused'
+
+
+class IdempotentReplay(Exception):
+    def __init__(self, response):
+        self.response = response
+
+
+def request_key(request):
+    # API clients send the header; HTML forms carry a hidden idempotency_key field
+    key = request.headers.get('Idempotency-Key') or request.POST.get('idempotency_key', '')
+    return key.strip()[:255]
+
+
+def fingerprint(request):
+    digest = hashlib.sha256(f'{request.method} {request.path}\n'.encode())
+    if request.content_type in _FORM_TYPES:
+        for name, values in sorted(request.POST.lists()):
+            if name not in _UNSIGNED_FIELDS:
+                digest.update(repr((name, values)).encode())
+    else:
+        digest.update(request.body)
+    return digest.hexdigest()
+
+
+def _cache_key(user_id, key):
+    return f"idempotency:{user_id}:{hashlib.sha256(key.encode()).hexdigest()}"
+
+
+def _ttl():
+    return timedelta(hours=getattr(settings, 'IDEMPOTENCY_KEY_TTL_HOURS', 24))
+
+
+def _replay(stored, request_fingerprint):
+    request_hash, status_code, content_type, location, body = stored
+    if request_hash != request_fingerprint:
+        raise IdempotencyKeyReused()
+    response = HttpResponse(body, status=status_code, content_type=content_type)
+    if location:
+        response['Location'] = location
+    response['Idempotent-Replayed'] = 'true'
+    raise IdempotentReplay(response)
+
+
+def _stored(row):
+    return row.fingerprint, row.status_code, row.content_type, row.location, bytes(row.body)
+
+
+def claim(user, key, request_fingerprint):
+    # Returns the claimed IdempotencyKey row, or raises IdempotentReplay with the
+    # first request's response, IdempotencyKeyReused, or IdempotencyConflict (409
+    # with Retry-After) while the first request is still running. Never waits for
+    # it: that would hold this worker thread for as long as the first request takes.
+    cache_key = _cache_key(user.pk, key)
+    stored = cache.get(cache_key)
+    if stored is not None:
+        _replay(stored, request_fingerprint)
+
+    # More than one pass only when the row disappears or expires between the
+    # INSERT and the read
+    for _ in range(3):
+        try:
+            # Committed on its own, before the view's transaction, so a retry
+            # arriving mid-request finds it
+            with transaction.atomic():
+                return IdempotencyKey.objects.create(user=user, key=key, fingerprint=request_fingerprint)
+        except IntegrityError:
+            pass
+        row = IdempotencyKey.objects.filter(user=user, key=key).first()
+        if row is None:
+            continue
+        now = timezone.now()
+        if row.created_at < now - _ttl():
+            IdempotencyKey.objects.filter(pk=row.pk, created_at=row.created_at).delete()
+            continue
+        if row.status_code is not None:
+            cache.set(cache_key, _stored(row), _ttl().total_seconds())
+            _replay(_stored(row), request_fingerprint)
+        if row.fingerprint != request_fingerprint:
+            raise IdempotencyKeyReused()
+        stale = now - timedelta(seconds=getattr(settings, 'IDEMPOTENCY_PENDING_TIMEOUT_SECONDS', 120))
+        if row.created_at < stale and IdempotencyKey.objects.filter(pk=row.pk, created_at=row.created_at).update(created_at=now):
+            # The worker that claimed it died mid-request
+            row.created_at = now
+            return row
+        break
+    raise IdempotencyConflict(getattr(settings, 'IDEMPOTENCY_RETRY_AFTER_SECONDS', 1))
+
+
+def finish(row, response):
+    # Successful and redirect responses are kept and replayed; errors release the
+    # key so the client can retry once whatever went wrong is fixed
+    if response.status_code >= 400 or response.streaming:
+        release(row)
+        return
+    stored = (row.fingerprint, response.status_code, response.get('Content-Type', ''),
+              response.get('Location', ''), response.content)
+    IdempotencyKey.objects.filter(pk=row.pk).update(
+        status_code=stored[1], content_type=stored[2], location=stored[3], body=stored[4],
+    )
+    cache.set(_cache_key(row.user_id, row.key), stored, _ttl().total_seconds())
+
+
+def release(row):
+    IdempotencyKey.objects.filter(pk=row.pk, status_code__isnull=True).delete()
+
+
+def prune_idempotency_keys():
+    deleted, _ = IdempotencyKey.objects.filter(created_at__lt=timezone.now() - _ttl()).delete()
+    return deleted
+
+
+def idempotent(view_func):
+    # For POST-handling function views; goes outside @transaction.atomic so the
+    # claim is visible to concurrent retries
+    @wraps(view_func)
+    def wrapper(request, *args, **kwargs):
+        key = request_key(request) if request.method == 'POST' else ''
+        if not key or not request.user.is_authenticated:
+            return view_func(request, *args, **kwargs)
+        try:
+            row = claim(request.user, key, fingerprint(request))
+        except IdempotentReplay as replay:
+            return replay.response
+        except exceptions.APIException as exc:
+            response = JsonResponse({'error': str(exc.detail)}, status=exc.status_code)
+            if getattr(exc, 'wait', None):
+                response['Retry-After'] = str(exc.wait)
+            return response
+        try:
+            response = view_func(request, *args, **kwargs)
+        except BaseException:
+            release(row)
+            raise
+        finish(row, response)
+        return response
+    return wrapper
+
+
+class IdempotentMixin:
+    # POSTs to a viewset (create and the bulk actions) honour Idempotency-Key
+    idempotency_row = None
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        key = request_key(request._request) if request.method == 'POST' else ''
+        if key and request.user.is_authenticated:
+            self.idempotency_row = claim(request.user, key, fingerprint(request._request))
+
+    def handle_exception(self, exc):
+        if isinstance(exc, IdempotentReplay):
+            return exc.response
+        try:
+            return super().handle_exception(exc)
+        except BaseException:
+            if self.idempotency_row is not None:
+                release(self.idempotency_row)
+            raise
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        if self.idempotency_row is not None:
+            if response.status_code < 400:
+                response.render()
+            finish(self.idempotency_row, response)
+        return response
@@ -0,0 +1,65 @@
+from decimal import Decimal
+from itertools import islice
+
+from django.db import transaction
+from django.db.models import Count, DecimalField, F, Sum, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import InventorySnapshot, InventorySnapshotItem, Product
+
+VALUE_FIELD = DecimalField(max_digits=14, decimal_places=2)
+
+
+def current_stock_valuation():
+    zero = Value(Decimal('0'), output_field=VALUE_FIELD)
+    return Product.objects.aggregate(
+        product_count=Count('id'),
+        total_units=Coalesce(Sum('stock'), 0),
+        total_cost_value=Coalesce(Sum(F('stock') * Coalesce('cost_price', zero), output_field=VALUE_FIELD), zero),
+        total_retail_value=Coalesce(Sum(F('stock') * F('price'), output_field=VALUE_FIELD), zero),
+    )
+
+
+def take_inventory_snapshot(batch_size=1000):
+    # Always today's: it records current stock, so it can't stand in for a past day
+    snapshot_date = timezone.localdate()
+    with transaction.atomic():
+        # Re-running for the same day replaces that day's snapshot
+        InventorySnapshot.objects.filter(snapshot_date=snapshot_date).delete()
+        snapshot = InventorySnapshot.objects.create(snapshot_date=snapshot_date, **current_stock_valuation())
+        rows = (
+            InventorySnapshotItem(
+                snapshot=snapshot,
+                product_id=p['id'],
+                snapshot_date=snapshot_date,
+                stock=p['stock'],
+                price=p['price'],
+                cost_price=p['cost_price'],
+                cost_value=(p['cost_price'] or 0) * p['stock'],
+                retail_value=p['price'] * p['stock'],
+            )
+            for p in Product.objects.values('id', 'stock', 'price', 'cost_price').iterator(chunk_size=batch_size)
+        )
+        while batch := list(islice(rows, batch_size)):
+            InventorySnapshotItem.objects.bulk_create(batch, batch_size=batch_size)
+    return snapshot
+
+
+def valuation_on(day):
+    return InventorySnapshot.objects.filter(snapshot_date__lte=day).order_by('-snapshot_date').first()
+
+
+def valuation_series(start, end):
+    return InventorySnapshot.objects.filter(snapshot_date__range=[start, end]).order_by('snapshot_date').values(
+        'snapshot_date', 'total_units', 'total_cost_value', 'total_retail_value',
+    )
+
+
+def stock_history(product_id, start=None, end=None):
+    history = InventorySnapshotItem.objects.filter(product_id=product_id)
+    if start:
+        history = history.filter(snapshot_date__gte=start)
+    if end:
+        history = history.filter(snapshot_date__lte=end)
+    return history.order_by('snapshot_date').values('snapshot_date', 'stock', 'cost_value', 'retail_value')
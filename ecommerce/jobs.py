@@ -0,0 +1,108 @@
+import logging
+from datetime import timedelta
+from functools import wraps
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .models import BackgroundJob, DeadJob
+
+logger = logging.getLogger(__name__)
+
+
+def background_job(func):
+    name = f'{func.__module__}.{func.__name__}'
+
+    @wraps(func)
+    def delay(*args, **kwargs):
+        return enqueue(name, *args, **kwargs)
+
+    def schedule(run_at, *args, **kwargs):
+        return BackgroundJob.objects.create(name=name, args=list(args), kwargs=kwargs, run_at=run_at)
+
+    func.is_background_job = True
+    func.delay = delay
+    func.schedule = schedule
+    return func
+
+
+def enqueue(name, *args, **kwargs):
+    # The row is written on the caller's connection, so a worker only sees it once
+    # the surrounding transaction commits, and it disappears if that rolls back.
+    # An identical job nobody has claimed yet is re-armed instead: the UPDATE locks
+    # it, so claim_jobs skips it until this transaction commits and the job then
+    # sees what the caller wrote. If a worker claimed it first, its run_at has moved
+    # past now, the update matches nothing and a new job is queued.
+    now = timezone.now()
+    pending = BackgroundJob.objects.filter(name=name, args=list(args), kwargs=kwargs, attempts=0, run_at__lte=now)
+    pk = pending.values_list('pk', flat=True).first()
+    if pk is not None and BackgroundJob.objects.filter(pk=pk, attempts=0, run_at__lte=now).update(run_at=now):
+        return None
+    return BackgroundJob.objects.create(name=name, args=list(args), kwargs=kwargs)
+
+
+def _retry_delay(attempts):
+    base = getattr(settings, 'JOB_RETRY_BASE_SECONDS', 30)
+    return timedelta(seconds=min(base * 2 ** (attempts - 1), 6 * 60 * 60))
+
+
+def claim_jobs(batch_size, lease_seconds=300):
+    now = timezone.now()
+    with transaction.atomic():
+        batch = list(
+            BackgroundJob.objects.select_for_update(skip_locked=True)
+            .filter(run_at__lte=now).order_by('run_at')[:batch_size]
+        )
+        # Same lease scheme as the email outbox: a crashed worker's jobs come back
+        # once the lease runs out
+        BackgroundJob.objects.filter(pk__in=[job.pk for job in batch]).update(
+            run_at=now + timedelta(seconds=lease_seconds),
+        )
+    return batch
+
+
+def run_job(job):
+    max_attempts = getattr(settings, 'JOB_MAX_ATTEMPTS', 5)
+    try:
+        func = import_string(job.name)
+        if not getattr(func, 'is_background_job', False):
+            raise ValueError(f'{job.name} is not a background job')
+        with transaction.atomic():
+            func(*job.args, **job.kwargs)
+    except Exception as exc:
+        attempts = job.attempts + 1
+        logger.warning('Job %s %s failed (attempt %s): %s', job.pk, job.name, attempts, exc)
+        if attempts >= max_attempts:
+            with transaction.atomic():
+                DeadJob.objects.create(
+                    name=job.name, args=job.args, kwargs=job.kwargs, attempts=attempts,
+                    last_error=str(exc)[:1000], created_at=job.created_at,
+                )
+                job.delete()
+        else:
+            BackgroundJob.objects.filter(pk=job.pk).update(
+                attempts=attempts, last_error=str(exc)[:1000], run_at=timezone.now() + _retry_delay(attempts),
+            )
+        return False
+    job.delete()
+    return True
+
+
+def run_pending_jobs(batch_size=None):
+    batch_size = batch_size or getattr(settings, 'JOB_BATCH_SIZE', 20)
+    done = 0
+    while batch := claim_jobs(batch_size):
+        done += sum(run_job(job) for job in batch)
+        if len(batch) < batch_size:
+            break
+    return done
+
+
+def requeue_dead_jobs(dead_jobs):
+    with transaction.atomic():
+        BackgroundJob.objects.bulk_create(
+            [BackgroundJob(name=job.name, args=job.args, kwargs=job.kwargs) for job in dead_jobs]
+        )
+        DeadJob.objects.filter(pk__in=[job.pk for job in dead_jobs]).delete()
@@ -0,0 +1,47 @@
+import time
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from rest_framework.authtoken.models import Token
+
+from ecommerce.models import ApiRateLimit
+from ecommerce.throttling import THROTTLE_SCOPES, usage_key
+
+
+class Command(BaseCommand):
+    help = 'Requests and throttled requests per API token and throttle scope over the last few hours'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hours', type=int, default=24)
+
+    def handle(self, *args, **options):
+        now_hour = int(time.time() // 3600)
+        hours = range(now_hour - options['hours'] + 1, now_hour + 1)
+        limits = {}
+        for user_id, scope, rate in ApiRateLimit.objects.values_list('user_id', 'scope', 'rate'):
+            limits.setdefault(user_id, []).append(f"{scope or 'all'}={rate}")
+
+        rows = []
+        for user_id, username in Token.objects.values_list('user_id', 'user__username'):
+            keys = {
+                (scope, throttled): [usage_key(hour, scope, user_id, throttled) for hour in hours]
+                for scope in THROTTLE_SCOPES for throttled in (False, True)
+            }
+            counts = cache.get_many([key for scope_keys in keys.values() for key in scope_keys])
+            totals = {group: sum(counts.get(key, 0) for key in group_keys) for group, group_keys in keys.items()}
+            requests = sum(count for (_, throttled), count in totals.items() if not throttled)
+            if requests:
+                rows.append((requests, username, user_id, totals))
+
+        if not rows:
+            self.stdout.write(f"No token API requests in the last {options['hours']} hours.")
+            return
+        for requests, username, user_id, totals in sorted(rows, key=lambda row: row[0], reverse=True):
+            throttled = sum(count for (_, is_throttled), count in totals.items() if is_throttled)
+            self.stdout.write(self.style.MIGRATE_HEADING(
+                f"{username}: {requests} requests, {throttled} throttled"
+                + (f" (limits: {', '.join(limits[user_id])})" if user_id in limits else '')
+            ))
+            for scope in THROTTLE_SCOPES:
+                if totals[(scope, False)]:
+                    self.stdout.write(f"  {scope:<10} {totals[(scope, False)]:>8}  throttled {totals[(scope, True)]:>6}")
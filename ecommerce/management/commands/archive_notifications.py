@@ -0,0 +1,17 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from ecommerce.notifications_util import archive_read_notifications
+
+
+class Command(BaseCommand):
+    help = 'Move read notifications older than the retention period into the archive table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=None, help='Defaults to NOTIFICATION_RETENTION_DAYS')
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        days = options['days'] if options['days'] is not None else settings.NOTIFICATION_RETENTION_DAYS
+        archived = archive_read_notifications(days, batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Archived {archived} notifications older than {days} days'))
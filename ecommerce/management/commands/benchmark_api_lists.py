@@ -0,0 +1,72 @@
+import json
+import time
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from rest_framework.renderers import JSONRenderer
+
+from ecommerce.models import Customer, Order, OrderItem, Payment, Product
+from ecommerce.renderers import FastJSONRenderer, convert_rows, fast_list_plan, fast_list_values, orjson
+from ecommerce.serializers import OrderSerializer
+
+
+def serializer_path(queryset):
+    return JSONRenderer().render(OrderSerializer(queryset, many=True).data)
+
+
+def fast_path(queryset):
+    plan = fast_list_plan(OrderSerializer())
+    return FastJSONRenderer().render(convert_rows(list(fast_list_values(queryset, plan)), plan))
+
+
+class Command(BaseCommand):
+    help = 'Time OrderSerializer + JSONRenderer against the .values() + orjson list path on throwaway orders'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, nargs='+', default=[1000, 10000])
+        parser.add_argument('--repeat', type=int, default=3, help='Best of this many runs is reported')
+
+    def handle(self, *args, **options):
+        if orjson is None:
+            raise CommandError('orjson is not installed, so there is no fast path to compare')
+        # Everything is created inside a transaction that is rolled back at the end
+        with transaction.atomic():
+            self.create_orders(max(options['rows']))
+            for rows in sorted(options['rows']):
+                queryset = Order.objects.with_totals().order_by('-id')[:rows]
+                if json.loads(serializer_path(queryset)) != json.loads(fast_path(queryset)):
+                    self.stderr.write(self.style.WARNING(f'{rows} rows: the two paths returned different data'))
+                slow = self.best_of(serializer_path, queryset, options['repeat'])
+                fast = self.best_of(fast_path, queryset, options['repeat'])
+                self.stdout.write(
+                    f'{rows:>6} rows  serializer {slow * 1000:8.1f} ms  fast {fast * 1000:8.1f} ms  '
+                    f'{slow / fast:4.1f}x'
+                )
+            transaction.set_rollback(True)
+
+    def best_of(self, path, queryset, repeat):
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            path(queryset.all())
+            timings.append(time.perf_counter() - started)
+        return min(timings)
+
+    def create_orders(self, count):
+        user = User.objects.create_user(f'benchmark-{time.time_ns()}')
+        customer, _ = Customer.objects.get_or_create(user=user)
+        product = Product.objects.create(name='Benchmark product', price=Decimal('120.00'), stock=0)
+        orders = Order.objects.bulk_create(
+            [Order(customer=customer, status='delivered', admin_note=f'Benchmark order {n}') for n in range(count)],
+            batch_size=1000,
+        )
+        OrderItem.objects.bulk_create(
+            [OrderItem(order=order, product=product, quantity=n % 5 + 1, price=product.price) for n, order in enumerate(orders)],
+            batch_size=1000,
+        )
+        Payment.objects.bulk_create(
+            [Payment(order=order, amount=Decimal('100.00'), status='completed') for order in orders],
+            batch_size=1000,
+        )
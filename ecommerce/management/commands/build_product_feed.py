@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from ecommerce.product_feed import FEED_FORMATS, build_feed_rows, publish_feed
+
+
+class Command(BaseCommand):
+    help = 'Rebuild every public product feed row and republish the JSON lines and CSV files'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        build_feed_rows(batch_size=options['batch_size'])
+        count = publish_feed()
+        self.stdout.write(self.style.SUCCESS(f"Published {count} products as {', '.join(FEED_FORMATS)}"))
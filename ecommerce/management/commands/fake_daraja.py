@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from ecommerce.fake_daraja import c2b_confirmation, make_server, post_callback, stk_callback
+
+
+class Command(BaseCommand):
+    help = 'Send a fake M-Pesa callback to this app, or serve a local stand-in for the Daraja sandbox'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--callback-url', required=True, help='e.g. http://127.0.0.1:8000/api/mpesa/callback/<token>/')
+        parser.add_argument('--serve', action='store_true', help='Serve /mpesa/c2b/v1/simulate and /mpesa/stkpush/v1/processrequest')
+        parser.add_argument('--port', type=int, default=8001)
+        parser.add_argument('--amount', help='Amount for a one-off callback')
+        parser.add_argument('--account', default='', help='Account reference (order number) for a C2B callback')
+        parser.add_argument('--receipt', help='M-Pesa receipt code; random if omitted')
+        parser.add_argument('--stk', action='store_true', help='Send an STK push result instead of a C2B confirmation')
+
+    def handle(self, *args, **options):
+        if options['serve']:
+            server = make_server(options['callback_url'], port=options['port'])
+            self.stdout.write(f"Fake Daraja listening on http://127.0.0.1:{options['port']}")
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                server.server_close()
+            return
+
+        if not options['amount']:
+            raise CommandError('--amount is required unless --serve is given')
+        if options['stk']:
+            payload = stk_callback(options['amount'], receipt=options['receipt'])
+        else:
+            payload = c2b_confirmation(options['amount'], options['account'], receipt=options['receipt'])
+        status, body = post_callback(options['callback_url'], payload)
+        self.stdout.write(f'{status} {body}')
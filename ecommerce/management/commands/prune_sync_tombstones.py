@@ -0,0 +1,16 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from ecommerce.sync import prune_tombstones
+
+
+class Command(BaseCommand):
+    help = 'Delete sync tombstones older than the retention period'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=None, help='Defaults to SYNC_TOMBSTONE_RETENTION_DAYS')
+
+    def handle(self, *args, **options):
+        days = options['days'] if options['days'] is not None else settings.SYNC_TOMBSTONE_RETENTION_DAYS
+        deleted = prune_tombstones(days)
+        self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} sync tombstones older than {days} days'))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from ecommerce.customer_stats import rebuild_all_customer_stats
+
+
+class Command(BaseCommand):
+    help = 'Recompute the cached lifetime stats for every customer'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        count = rebuild_all_customer_stats(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt stats for {count} customers'))
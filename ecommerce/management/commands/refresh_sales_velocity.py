@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from ecommerce.velocity import products_needing_refresh, refresh_sales_velocity
+
+
+class Command(BaseCommand):
+    help = 'Recompute rolling sales velocity and reorder points per product'
+
+    def add_arguments(self, parser):
+        # The nightly cron runs incrementally; --full is for manual runs, e.g. after
+        # editing supplier lead times or the velocity settings
+        parser.add_argument('--full', action='store_true', help='Recompute every product, not just those with new activity')
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        product_ids = None if options['full'] else products_needing_refresh(now)
+        count = refresh_sales_velocity(product_ids, now=now)
+        self.stdout.write(self.style.SUCCESS(f'Refreshed sales velocity for {count} products'))
@@ -0,0 +1,27 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from ecommerce.email_outbox import drain_outbox
+from ecommerce.jobs import run_pending_jobs
+
+
+class Command(BaseCommand):
+    help = 'Run queued background jobs and send outbox emails'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None)
+        parser.add_argument('--loop', action='store_true', help='Keep polling instead of exiting when the queues are empty')
+        parser.add_argument('--sleep', type=float, default=2, help='Seconds to wait between polls in --loop mode')
+
+    def handle(self, *args, **options):
+        while True:
+            done = run_pending_jobs(options['batch_size'])
+            sent = drain_outbox()
+            if done or sent:
+                self.stdout.write(f'Ran {done} jobs, sent {sent} emails')
+            if not options['loop']:
+                break
+            # Only sleep when idle so a backlog drains at full speed
+            if not done and not sent:
+                time.sleep(options['sleep'])
@@ -0,0 +1,23 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from ecommerce.email_outbox import drain_outbox
+
+
+class Command(BaseCommand):
+    help = 'Send queued notification emails from the outbox'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None)
+        parser.add_argument('--loop', action='store_true', help='Keep polling the outbox instead of exiting when it is empty')
+        parser.add_argument('--sleep', type=float, default=5, help='Seconds to wait between polls in --loop mode')
+
+    def handle(self, *args, **options):
+        while True:
+            sent = drain_outbox(options['batch_size'])
+            if sent:
+                self.stdout.write(f'Sent {sent} emails')
+            if not options['loop']:
+                break
+            time.sleep(options['sleep'])
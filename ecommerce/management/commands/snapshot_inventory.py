@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from ecommerce.inventory import take_inventory_snapshot
+
+
+class Command(BaseCommand):
+    help = "Record today's per-product stock and valuation"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        snapshot = take_inventory_snapshot(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Snapshot for {snapshot.snapshot_date}: {snapshot.product_count} products, '
+            f'cost KSh {snapshot.total_cost_value}, retail KSh {snapshot.total_retail_value}'
+        ))
@@ -0,0 +1,47 @@
+# Generated by Django 5.2.9 on 2026-10-19 11:58
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ecommerce', '0018_customerstats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InventorySnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('snapshot_date', models.DateField(unique=True)),
+                ('product_count', models.PositiveIntegerField(default=0)),
+                ('total_units', models.PositiveBigIntegerField(default=0)),
+                ('total_cost_value', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('total_retail_value', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ['-snapshot_date'],
+            },
+        ),
+        migrations.CreateModel(
+            name='InventorySnapshotItem',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('snapshot_date', models.DateField()),
+                ('stock', models.PositiveIntegerField()),
+                ('price', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('cost_price', models.DecimalField(blank=True, decimal_places=2, max_digits=10, null=True)),
+                ('cost_value', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('retail_value', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='inventory_snapshots', to='ecommerce.product')),
+                ('snapshot', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='items', to='ecommerce.inventorysnapshot')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['product', 'snapshot_date'], name='ecommerce_i_product_701256_idx')],
+                'unique_together': {('snapshot', 'product')},
+            },
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.2.9 on 2026-10-19 12:00
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ecommerce', '0019_inventorysnapshot'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductVelocity',
+            fields=[
+                ('product', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='velocity', serialize=False, to='ecommerce.product')),
+                ('units_sold', models.PositiveIntegerField(default=0, help_text='Units sold in the rolling window')),
+                ('window_days', models.PositiveIntegerField()),
+                ('daily_velocity', models.DecimalField(decimal_places=3, default=0, max_digits=10)),
+                ('lead_time_days', models.PositiveIntegerField()),
+                ('reorder_point', models.PositiveIntegerField(default=0)),
+                ('computed_at', models.DateTimeField()),
+            ],
+            options={
+                'verbose_name_plural': 'Product velocities',
+            },
+        ),
+        migrations.AddField(
+            model_name='consignment',
+            name='date_ordered',
+            field=models.DateField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='supplier',
+            name='lead_time_days',
+            field=models.PositiveIntegerField(blank=True, help_text='Typical days from placing an order to receiving it', null=True),
+        ),
+    ]
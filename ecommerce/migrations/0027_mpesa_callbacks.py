@@ -0,0 +1,35 @@
+# Generated by Django 5.2.9 on 2026-10-19 12:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ecommerce', '0026_email_digest'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MpesaCallback',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('stk', 'STK Push'), ('c2b', 'C2B Confirmation')], max_length=3)),
+                ('payload', models.JSONField()),
+                ('receipt_number', models.CharField(blank=True, db_index=True, max_length=20)),
+                ('amount', models.DecimalField(blank=True, decimal_places=2, max_digits=10, null=True)),
+                ('phone_number', models.CharField(blank=True, max_length=20)),
+                ('account_reference', models.CharField(blank=True, max_length=50)),
+                ('result_code', models.IntegerField(default=0)),
+                ('received_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ['-received_at'],
+            },
+        ),
+        migrations.AddField(
+            model_name='payment',
+            name='mpesa_receipt',
+            field=models.CharField(blank=True, max_length=20, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.9 on 2026-10-19 12:45
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ecommerce', '0029_api_rate_limits'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductFeedRow',
+            fields=[
+                ('product', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='feed_row', serialize=False, to='ecommerce.product')),
+                ('json_line', models.TextField()),
+                ('csv_line', models.TextField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
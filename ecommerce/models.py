@@ -1,7 +1,12 @@
+from decimal import Decimal
+
 from django.db import models
+from django.db.models import ExpressionWrapper, F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce, Greatest
 from django.contrib.auth.models import User
 from django.conf import settings
 from django.core.exceptions import ValidationError
+from django.utils import timezone
 from django.utils.text import slugify
 
 
@@ -51,6 +56,7 @@ class Customer(models.Model):
     phone_number = models.CharField(max_length=20, blank=True)
     address = models.TextField(blank=True)
     profile_picture = models.ImageField(upload_to='profile_pics/', null=True, blank=True)
+    email_digest = models.BooleanField(default=False, help_text='Bundle order update emails into one digest per window')
 
     def __str__(self):
         return self.user.username
@@ -63,9 +69,23 @@ class Product(models.Model):
     price = models.DecimalField(max_digits=10, decimal_places=2)
     cost_price = models.DecimalField(max_digits=10, decimal_places=2, blank=True, null=True, help_text='Supplier cost price for profit calculation')
     stock = models.PositiveIntegerField()
+    low_stock_threshold = models.PositiveIntegerField(blank=True, null=True, help_text='Alert staff at or below this stock level; leave blank to use the reorder point from sales velocity')
+    low_stock_alerted = models.BooleanField(default=False, editable=False)
     featured = models.BooleanField(default=False, help_text='Show as featured/best seller on the storefront')
     category = models.ForeignKey(Category, on_delete=models.SET_NULL, null=True, blank=True, related_name='products')
     brand = models.ForeignKey(Brand, on_delete=models.SET_NULL, null=True, blank=True, related_name='products')
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    def save(self, *args, update_fields=None, **kwargs):
+        # A full save from a stale instance would clear low_stock_alerted and repeat the
+        # alert, so it leaves the flag to check_stock_level's conditional UPDATEs. Name it
+        # in update_fields to write it on purpose.
+        if update_fields is None and not args and not self._state.adding and not kwargs.get('force_insert'):
+            update_fields = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name != 'low_stock_alerted'
+            ]
+        super().save(*args, update_fields=update_fields, **kwargs)
 
     def get_profit(self):
         if self.cost_price is not None:
@@ -88,9 +108,70 @@ class ProductImage(models.Model):
     def __str__(self):
         return f"Image for {self.product.name}"
 
-    def delete(self, *args, **kwargs):
-        self.image.delete(save=False)
-        super().delete(*args, **kwargs)
+
+class ProductFeedRow(models.Model):
+    # Prebuilt line of the public product feed, refreshed when the product changes
+    # so publishing the feed is a concatenation rather than a re-serialisation
+    product = models.OneToOneField(Product, on_delete=models.CASCADE, primary_key=True, related_name='feed_row')
+    json_line = models.TextField()
+    csv_line = models.TextField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Feed row for {self.product_id}"
+
+
+class ProductFeedFile(models.Model):
+    # The published feed, gzipped. Kept in the database because the worker that
+    # publishes it and the web service that serves it don't share a filesystem.
+    name = models.CharField(max_length=50, unique=True)
+    content = models.BinaryField()
+    etag = models.CharField(max_length=64)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.name
+
+
+
+MONEY_FIELD = models.DecimalField(max_digits=12, decimal_places=2)
+
+
+def order_total_subquery(order_ref='pk'):
+    return OrderItem.objects.filter(order=OuterRef(order_ref)).values('order').annotate(
+        total=Sum(F('price') * F('quantity'), output_field=MONEY_FIELD)
+    ).values('total')
+
+
+def order_paid_subquery(order_ref='pk'):
+    return Payment.objects.filter(
+        order=OuterRef(order_ref), status__in=['completed', 'pending']
+    ).values('order').annotate(total=Sum('amount')).values('total')
+
+
+def money(expression):
+    return Coalesce(Subquery(expression, output_field=MONEY_FIELD), Value(Decimal('0'), output_field=MONEY_FIELD))
+
+
+class OrderQuerySet(models.QuerySet):
+    def with_totals(self):
+        # SQL equivalents of get_total_amount/get_total_paid/get_outstanding_balance
+        zero = Value(Decimal('0'), output_field=MONEY_FIELD)
+        return self.annotate(
+            total_amount=money(order_total_subquery()),
+            total_paid=money(order_paid_subquery()),
+        ).annotate(
+            outstanding_balance=Greatest(F('total_amount') - F('total_paid'), zero, output_field=MONEY_FIELD),
+        )
+
+    def for_api(self, totals=True, items=True, payments=True):
+        # What OrderSerializer reads: annotated totals plus whichever nested blocks it renders
+        orders = self.with_totals() if totals else self
+        if items:
+            orders = orders.prefetch_related('items')
+        if payments:
+            orders = orders.prefetch_related('payments')
+        return orders
 
 
 class Order(models.Model):
@@ -126,6 +207,10 @@ class Order(models.Model):
     admin_note = models.TextField(blank=True, null=True, help_text='Admin note for approval/rejection')
     confirmed_at = models.DateTimeField(null=True, blank=True)
     mpesa_code = models.CharField(max_length=20, blank=True, null=True, help_text='M-Pesa transaction code if applicable')
+    # Also bumped when the order's items or payments change, so synced totals stay current
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    objects = OrderQuerySet.as_manager()
 
     def __str__(self):
         return f"Order {self.id} by {self.customer.user.username}"
@@ -203,6 +288,30 @@ class OrderItem(models.Model):
         super().delete(*args, **kwargs)
 
 
+class CustomerStats(models.Model):
+    customer = models.OneToOneField(Customer, on_delete=models.CASCADE, primary_key=True, related_name='stats')
+    order_count = models.PositiveIntegerField(default=0)
+    lifetime_spend = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    outstanding = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    pending_count = models.PositiveIntegerField(default=0)
+    last_order_date = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name_plural = "Customer stats"
+
+    def __str__(self):
+        return f"Stats for {self.customer}"
+
+
+class PaymentQuerySet(models.QuerySet):
+    def with_order_outstanding(self):
+        zero = Value(Decimal('0'), output_field=MONEY_FIELD)
+        return self.annotate(order_outstanding=Greatest(
+            money(order_total_subquery('order')) - money(order_paid_subquery('order')), zero, output_field=MONEY_FIELD,
+        ))
+
+
 class Payment(models.Model):
     order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='payments')
     payment_date = models.DateTimeField(auto_now_add=True)
@@ -219,6 +328,11 @@ class Payment(models.Model):
     )
     notes = models.TextField(blank=True)
     created_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='payments_created')
+    # Set for payments confirmed from an M-Pesa callback; unique so a receipt is only ever applied once
+    mpesa_receipt = models.CharField(max_length=20, unique=True, null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    objects = PaymentQuerySet.as_manager()
 
     def clean(self):
         from decimal import Decimal
@@ -239,21 +353,30 @@ class Payment(models.Model):
         self.clean()
         super().save(*args, **kwargs)
         total_paid = sum(p.amount for p in self.order.payments.all())
-        if total_paid >= self.order.get_total_amount():
-            self.order.payments.update(status='completed')
-        else:
-            self.order.payments.update(status='pending')
+        status = 'completed' if total_paid >= self.order.get_total_amount() else 'pending'
+        # update() skips auto_now, and only rows whose status flips have changed for sync clients
+        self.order.payments.exclude(status=status).update(status=status, updated_at=timezone.now())
 
     def __str__(self):
         return f"{self.amount} via {self.payment_method} for Order {self.order.id}"
 
 
+class DebtQuerySet(models.QuerySet):
+    def with_order_totals(self):
+        return self.annotate(order_total=money(order_total_subquery('order'))).annotate(
+            amount_paid=ExpressionWrapper(F('order_total') - F('outstanding_balance'), output_field=MONEY_FIELD),
+        )
+
+
 class Debt(models.Model):
     customer = models.ForeignKey(Customer, on_delete=models.CASCADE, related_name='debts')
     order = models.ForeignKey(Order, on_delete=models.CASCADE)
     outstanding_balance = models.DecimalField(max_digits=10, decimal_places=2)
     paid_at = models.DateField(null=True, blank=True)
     is_paid = models.BooleanField(default=False)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    objects = DebtQuerySet.as_manager()
 
     def calculate_outstanding_balance(self):
         total_paid = sum(
@@ -296,12 +419,47 @@ class StockAdjustment(models.Model):
         return f"{self.adjustment_type} {self.quantity} for {self.product.name}"
 
 
+class InventorySnapshot(models.Model):
+    snapshot_date = models.DateField(unique=True)
+    product_count = models.PositiveIntegerField(default=0)
+    total_units = models.PositiveBigIntegerField(default=0)
+    total_cost_value = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    total_retail_value = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-snapshot_date']
+
+    def __str__(self):
+        return f"Inventory on {self.snapshot_date}"
+
+
+class InventorySnapshotItem(models.Model):
+    snapshot = models.ForeignKey(InventorySnapshot, on_delete=models.CASCADE, related_name='items')
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='inventory_snapshots')
+    # Copied from the snapshot so per-product history is a single index range scan
+    snapshot_date = models.DateField()
+    stock = models.PositiveIntegerField()
+    price = models.DecimalField(max_digits=10, decimal_places=2)
+    cost_price = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
+    cost_value = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    retail_value = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        unique_together = [['snapshot', 'product']]
+        indexes = [models.Index(fields=['product', 'snapshot_date'])]
+
+    def __str__(self):
+        return f"{self.stock} x {self.product_id} on {self.snapshot_date}"
+
+
 class Supplier(models.Model):
     name = models.CharField(max_length=100)
     contact_person = models.CharField(max_length=100, blank=True)
     phone = models.CharField(max_length=20, blank=True)
     email = models.EmailField(blank=True)
     address = models.TextField(blank=True)
+    lead_time_days = models.PositiveIntegerField(null=True, blank=True, help_text='Typical days from placing an order to receiving it')
 
     def __str__(self):
         return self.name
@@ -310,6 +468,7 @@ class Supplier(models.Model):
 class Consignment(models.Model):
     reference_number = models.CharField(max_length=100, unique=True)
     supplier = models.ForeignKey(Supplier, on_delete=models.SET_NULL, null=True, blank=True)
+    date_ordered = models.DateField(null=True, blank=True)
     date_received = models.DateField()
     freight_cost = models.DecimalField(max_digits=10, decimal_places=2, default=0)
     customs_tax = models.DecimalField(max_digits=10, decimal_places=2, default=0)
@@ -348,6 +507,22 @@ class ConsignmentItem(models.Model):
         return self.quantity * self.cost_per_unit
 
 
+class ProductVelocity(models.Model):
+    product = models.OneToOneField(Product, on_delete=models.CASCADE, primary_key=True, related_name='velocity')
+    units_sold = models.PositiveIntegerField(default=0, help_text='Units sold in the rolling window')
+    window_days = models.PositiveIntegerField()
+    daily_velocity = models.DecimalField(max_digits=10, decimal_places=3, default=0)
+    lead_time_days = models.PositiveIntegerField()
+    reorder_point = models.PositiveIntegerField(default=0)
+    computed_at = models.DateTimeField()
+
+    class Meta:
+        verbose_name_plural = "Product velocities"
+
+    def __str__(self):
+        return f"{self.product_id}: {self.daily_velocity}/day"
+
+
 EXPENSE_CATEGORIES = [
     ('transport', 'Transport'),
     ('salaries', 'Salaries'),
@@ -431,6 +606,191 @@ class Notification(models.Model):
 
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['user', 'is_read', 'created_at']),
+            models.Index(fields=['-created_at', '-id']),
+        ]
 
     def __str__(self):
         return f"{self.notification_type} - {self.created_at}"
+
+
+class NotificationArchive(models.Model):
+    original_id = models.BigIntegerField(unique=True)
+    notification_type = models.CharField(max_length=20, choices=Notification.TYPES)
+    message = models.TextField()
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE,
+        null=True, blank=True, related_name='archived_notifications'
+    )
+    order = models.ForeignKey(
+        Order, on_delete=models.SET_NULL,
+        null=True, blank=True, related_name='archived_notifications'
+    )
+    is_read = models.BooleanField(default=True)
+    created_at = models.DateTimeField()
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"{self.notification_type} - {self.created_at} (archived)"
+
+
+class EmailOutbox(models.Model):
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('sent', 'Sent'),
+        ('failed', 'Failed'),
+    ]
+    to_email = models.EmailField()
+    subject = models.CharField(max_length=255)
+    body_text = models.TextField()
+    body_html = models.TextField(blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+    attempts = models.PositiveIntegerField(default=0)
+    # Earliest time a worker may (re)try this message; also acts as the claim lease
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['created_at']
+        indexes = [models.Index(fields=['status', 'next_attempt_at'])]
+
+    def __str__(self):
+        return f"{self.status}: {self.subject} -> {self.to_email}"
+
+
+class EmailDigestItem(models.Model):
+    # A notification email held back for a customer who prefers digests
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='email_digest_items')
+    order = models.ForeignKey(Order, on_delete=models.SET_NULL, null=True, blank=True)
+    subject = models.CharField(max_length=255)
+    message = models.TextField()
+    site_url = models.CharField(max_length=200)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['created_at']
+        indexes = [models.Index(fields=['user', 'created_at'])]
+
+    def __str__(self):
+        return f"{self.subject} -> {self.user}"
+
+
+class MpesaCallback(models.Model):
+    # Append-only log of raw Daraja callbacks; matching to orders happens in a background job
+    KIND_CHOICES = [
+        ('stk', 'STK Push'),
+        ('c2b', 'C2B Confirmation'),
+    ]
+    kind = models.CharField(max_length=3, choices=KIND_CHOICES)
+    payload = models.JSONField()
+    receipt_number = models.CharField(max_length=20, blank=True, db_index=True)
+    amount = models.DecimalField(max_digits=10, decimal_places=2, null=True, blank=True)
+    phone_number = models.CharField(max_length=20, blank=True)
+    account_reference = models.CharField(max_length=50, blank=True)
+    result_code = models.IntegerField(default=0)
+    received_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-received_at']
+
+    def __str__(self):
+        return f"{self.get_kind_display()} {self.receipt_number or '(failed)'} KSh {self.amount}"
+
+
+class BackgroundJob(models.Model):
+    # Dotted path to a function decorated with ecommerce.jobs.background_job
+    name = models.CharField(max_length=200)
+    args = models.JSONField(default=list)
+    kwargs = models.JSONField(default=dict)
+    attempts = models.PositiveIntegerField(default=0)
+    # Earliest time a worker may (re)run this job; also acts as the claim lease
+    run_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['run_at']
+        indexes = [models.Index(fields=['run_at']), models.Index(fields=['name', 'attempts'])]
+
+    def __str__(self):
+        return f"{self.name}{tuple(self.args)}"
+
+
+class DeadJob(models.Model):
+    name = models.CharField(max_length=200)
+    args = models.JSONField(default=list)
+    kwargs = models.JSONField(default=dict)
+    attempts = models.PositiveIntegerField()
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField()
+    failed_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-failed_at']
+
+    def __str__(self):
+        return f"{self.name}{tuple(self.args)} (dead)"
+
+
+class SyncTombstone(models.Model):
+    # Records deletes of synced rows so /api/sync/ clients can drop them
+    resource = models.CharField(max_length=20)
+    object_id = models.PositiveBigIntegerField()
+    # Owner of customer-scoped rows, kept as a plain id since the customer may be deleted too
+    customer_id = models.PositiveBigIntegerField(null=True, blank=True)
+    deleted_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['resource', 'id'])]
+
+    def __str__(self):
+        return f"{self.resource} #{self.object_id} deleted"
+
+
+class ApiRateLimit(models.Model):
+    # Gives one API user (usually an integration's token) its own limit for a
+    # throttle scope, or for every scope when scope is blank
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='api_rate_limits')
+    scope = models.CharField(max_length=20, blank=True, help_text='Throttle scope, e.g. catalog or payments; blank for all')
+    rate = models.CharField(max_length=20, help_text='Requests per period, e.g. 5000/hour or 20/second')
+
+    class Meta:
+        unique_together = [['user', 'scope']]
+
+    def clean(self):
+        from .throttling import THROTTLE_SCOPES, parse_rate
+        if self.scope and self.scope not in THROTTLE_SCOPES:
+            raise ValidationError({'scope': f"Unknown scope; use one of {', '.join(THROTTLE_SCOPES)}."})
+        try:
+            parse_rate(self.rate)
+        except (ValueError, KeyError, IndexError):
+            raise ValidationError({'rate': 'Use the form <requests>/<second|minute|hour|day>.'})
+
+    def __str__(self):
+        return f"{self.user} {self.scope or 'all scopes'}: {self.rate}"
+
+
+class IdempotencyKey(models.Model):
+    # First response to a POST sent with an Idempotency-Key, replayed to retries
+    # of the same request (see ecommerce.idempotency). status_code stays empty
+    # while the first request is still running.
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    key = models.CharField(max_length=255)
+    fingerprint = models.CharField(max_length=64)
+    status_code = models.PositiveSmallIntegerField(null=True, blank=True)
+    content_type = models.CharField(max_length=100, blank=True)
+    location = models.CharField(max_length=500, blank=True)
+    body = models.BinaryField(blank=True, default=b'')
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        unique_together = [['user', 'key']]
+
+    def __str__(self):
+        return f"{self.user_id}:{self.key}"
@@ -0,0 +1,149 @@
+import logging
+from decimal import Decimal, InvalidOperation
+
+from django.db import transaction
+from django.utils import timezone
+
+from .jobs import background_job
+from .models import MpesaCallback, Order, Payment
+from .notifications_util import NotificationDispatcher
+
+logger = logging.getLogger(__name__)
+
+
+class InvalidCallback(ValueError):
+    pass
+
+
+def _decimal(value):
+    try:
+        return Decimal(str(value))
+    except (InvalidOperation, TypeError):
+        return None
+
+
+def parse_callback(payload):
+    # Daraja sends STK results wrapped in Body.stkCallback and C2B confirmations as a flat object
+    if not isinstance(payload, dict):
+        raise InvalidCallback('Callback body must be a JSON object')
+    body = payload.get('Body')
+    stk = body.get('stkCallback') if isinstance(body, dict) else None
+    if stk is not None:
+        if not isinstance(stk, dict):
+            raise InvalidCallback('stkCallback must be an object')
+        metadata = stk.get('CallbackMetadata', {})
+        if not isinstance(metadata, dict) or not isinstance(metadata.get('Item', []), list):
+            raise InvalidCallback('CallbackMetadata must be an object with an Item list')
+        try:
+            result_code = int(stk.get('ResultCode', -1))
+        except (TypeError, ValueError):
+            raise InvalidCallback('ResultCode must be a number')
+        items = {
+            item.get('Name'): item.get('Value')
+            for item in metadata.get('Item', [])
+            if isinstance(item, dict)
+        }
+        return {
+            'kind': 'stk',
+            'result_code': result_code,
+            'receipt_number': str(items.get('MpesaReceiptNumber') or ''),
+            'amount': _decimal(items.get('Amount')),
+            'phone_number': str(items.get('PhoneNumber') or ''),
+            'account_reference': str(items.get('AccountReference') or ''),
+        }
+    if 'TransID' in payload:
+        return {
+            'kind': 'c2b',
+            'result_code': 0,
+            'receipt_number': str(payload['TransID']),
+            'amount': _decimal(payload.get('TransAmount')),
+            'phone_number': str(payload.get('MSISDN') or ''),
+            'account_reference': str(payload.get('BillRefNumber') or ''),
+        }
+    raise InvalidCallback('Not an STK or C2B callback')
+
+
+@transaction.atomic
+def record_callback(payload):
+    fields = parse_callback(payload)
+    callback = MpesaCallback.objects.create(payload=payload, **fields)
+    if callback.result_code == 0 and callback.receipt_number:
+        reconcile_mpesa_receipt.delay(callback.receipt_number)
+    return callback
+
+
+def _order_for(callback):
+    orders = Order.objects.select_for_update().filter(payment_type='mpesa')
+    # The code the customer typed at checkout, else an account reference of the order number
+    match = orders.filter(mpesa_code__iexact=callback.receipt_number).first()
+    if match is None and callback.account_reference.isdigit():
+        match = orders.filter(pk=int(callback.account_reference)).first()
+    return match
+
+
+@background_job
+def reconcile_mpesa_receipt(receipt_number):
+    # Safe to run any number of times per receipt: the receipt is unique on Payment
+    # Customers type the code by hand, so match it case-insensitively
+    callback = MpesaCallback.objects.filter(
+        receipt_number__iexact=receipt_number, result_code=0,
+    ).order_by('received_at').first()
+    if callback is None or callback.amount is None:
+        return
+    receipt_number = callback.receipt_number
+    if Payment.objects.filter(mpesa_receipt=receipt_number).exists():
+        return
+    order = _order_for(callback)
+    if order is None:
+        # Kept in the log; re-run when a checkout quotes this code
+        logger.info('M-Pesa receipt %s has no matching order yet', receipt_number)
+        return
+
+    notifications = NotificationDispatcher()
+    if order.status in ('rejected', 'cancelled'):
+        notifications.notify_staff(
+            'payment_received',
+            f"M-Pesa payment {receipt_number} of KSh {callback.amount} received for "
+            f"{order.get_status_display().lower()} order #{order.id}. Refund or reassign it manually.",
+            order=order,
+        )
+        return
+
+    outstanding = order.get_total_amount() - order.get_total_paid()
+    if callback.amount != outstanding:
+        # A code quoted against the wrong order, a short payment or a second payment
+        # for a paid order: leave it for staff rather than guess
+        notifications.notify_staff(
+            'payment_received',
+            f"M-Pesa payment {receipt_number} of KSh {callback.amount} does not match the KSh {outstanding} "
+            f"due on order #{order.id}. Reconcile it manually.",
+            order=order,
+        )
+        return
+    amount = callback.amount
+    Payment.objects.create(
+        order=order,
+        amount=amount,
+        payment_method='mpesa',
+        status='completed',
+        mpesa_receipt=receipt_number,
+        notes=f"Confirmed from M-Pesa callback ({callback.phone_number})",
+    )
+
+    if order.status == 'pending_payment':
+        order.status = 'pending'
+        order.payment_status = 'paid'
+        order.confirmed_at = timezone.now()
+        order.admin_note = f"Payment confirmed automatically from M-Pesa {receipt_number}"
+        order.save()
+    notifications.notify_staff(
+        'payment_received',
+        f"M-Pesa payment {receipt_number} confirmed for order #{order.id} "
+        f"from {order.customer.user.username}. KSh {amount} received.",
+        order=order,
+    )
+    notifications.notify(
+        order.customer.user, 'payment_received',
+        f"Payment confirmed for your order #{order.id} via M-Pesa. KSh {amount} received.",
+        order=order,
+    )
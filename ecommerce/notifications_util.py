@@ -1,26 +1,175 @@
-from django.core.mail import send_mail
+from collections import Counter
+from datetime import timedelta
+
 from django.conf import settings
-from django.template.loader import render_to_string
+from django.core.cache import cache
+from django.db import transaction
+from django.template.loader import get_template
+from django.utils import timezone
 
+from .email_outbox import enqueue_email
+from .jobs import background_job
+from .models import Customer, EmailDigestItem, Notification, NotificationArchive
+from .realtime import notification_payload, publish_staff_event
 
-def send_notification_email(user, subject, message, order=None, request=None):
-    if not user.email:
+
+def _unread_key(user_id):
+    return f'notifications:unread:{user_id}'
+
+
+def _unread_timeout():
+    return getattr(settings, 'UNREAD_COUNT_CACHE_SECONDS', 30)
+
+
+def get_unread_count(user_id):
+    count = cache.get(_unread_key(user_id))
+    if count is None:
+        count = Notification.objects.filter(user_id=user_id, is_read=False).count()
+        cache.set(_unread_key(user_id), count, _unread_timeout())
+    return count
+
+
+def adjust_unread_count(user_id, delta):
+    # Only adjusts a cached counter; a missing key is recounted on next read
+    try:
+        count = cache.incr(_unread_key(user_id), delta)
+    except ValueError:
         return
-    scheme = request.scheme if request else 'https'
-    host = request.get_host() if request else 'localhost:8000'
-    context = {
+    if count < 0:
+        cache.delete(_unread_key(user_id))
+
+
+def reset_unread_count(user_id, count=None):
+    if count is None:
+        cache.delete(_unread_key(user_id))
+    else:
+        cache.set(_unread_key(user_id), count, _unread_timeout())
+
+
+def _wants_digest(user):
+    try:
+        return user.customer.email_digest and settings.EMAIL_DIGEST_WINDOW_MINUTES > 0
+    except Customer.DoesNotExist:
+        return False
+
+
+def render_notification_email(user, message, order=None, site_url='', order_total=None):
+    if order is not None and order_total is None:
+        order_total = order.get_total_amount()
+    return get_template('ecommerce/email_notification.html').render({
         'user': user,
         'message': message,
         'order': order,
-        'scheme': scheme,
-        'host': host,
-    }
-    html_message = render_to_string('ecommerce/email_notification.html', context)
-    send_mail(
-        subject=subject,
-        message=message,
-        from_email=settings.DEFAULT_FROM_EMAIL,
-        recipient_list=[user.email],
-        html_message=html_message,
-        fail_silently=True,
-    )
+        'order_total': order_total,
+        'site_url': site_url,
+    })
+
+
+def send_notification_email(user, subject, message, order=None, request=None, order_total=None):
+    if not user.email:
+        return
+    site_url = f"{request.scheme}://{request.get_host()}" if request else 'https://localhost:8000'
+    if _wants_digest(user):
+        with transaction.atomic():
+            # Serialises with send_email_digest, so an item is either in the digest
+            # being sent or finds the window empty and schedules the next one
+            _lock_digest(user.pk)
+            first_in_window = not EmailDigestItem.objects.filter(user=user).exists()
+            EmailDigestItem.objects.create(user=user, order=order, subject=subject, message=message, site_url=site_url)
+            if first_in_window:
+                _schedule_digest(user.pk)
+        return
+    html_message = render_notification_email(user, message, order, site_url, order_total)
+    # Queued for the worker; never talks to SMTP in the request
+    enqueue_email(user.email, subject, message, html_message)
+
+
+def _lock_digest(user_id):
+    list(Customer.objects.select_for_update().filter(user_id=user_id).values_list('pk'))
+
+
+def _schedule_digest(user_id):
+    send_email_digest.schedule(timezone.now() + timedelta(minutes=settings.EMAIL_DIGEST_WINDOW_MINUTES), user_id)
+
+
+@background_job
+def send_email_digest(user_id):
+    _lock_digest(user_id)
+    items = list(EmailDigestItem.objects.filter(user_id=user_id).select_related('user', 'order'))
+    if not items:
+        return
+    user = items[0].user
+    if user.email:
+        if len(items) == 1:
+            item = items[0]
+            subject, text = item.subject, item.message
+            html = render_notification_email(user, item.message, item.order, item.site_url)
+        else:
+            subject = f"{len(items)} updates on your orders - H&I Store"
+            text = "\n\n".join(f"{timezone.localtime(item.created_at):%b %d, %H:%M} - {item.message}" for item in items)
+            html = get_template('ecommerce/email_digest.html').render({
+                'user': user, 'items': items, 'site_url': items[-1].site_url,
+            })
+        enqueue_email(user.email, subject, text, html)
+    EmailDigestItem.objects.filter(pk__in=[item.pk for item in items]).delete()
+    # Items written without the lock (admin, shell) would otherwise wait for a
+    # notification that starts a new window
+    if EmailDigestItem.objects.filter(user_id=user_id).exists():
+        _schedule_digest(user_id)
+
+
+# Collects the notifications a view produces and writes them with one INSERT once
+# its transaction commits. Create one per request; a rollback simply drops it.
+class NotificationDispatcher:
+    def __init__(self):
+        self._pending = []
+
+    def notify(self, user, notification_type, message, order=None):
+        self._pending.append(Notification(user=user, notification_type=notification_type, message=message, order=order))
+        # Outside a transaction on_commit runs immediately, so register after queueing
+        if len(self._pending) == 1:
+            transaction.on_commit(self.flush)
+
+    def notify_staff(self, notification_type, message, order=None):
+        # Staff share notifications without a user, so a broadcast is a single row
+        # no matter how many staff accounts exist
+        self.notify(None, notification_type, message, order=order)
+
+    def flush(self):
+        pending, self._pending = self._pending, []
+        if pending:
+            announce_notifications(Notification.objects.bulk_create(pending))
+
+
+def notify_staff(notification_type, message, order=None):
+    # Broadcasts raised outside a view's dispatcher, e.g. low stock alerts
+    NotificationDispatcher().notify_staff(notification_type, message, order=order)
+
+
+def announce_notifications(notifications):
+    # bulk_create skips post_save, so do what the Notification signals would have done
+    for user_id, count in Counter(n.user_id for n in notifications if n.user_id and not n.is_read).items():
+        adjust_unread_count(user_id, count)
+    for notification in notifications:
+        publish_staff_event('notification', notification_payload(notification))
+
+
+def archive_read_notifications(days, batch_size=1000):
+    cutoff = timezone.now() - timedelta(days=days)
+    fields = ['notification_type', 'message', 'user_id', 'order_id', 'is_read', 'created_at']
+    archived = 0
+    while True:
+        with transaction.atomic():
+            rows = list(
+                Notification.objects.filter(is_read=True, created_at__lt=cutoff)
+                .order_by('id').values('id', *fields)[:batch_size]
+            )
+            if not rows:
+                break
+            NotificationArchive.objects.bulk_create(
+                [NotificationArchive(original_id=row['id'], **{f: row[f] for f in fields}) for row in rows],
+                ignore_conflicts=True,
+            )
+            Notification.objects.filter(id__in=[row['id'] for row in rows]).delete()
+        archived += len(rows)
+    return archived
@@ -0,0 +1,133 @@
+import csv
+import gzip
+import hashlib
+import io
+import json
+from urllib.parse import urljoin
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.urls import reverse
+
+from .jobs import background_job
+from .models import Product, ProductFeedFile, ProductFeedRow
+
+# Google Merchant / marketplace attribute names. Cost prices and stock levels stay out.
+FEED_COLUMNS = (
+    'id', 'title', 'description', 'link', 'image_link', 'additional_image_link',
+    'availability', 'price', 'brand', 'product_type', 'mpn', 'condition', 'updated_at',
+)
+
+
+# Published as /api/feeds/products.<format>
+FEED_FORMATS = {'jsonl': 'application/x-ndjson', 'csv': 'text/csv'}
+
+# Product columns the feed reads; saves that change none of these (nor whether the
+# product is in stock) leave the feed alone, so checkouts don't rebuild it
+FEED_PRODUCT_FIELDS = ('name', 'description', 'price', 'sku', 'category_id', 'brand_id')
+_MISSING = object()
+
+
+def feed_state(product):
+    values = product.__dict__
+    stock = values.get('stock')
+    return tuple(values.get(field, _MISSING) for field in FEED_PRODUCT_FIELDS) + (None if stock is None else stock > 0,)
+
+
+def cache_key(name):
+    return f'product-feed:{name}'
+
+
+def _absolute(url):
+    return urljoin(getattr(settings, 'PRODUCT_FEED_BASE_URL', ''), url)
+
+
+def feed_row(product):
+    images = [_absolute(image.image.url) for image in product.images.all() if image.image]
+    return {
+        'id': str(product.pk),
+        'title': product.name,
+        'description': product.description or product.name,
+        'link': _absolute(reverse('product_detail', args=[product.pk])),
+        'image_link': images[0] if images else '',
+        'additional_image_link': images[1:],
+        'availability': 'in_stock' if product.stock > 0 else 'out_of_stock',
+        'price': f"{product.price} {getattr(settings, 'PRODUCT_FEED_CURRENCY', 'KES')}",
+        'brand': product.brand.name if product.brand else '',
+        'product_type': product.category.name if product.category else '',
+        'mpn': product.sku or '',
+        'condition': 'new',
+        'updated_at': product.updated_at.isoformat(),
+    }
+
+
+def _csv_line(row):
+    out = io.StringIO()
+    csv.writer(out).writerow([
+        ','.join(row[column]) if isinstance(row[column], list) else row[column] for column in FEED_COLUMNS
+    ])
+    return out.getvalue()
+
+
+def build_feed_rows(product_ids=None, batch_size=500):
+    # None rebuilds every row; deleted products lose theirs through the cascade
+    products = Product.objects.select_related('category', 'brand').prefetch_related('images').order_by('pk')
+    if product_ids is not None:
+        products = products.filter(pk__in=product_ids)
+    count = 0
+    for start in range(0, products.count(), batch_size):
+        rows = []
+        for product in products[start:start + batch_size]:
+            row = feed_row(product)
+            rows.append(ProductFeedRow(
+                product=product, json_line=json.dumps(row, ensure_ascii=False), csv_line=_csv_line(row),
+            ))
+        ProductFeedRow.objects.bulk_create(
+            rows, update_conflicts=True, unique_fields=['product'], update_fields=['json_line', 'csv_line', 'updated_at'],
+        )
+        count += len(rows)
+    return count
+
+
+def publish_feed():
+    # Concatenates the prebuilt rows into one gzipped file per format. Stored in
+    # ProductFeedFile and the cache, where product_feed_view serves it from.
+    header = io.StringIO()
+    csv.writer(header).writerow(FEED_COLUMNS)
+    jsonl, csv_lines = [], [header.getvalue()]
+    for json_line, csv_line in ProductFeedRow.objects.order_by('product_id').values_list('json_line', 'csv_line').iterator():
+        jsonl.append(json_line + '\n')
+        csv_lines.append(csv_line)
+    for fmt, text in (('jsonl', ''.join(jsonl)), ('csv', ''.join(csv_lines))):
+        name = f'products.{fmt}'
+        content = gzip.compress(text.encode(), mtime=0)
+        etag = hashlib.sha256(content).hexdigest()[:32]
+        feed_file, _ = ProductFeedFile.objects.update_or_create(name=name, defaults={'content': content, 'etag': etag})
+        entry = (content, etag, feed_file.updated_at)
+        transaction.on_commit(lambda name=name, entry=entry: cache.set(cache_key(name), entry, None))
+    return len(jsonl)
+
+
+def published_feed(name):
+    # (gzipped content, etag, updated_at), or None before the first publish
+    entry = cache.get(cache_key(name))
+    if entry is None:
+        feed_file = ProductFeedFile.objects.filter(name=name).first()
+        if feed_file is None:
+            return None
+        entry = (bytes(feed_file.content), feed_file.etag, feed_file.updated_at)
+        cache.set(cache_key(name), entry, None)
+    return entry
+
+
+@background_job
+def refresh_product_feed(product_ids=None):
+    build_feed_rows(product_ids)
+    # Identical pending jobs are coalesced, so a burst of product edits publishes once or twice
+    publish_product_feed.delay()
+
+
+@background_job
+def publish_product_feed():
+    publish_feed()
@@ -0,0 +1,161 @@
+import json
+import logging
+import re
+import time
+from collections import Counter
+from contextlib import ExitStack
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.cache.backends.redis import RedisCache
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.template.backends.django import DjangoTemplates
+
+logger = logging.getLogger('ecommerce.profiling')
+
+_current = ContextVar('ecommerce_request_profile', default=None)
+_MISSING = object()
+_IN_LIST = re.compile(r'IN \((?:%s, )*%s\)')
+
+
+class RequestProfile:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.db_queries = 0
+        self.db_seconds = 0.0
+        self.template_seconds = 0.0
+        self.template_depth = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.sql_shapes = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        # connection.execute_wrapper hook
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_seconds += time.perf_counter() - start
+            self.db_queries += 1
+            # Parameters are already placeholders; also fold IN lists of any length together
+            self.sql_shapes[_IN_LIST.sub('IN (...)', sql)] += 1
+
+    def repeated_queries(self, threshold):
+        return [(sql, count) for sql, count in self.sql_shapes.most_common() if count >= threshold]
+
+
+class ProfiledTemplate:
+    def __init__(self, template):
+        self._wrapped = template
+
+    def __getattr__(self, name):
+        # origin, template and the rest read through to the backend's template
+        return getattr(self._wrapped, name)
+
+    def render(self, context=None, request=None):
+        profile = _current.get()
+        if profile is None:
+            return self._wrapped.render(context, request)
+        # Only the outermost render is timed so nested render_to_string calls aren't counted twice
+        profile.template_depth += 1
+        start = time.perf_counter()
+        try:
+            return self._wrapped.render(context, request)
+        finally:
+            profile.template_depth -= 1
+            if not profile.template_depth:
+                profile.template_seconds += time.perf_counter() - start
+
+
+class ProfiledDjangoTemplates(DjangoTemplates):
+    # Swapped in by settings, like the cache backends below, while REQUEST_PROFILING is on
+    def from_string(self, template_code):
+        return ProfiledTemplate(super().from_string(template_code))
+
+    def get_template(self, template_name):
+        return ProfiledTemplate(super().get_template(template_name))
+
+
+class ProfiledCacheMixin:
+    # Counts hits and misses for the current request's profile
+    def get(self, key, default=None, version=None):
+        value = super().get(key, _MISSING, version=version)
+        profile = _current.get()
+        if profile is not None:
+            if value is _MISSING:
+                profile.cache_misses += 1
+            else:
+                profile.cache_hits += 1
+        return default if value is _MISSING else value
+
+    def get_many(self, keys, version=None):
+        keys = list(keys)
+        found = super().get_many(keys, version=version)
+        profile = _current.get()
+        if profile is not None:
+            profile.cache_hits += len(found)
+            profile.cache_misses += len(keys) - len(found)
+        return found
+
+
+class ProfiledLocMemCache(ProfiledCacheMixin, LocMemCache):
+    pass
+
+
+class ProfiledRedisCache(ProfiledCacheMixin, RedisCache):
+    pass
+
+
+# One structured log line per request (wall time, SQL, templates, cache), with
+# repeated query shapes flagged as likely N+1s. Off unless REQUEST_PROFILING is set,
+# which also switches settings to the template and cache backends above; SQL is
+# counted with execute_wrapper, so nothing outside the request is touched.
+class RequestProfilingMiddleware:
+    def __init__(self, get_response):
+        if not getattr(settings, 'REQUEST_PROFILING', False):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.threshold = getattr(settings, 'PROFILING_REPEATED_QUERY_THRESHOLD', 5)
+
+    def __call__(self, request):
+        profile = RequestProfile()
+        token = _current.set(profile)
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(profile))
+                response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        self.report(request, response, profile)
+        return response
+
+    def report(self, request, response, profile):
+        total_ms = (time.perf_counter() - profile.started) * 1000
+        db_ms = profile.db_seconds * 1000
+        template_ms = profile.template_seconds * 1000
+        repeated = profile.repeated_queries(self.threshold)
+        match = getattr(request, 'resolver_match', None)
+        logger.log(logging.WARNING if repeated else logging.INFO, json.dumps({
+            'method': request.method,
+            'path': request.path,
+            'view': match.view_name if match else None,
+            'status': response.status_code,
+            'duration_ms': round(total_ms, 1),
+            'db_queries': profile.db_queries,
+            'db_ms': round(db_ms, 1),
+            'template_ms': round(template_ms, 1),
+            'cache_hits': profile.cache_hits,
+            'cache_misses': profile.cache_misses,
+            'repeated_queries': [{'sql': sql[:300], 'count': count} for sql, count in repeated],
+        }))
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_staff:
+            response['Server-Timing'] = ', '.join([
+                f'db;dur={db_ms:.1f};desc="{profile.db_queries} queries"',
+                f'tpl;dur={template_ms:.1f}',
+                f'cache;desc="{profile.cache_hits} hits {profile.cache_misses} misses"',
+                f'total;dur={total_ms:.1f}',
+            ])
@@ -0,0 +1,129 @@
+import asyncio
+import json
+import logging
+import threading
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core import signing
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.urls import reverse
+
+logger = logging.getLogger(__name__)
+
+STAFF_CHANNEL = 'ecommerce:staff-events'
+_TOKEN_SALT = 'ecommerce.staff-events'
+
+
+def format_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, cls=DjangoJSONEncoder)}\n\n"
+
+
+# Only reaches browsers connected to the same process, which is enough for a
+# single worker or local development. Set REDIS_URL to fan out across workers.
+class LocalBroker:
+    def __init__(self):
+        self._subscribers = set()
+        self._lock = threading.Lock()
+
+    def publish(self, message):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for loop, queue in subscribers:
+            try:
+                loop.call_soon_threadsafe(_offer, queue, message)
+            except RuntimeError:
+                # The subscriber's event loop already shut down
+                pass
+
+    async def listen(self, keepalive):
+        subscriber = (asyncio.get_running_loop(), asyncio.Queue(maxsize=100))
+        with self._lock:
+            self._subscribers.add(subscriber)
+        try:
+            while True:
+                try:
+                    yield await asyncio.wait_for(subscriber[1].get(), keepalive)
+                except asyncio.TimeoutError:
+                    yield None
+        finally:
+            with self._lock:
+                self._subscribers.discard(subscriber)
+
+
+def _offer(queue, message):
+    try:
+        queue.put_nowait(message)
+    except asyncio.QueueFull:
+        # A stalled tab misses events rather than buffering without bound
+        pass
+
+
+class RedisBroker:
+    def __init__(self, url):
+        import redis
+        self.url = url
+        self._client = redis.Redis.from_url(url)
+
+    def publish(self, message):
+        import redis
+        try:
+            self._client.publish(STAFF_CHANNEL, message)
+        except redis.RedisError:
+            logger.exception('Could not publish staff event')
+
+    async def listen(self, keepalive):
+        from redis import asyncio as aioredis
+        client = aioredis.Redis.from_url(self.url)
+        pubsub = client.pubsub(ignore_subscribe_messages=True)
+        await pubsub.subscribe(STAFF_CHANNEL)
+        try:
+            while True:
+                message = await pubsub.get_message(timeout=keepalive)
+                yield message['data'].decode() if message else None
+        finally:
+            await pubsub.aclose()
+            await client.aclose()
+
+
+_broker = None
+
+
+def get_broker():
+    global _broker
+    if _broker is None:
+        redis_url = getattr(settings, 'REDIS_URL', None)
+        _broker = RedisBroker(redis_url) if redis_url else LocalBroker()
+    return _broker
+
+
+def publish_staff_event(event, data):
+    # Only announce rows that actually committed
+    message = format_event(event, data)
+    transaction.on_commit(lambda: get_broker().publish(message))
+
+
+def notification_payload(notification):
+    return {
+        'id': notification.pk,
+        'type': notification.notification_type,
+        'message': notification.message,
+        'order_id': notification.order_id,
+        'user_id': notification.user_id,
+        'created_at': notification.created_at,
+    }
+
+
+def staff_events_url(user):
+    # The stream is served by the ASGI events service (start_events.sh) on its own
+    # host, which never sees the site's session cookie, so the URL carries a signed token
+    url = settings.STAFF_EVENTS_URL or reverse('staff_events')
+    return f"{url}?{urlencode({'token': signing.dumps(user.pk, salt=_TOKEN_SALT)})}"
+
+
+def staff_events_user_id(token):
+    try:
+        return signing.loads(token, salt=_TOKEN_SALT, max_age=settings.STAFF_EVENTS_TOKEN_SECONDS)
+    except signing.BadSignature:
+        return None
@@ -0,0 +1,42 @@
+from datetime import timedelta
+from decimal import Decimal
+
+from django.db.models import Count, Q, Sum
+from django.utils import timezone
+
+# (key, label, min_age_days, max_age_days) — ages are measured from the order date
+AGEING_BUCKETS = [
+    ('days_0_30', '0–30 days', 0, 30),
+    ('days_31_60', '31–60 days', 31, 60),
+    ('days_61_90', '61–90 days', 61, 90),
+    ('days_90_plus', '90+ days', 91, None),
+]
+
+
+def _bucket_aggregates(as_of):
+    aggregates = {}
+    for key, _label, min_age, max_age in AGEING_BUCKETS:
+        condition = Q(order__order_date__lt=as_of - timedelta(days=min_age)) if min_age else Q()
+        if max_age is not None:
+            condition &= Q(order__order_date__gte=as_of - timedelta(days=max_age + 1))
+        aggregates[key] = Sum('outstanding_balance', filter=condition, default=Decimal('0'))
+    aggregates['total'] = Sum('outstanding_balance', default=Decimal('0'))
+    aggregates['debt_count'] = Count('id')
+    return aggregates
+
+
+def _start_of_day(as_of):
+    # Midnight ending the as-of day, so an order placed that day is 0 days old
+    return timezone.localtime(as_of).replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+
+
+def aged_receivables_by_customer(debts, as_of=None):
+    as_of = _start_of_day(as_of or timezone.now())
+    return debts.filter(is_paid=False).values(
+        'customer_id', 'customer__user__username', 'customer__phone_number',
+    ).annotate(**_bucket_aggregates(as_of)).order_by('-total', 'customer_id')
+
+
+def aged_receivables_totals(debts, as_of=None):
+    as_of = _start_of_day(as_of or timezone.now())
+    return debts.filter(is_paid=False).aggregate(**_bucket_aggregates(as_of))
@@ -0,0 +1,90 @@
+from decimal import Decimal
+
+from django.db.models import F
+from django.utils import timezone
+from rest_framework import serializers
+from rest_framework.renderers import JSONRenderer
+from rest_framework.settings import ISO_8601, api_settings
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+_drf_default = JSONEncoder().default
+
+# Serializer fields whose output is the plain column value (give or take the
+# conversions in fast_list_plan), so a .values() row can stand in for them
+_PLAIN_FIELDS = (
+    serializers.BooleanField, serializers.CharField, serializers.ChoiceField, serializers.DateField,
+    serializers.DateTimeField, serializers.DecimalField, serializers.FloatField, serializers.IntegerField,
+    serializers.PrimaryKeyRelatedField,
+)
+
+
+class FastJSONRenderer(JSONRenderer):
+    # orjson encodes dicts, lists, datetimes and dates itself and hands anything
+    # else (Decimal, lazy strings) to DRF's encoder, so output matches JSONRenderer
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if orjson is None or data is None or self.get_indent(accepted_media_type, renderer_context or {}):
+            return super().render(data, accepted_media_type, renderer_context)
+        return orjson.dumps(data, default=_drf_default, option=orjson.OPT_UTC_Z)
+
+
+def _decimal_to_string(field):
+    def convert(value):
+        if not isinstance(value, Decimal):
+            value = Decimal(str(value))
+        return f'{field.quantize(value):f}'
+    return convert
+
+
+def fast_list_plan(serializer, sources=None):
+    # Maps each serializer field to a queryset column, with converters for the
+    # values the serializer would reformat. Returns None if any field needs a real
+    # serializer (nested blocks, files, method fields with no column in sources).
+    sources = sources or {}
+    columns, converters = {}, []
+    local_time = timezone.get_current_timezone_name() != 'UTC'
+    for name, field in serializer.fields.items():
+        if field.write_only:
+            continue
+        if name in sources:
+            columns[name] = sources[name]
+            continue
+        if not isinstance(field, _PLAIN_FIELDS) or field.source != name:
+            return None
+        columns[name] = name
+        if isinstance(field, serializers.DecimalField):
+            if field.normalize_output or field.localize:
+                return None
+            if getattr(field, 'coerce_to_string', api_settings.COERCE_DECIMAL_TO_STRING):
+                converters.append((name, _decimal_to_string(field)))
+        elif isinstance(field, serializers.DateTimeField):
+            if getattr(field, 'format', api_settings.DATETIME_FORMAT) != ISO_8601:
+                return None
+            if local_time:
+                converters.append((name, timezone.localtime))
+        elif isinstance(field, serializers.DateField):
+            if getattr(field, 'format', api_settings.DATE_FORMAT) != ISO_8601:
+                return None
+    return columns, converters
+
+
+def fast_list_values(queryset, plan, *extra):
+    columns, _ = plan
+    return queryset.values(
+        *[name for name, column in columns.items() if name == column], *extra,
+        **{name: F(column) for name, column in columns.items() if name != column},
+    )
+
+
+def convert_rows(rows, plan):
+    _, converters = plan
+    for row in rows:
+        for name, convert in converters:
+            value = row[name]
+            if value is not None:
+                row[name] = convert(value)
+    return rows
@@ -1,22 +1,72 @@
+from decimal import Decimal
+
 from rest_framework import serializers
-from .models import Customer, Product, Order, OrderItem, Payment, Debt
+from rest_framework.permissions import SAFE_METHODS
+from .models import Customer, CustomerStats, Product, Order, OrderItem, Payment, Debt
+
+
+def _param_set(value):
+    return {name.strip() for name in value.split(',') if name.strip()}
+
+
+def sparse_fieldset(request):
+    # ?fields=id,status,items picks top-level fields, nested blocks included; without it
+    # everything renders. Writes always get the full serializer so required fields
+    # can't be filtered away.
+    if request is None or request.method not in SAFE_METHODS:
+        return {'fields': None}
+    fields = request.query_params.get('fields')
+    return {'fields': _param_set(fields) if fields else None}
 
-class CustomerSerializer(serializers.ModelSerializer):
+
+class SparseFieldsMixin:
+    # Nested blocks listed here render in full unless context['nested'] names the
+    # ones to keep (paths like items or order.payments); the rest collapse to the
+    # foreign key's id, or are left out for a reverse relation
+    nested_fields = ()
+
+    def _path(self):
+        names, node = [], self
+        while node.parent is not None:
+            if node.field_name:
+                names.append(node.field_name)
+            node = node.parent
+        return '.'.join(reversed(names))
+
+    def get_fields(self):
+        fields = super().get_fields()
+        path = self._path()
+        prefix = f'{path}.' if path else ''
+        nested = self.context.get('nested')
+        for name in self.nested_fields if nested is not None else ():
+            if f'{prefix}{name}' in nested:
+                continue
+            model_field = self.Meta.model._meta.get_field(name)
+            if model_field.many_to_one:
+                fields[name] = serializers.PrimaryKeyRelatedField(read_only=True)
+            else:
+                fields.pop(name, None)
+        requested = self.context.get('fields')
+        if requested and not path:
+            fields = {name: field for name, field in fields.items() if name in requested}
+        return fields
+
+class CustomerSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = Customer
         fields = '__all__'
 
-class ProductSerializer(serializers.ModelSerializer):
+class ProductSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = Product
         fields = '__all__'
 
-class OrderItemSerializer(serializers.ModelSerializer):
+class OrderItemSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = OrderItem
         fields = '__all__'
 
-class PaymentSerializer(serializers.ModelSerializer):
+class PaymentSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     outstanding_balance = serializers.SerializerMethodField()
 
     class Meta:
@@ -24,9 +74,14 @@ class PaymentSerializer(serializers.ModelSerializer):
         fields = ['id', 'order', 'amount', 'payment_method', 'status', 'payment_date', 'notes', 'created_by', 'outstanding_balance']
 
     def get_outstanding_balance(self, obj):
+        # Annotated by PaymentViewSet, or taken from the with_totals() order this payment was prefetched under
+        if hasattr(obj, 'order_outstanding'):
+            return obj.order_outstanding
+        if hasattr(obj.order, 'outstanding_balance'):
+            return obj.order.outstanding_balance
         return obj.order.get_outstanding_balance()
 
-class OrderSerializer(serializers.ModelSerializer):
+class OrderSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     items = OrderItemSerializer(many=True, read_only=True)
     payments = PaymentSerializer(many=True, read_only=True)
     total_amount = serializers.DecimalField(max_digits=10, decimal_places=2, read_only=True)
@@ -37,18 +92,55 @@ class OrderSerializer(serializers.ModelSerializer):
         model = Order
         fields = '__all__'
 
-    def get_total_amount(self, obj):
-        return obj.get_total_amount()
+    nested_fields = ('items', 'payments')
 
-    def get_total_paid(self, obj):
-        return obj.get_total_paid()
+    def to_representation(self, instance):
+        # Totals come from Order.objects.with_totals(); orders just created or saved here aren't annotated
+        if 'outstanding_balance' in self.fields and not hasattr(instance, 'outstanding_balance'):
+            instance.total_amount = instance.get_total_amount()
+            instance.total_paid = instance.get_total_paid()
+            instance.outstanding_balance = instance.get_outstanding_balance()
+        return super().to_representation(instance)
 
-    def get_outstanding_balance(self, obj):
-        return obj.get_outstanding_balance()
-
-class DebtSerializer(serializers.ModelSerializer):
+class DebtSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     order = OrderSerializer(read_only=True)
     customer = CustomerSerializer(read_only=True)
     class Meta:
         model = Debt
-        fields = '__all__'
\ No newline at end of file
+        fields = '__all__'
+
+    nested_fields = ('order', 'customer')
+
+class BulkOrderItemRowSerializer(serializers.Serializer):
+    # Rows with an id change that item's quantity; rows without one add an item to an order
+    id = serializers.IntegerField(required=False)
+    order = serializers.IntegerField(required=False)
+    product = serializers.IntegerField(required=False)
+    quantity = serializers.IntegerField(min_value=1)
+
+    def validate(self, attrs):
+        if 'id' not in attrs:
+            missing = {name: ['This field is required.'] for name in ('order', 'product') if name not in attrs}
+            if missing:
+                raise serializers.ValidationError(missing)
+        return attrs
+
+class BulkPaymentRowSerializer(serializers.Serializer):
+    # Rows with an id edit that payment; rows without one record a new payment
+    id = serializers.IntegerField(required=False)
+    order = serializers.IntegerField(required=False)
+    amount = serializers.DecimalField(max_digits=10, decimal_places=2, min_value=Decimal('0.01'), required=False)
+    payment_method = serializers.ChoiceField(choices=Payment._meta.get_field('payment_method').choices, required=False)
+    notes = serializers.CharField(allow_blank=True, required=False)
+
+    def validate(self, attrs):
+        if 'id' not in attrs:
+            missing = {name: ['This field is required.'] for name in ('order', 'amount') if name not in attrs}
+            if missing:
+                raise serializers.ValidationError(missing)
+        return attrs
+
+class CustomerStatsSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = CustomerStats
+        fields = ['customer', 'order_count', 'lifetime_spend', 'outstanding', 'pending_count', 'last_order_date', 'updated_at']
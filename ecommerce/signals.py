@@ -1,30 +1,25 @@
 from django.db.models.signals import pre_save
-from django.db.models.signals import post_save, post_delete
+from django.db.models.signals import post_init, post_save, post_delete
 from django.utils import timezone
 from django.dispatch import receiver
-from django.core.exceptions import MultipleObjectsReturned
-from .models import OrderItem, Payment, Debt, Order
+from django.db import transaction
+from django.core.cache import cache
+from .models import OrderItem, Payment, Debt, Order, Notification, Product
+from .notifications_util import adjust_unread_count, reset_unread_count
+from .realtime import notification_payload, publish_staff_event
+from .stock_alerts import check_stock_level
+from .sync import record_tombstone
+from .customer_stats import refresh_customer_stats
+from .tasks import recalculate_debt_on_commit
+from django.core.files.storage import default_storage
 from django.contrib.auth import get_user_model
 from .models import Customer
 from .models import ProductImage
-
-
-def get_or_create_debt(order):
-    try:
-        return Debt.objects.get_or_create(
-            customer=order.customer,
-            order=order,
-            defaults={
-                'outstanding_balance': order.get_total_amount() - order.get_total_paid(),
-                'is_paid': False,
-                'paid_at': None
-            }
-        )
-    except MultipleObjectsReturned:
-        debts = Debt.objects.filter(customer=order.customer, order=order).order_by('pk')
-        debt = debts.first()
-        debts.exclude(pk=debt.pk).delete()
-        return debt, False
+from .models import ApiRateLimit
+from .models import Brand, Category
+from .product_feed import feed_state, publish_product_feed, refresh_product_feed
+from .authentication import forget_tokens
+from rest_framework.authtoken.models import Token
 
 
 @receiver(pre_save, sender=OrderItem)
@@ -33,11 +28,12 @@ def set_price_from_product(sender, instance, **kwargs):
         instance.price = instance.product.price
 
 
+# Inline, once per order after the transaction commits, so whatever reads the debt
+# next (the API response, the next page) sees the new balance
 @receiver(post_save, sender=Payment)
-def update_debt_after_payment(sender, instance, **kwargs):
-    order = instance.order
-    debt, _ = get_or_create_debt(order)
-    debt.calculate_outstanding_balance()
+@receiver(post_save, sender=OrderItem)
+def update_debt_after_commit(sender, instance, **kwargs):
+    recalculate_debt_on_commit(instance.order_id)
 
 
 @receiver(post_save, sender=Order)
@@ -52,21 +48,91 @@ def create_debt_for_order(sender, instance, created, **kwargs):
         )
 
 
+def schedule_stats_refresh(customer_id):
+    if customer_id:
+        refresh_customer_stats.delay(customer_id)
+
+
+@receiver(post_save, sender=Order)
+@receiver(post_delete, sender=Order)
+def refresh_stats_for_order(sender, instance, **kwargs):
+    schedule_stats_refresh(instance.customer_id)
+
+
 @receiver(post_save, sender=OrderItem)
-def update_debt_after_orderitem(sender, instance, **kwargs):
-    order = instance.order
-    try:
-        debt = Debt.objects.get(customer=order.customer, order=order)
-    except Debt.DoesNotExist:
-        debt = Debt.objects.create(
-            customer=order.customer, order=order,
-            outstanding_balance=0, is_paid=False, paid_at=None
-        )
-    except MultipleObjectsReturned:
-        debts = Debt.objects.filter(customer=order.customer, order=order).order_by('pk')
-        debt = debts.first()
-        debts.exclude(pk=debt.pk).delete()
-    debt.calculate_outstanding_balance()
+@receiver(post_delete, sender=OrderItem)
+@receiver(post_save, sender=Payment)
+@receiver(post_delete, sender=Payment)
+def refresh_stats_for_order_child(sender, instance, **kwargs):
+    # The parent order may already be gone during a cascade delete;
+    # its own post_delete schedules the refresh in that case.
+    customer_id = Order.objects.filter(pk=instance.order_id).values_list('customer_id', flat=True).first()
+    schedule_stats_refresh(customer_id)
+
+
+@receiver(post_save, sender=OrderItem)
+@receiver(post_delete, sender=OrderItem)
+@receiver(post_save, sender=Payment)
+@receiver(post_delete, sender=Payment)
+def touch_order_for_sync(sender, instance, **kwargs):
+    # The order's totals changed, so sync clients need to pull it again
+    Order.objects.filter(pk=instance.order_id).update(updated_at=timezone.now())
+
+
+@receiver(post_delete, sender=Product)
+@receiver(post_delete, sender=Order)
+@receiver(post_delete, sender=Payment)
+@receiver(post_delete, sender=Debt)
+def record_sync_tombstone(sender, instance, **kwargs):
+    record_tombstone(instance)
+
+
+@receiver(post_save, sender=Notification)
+def count_new_notification(sender, instance, created, **kwargs):
+    if created and instance.user_id and not instance.is_read:
+        transaction.on_commit(lambda: adjust_unread_count(instance.user_id, 1))
+
+
+@receiver(post_delete, sender=Notification)
+def forget_unread_count(sender, instance, **kwargs):
+    if instance.user_id and not instance.is_read:
+        transaction.on_commit(lambda: reset_unread_count(instance.user_id))
+
+
+@receiver(post_save, sender=Notification)
+def push_new_notification(sender, instance, created, **kwargs):
+    if created:
+        publish_staff_event('notification', notification_payload(instance))
+
+
+@receiver(post_init, sender=Order)
+def remember_order_status(sender, instance, **kwargs):
+    # Read from __dict__ so a deferred status field isn't fetched just for this
+    instance._loaded_status = instance.__dict__.get('status')
+
+
+@receiver(post_save, sender=Order)
+def push_order_status_change(sender, instance, created, **kwargs):
+    if not created and instance.status != instance._loaded_status:
+        publish_staff_event('order_status', {
+            'order_id': instance.pk,
+            'status': instance.status,
+            'previous_status': instance._loaded_status,
+        })
+    instance._loaded_status = instance.status
+
+
+@receiver(post_init, sender=Product)
+def remember_stock(sender, instance, **kwargs):
+    instance._loaded_stock = instance.__dict__.get('stock')
+
+
+@receiver(post_save, sender=Product)
+def alert_on_low_stock(sender, instance, created, **kwargs):
+    # Every stock path (order items, approvals, adjustments, admin edits) saves the product;
+    # the bulk API writes stock in one query and calls check_stock_level itself
+    check_stock_level(instance, None if created else instance._loaded_stock)
+    instance._loaded_stock = instance.stock
 
 
 User = get_user_model()
@@ -78,9 +144,71 @@ def create_customer(sender, instance, created, **kwargs):
         Customer.objects.create(user=instance)
 
 
+@receiver(post_init, sender=Product)
+def remember_feed_state(sender, instance, **kwargs):
+    instance._loaded_feed_state = feed_state(instance)
+
+
+@receiver(post_save, sender=Product)
+def refresh_product_feed_row(sender, instance, created, **kwargs):
+    # Most saves are stock changes from orders; only a change the feed shows needs a rebuild
+    state = feed_state(instance)
+    if created or state != instance._loaded_feed_state:
+        refresh_product_feed.delay([instance.pk])
+    instance._loaded_feed_state = state
+
+
+@receiver(post_save, sender=ProductImage)
+@receiver(post_delete, sender=ProductImage)
+def refresh_product_feed_images(sender, instance, **kwargs):
+    refresh_product_feed.delay([instance.product_id])
+
+
+@receiver(post_delete, sender=Product)
+def drop_product_from_feed(sender, instance, **kwargs):
+    # The feed row went with the product; the published files still list it
+    publish_product_feed.delay()
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+@receiver(post_save, sender=Brand)
+@receiver(post_delete, sender=Brand)
+def rebuild_product_feed(sender, instance, **kwargs):
+    # Renames show up in every row of the category or brand; rare enough to rebuild all
+    refresh_product_feed.delay()
+
+
 @receiver(post_delete, sender=ProductImage)
 def delete_product_image_file(sender, instance, **kwargs):
-    print("Signal fired for:", instance)
+    # Done by the web process: media lives on its local disk, which the worker can't reach
     if instance.image:
-        print("Deleting file:", instance.image.path)
-        instance.image.delete(save=False)
+        name = instance.image.name
+        transaction.on_commit(lambda: default_storage.delete(name))
+
+
+@receiver(post_save, sender=ApiRateLimit)
+@receiver(post_delete, sender=ApiRateLimit)
+def forget_rate_limits(sender, instance, **kwargs):
+    cache.delete(f'api-rate-limits:{instance.user_id}')
+
+
+@receiver(post_delete, sender=Token)
+def forget_cached_token(sender, instance, **kwargs):
+    forget_tokens([instance.key])
+
+
+@receiver(post_save, sender=User)
+def forget_cached_user_tokens(sender, instance, update_fields=None, **kwargs):
+    # Logins only touch last_login, which the token cache doesn't hold
+    if update_fields and set(update_fields) <= {'last_login'}:
+        return
+    forget_tokens(Token.objects.filter(user=instance).values_list('key', flat=True))
+
+
+@receiver(post_save, sender=Customer)
+@receiver(post_delete, sender=Customer)
+def forget_cached_customer_tokens(sender, instance, created=True, **kwargs):
+    # The cached customer id only changes when the customer is created or deleted
+    if created:
+        forget_tokens(Token.objects.filter(user_id=instance.user_id).values_list('key', flat=True))
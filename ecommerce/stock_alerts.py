@@ -0,0 +1,35 @@
+from django.core.exceptions import ObjectDoesNotExist
+from django.utils import timezone
+
+from .models import Product
+from .notifications_util import notify_staff
+from .velocity import default_low_stock_threshold
+
+
+def low_stock_threshold(product):
+    if product.low_stock_threshold is not None:
+        return product.low_stock_threshold
+    try:
+        return product.velocity.reorder_point
+    except ObjectDoesNotExist:
+        return default_low_stock_threshold()
+
+
+def check_stock_level(product, previous_stock):
+    # Called once per stock change. low_stock_alerted is flipped with a conditional
+    # UPDATE so concurrent saves raise a single alert, and it re-arms once the
+    # product is restocked above its threshold.
+    if previous_stock is None or previous_stock == product.stock:
+        return
+    threshold = low_stock_threshold(product)
+    if product.stock <= threshold:
+        if Product.objects.filter(pk=product.pk, low_stock_alerted=False).update(low_stock_alerted=True, updated_at=timezone.now()):
+            product.low_stock_alerted = True
+            notify_staff(
+                'low_stock',
+                f"Low stock: {product.name} is down to {product.stock} "
+                f"(alert level {threshold}).",
+            )
+    elif product.low_stock_alerted or previous_stock <= threshold:
+        Product.objects.filter(pk=product.pk, low_stock_alerted=True).update(low_stock_alerted=False, updated_at=timezone.now())
+        product.low_stock_alerted = False
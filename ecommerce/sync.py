@@ -0,0 +1,134 @@
+import base64
+import json
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db.models import Max, Q
+from django.utils import timezone
+
+from .models import Customer, Debt, Order, Payment, Product, SyncTombstone
+from .serializers import DebtSerializer, OrderSerializer, PaymentSerializer, ProductSerializer
+
+# resource -> (model, serializer, lookup from the model to its Customer, or None if public)
+SYNC_RESOURCES = {
+    'products': (Product, ProductSerializer, None),
+    'orders': (Order, OrderSerializer, 'customer'),
+    'payments': (Payment, PaymentSerializer, 'order__customer'),
+    'debts': (Debt, DebtSerializer, 'customer'),
+}
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+class CursorExpired(Exception):
+    pass
+
+
+def sync_resource_name(model):
+    for resource, (resource_model, _, _) in SYNC_RESOURCES.items():
+        if resource_model is model:
+            return resource
+    return None
+
+
+def encode_sync_cursor(updated_at, pk, tombstone_id, issued_at):
+    raw = json.dumps({
+        'u': updated_at.isoformat() if updated_at else None,
+        'p': pk,
+        't': tombstone_id,
+        'i': issued_at.isoformat(),
+    }, separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_sync_cursor(cursor):
+    try:
+        raw = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        updated_at = datetime.fromisoformat(raw['u']) if raw['u'] else None
+        return updated_at, int(raw['p']), int(raw['t']), datetime.fromisoformat(raw['i'])
+    except (ValueError, TypeError, KeyError):
+        raise InvalidCursor(cursor)
+
+
+def sync_queryset(resource, user):
+    model, _, customer_lookup = SYNC_RESOURCES[resource]
+    if model is Order:
+        rows = Order.objects.with_totals()
+    elif model is Payment:
+        rows = Payment.objects.with_order_outstanding()
+    else:
+        rows = model.objects.all()
+    if customer_lookup and not user.is_staff:
+        rows = rows.filter(**{f'{customer_lookup}__user': user})
+    return rows
+
+
+def changes_since(resource, user, cursor=None, limit=None):
+    # Rows are walked in (updated_at, pk) order and deletes in tombstone id order.
+    # Neither is commit order: updated_at is stamped at save() and ids are drawn
+    # when inserted, so a transaction that commits after a later-stamped one could
+    # land behind a client's cursor. Only changes older than SYNC_SETTLE_SECONDS
+    # are served, which is safe as long as no transaction writing synced rows stays
+    # open longer than that. Requests and worker jobs are far shorter; after a
+    # long-running script rewrites synced rows, clients should do a full sync.
+    limit = limit or getattr(settings, 'SYNC_PAGE_SIZE', 200)
+    now = timezone.now()
+    settled = now - timedelta(seconds=getattr(settings, 'SYNC_SETTLE_SECONDS', 60))
+    rows = sync_queryset(resource, user).filter(updated_at__lte=settled)
+    tombstones = SyncTombstone.objects.filter(resource=resource, deleted_at__lte=settled)
+    if not user.is_staff and SYNC_RESOURCES[resource][2]:
+        if hasattr(user, 'api_customer_id'):
+            # set by CachedTokenAuthentication
+            tombstones = tombstones.filter(customer_id__in=[user.api_customer_id])
+        else:
+            tombstones = tombstones.filter(customer_id__in=Customer.objects.filter(user=user).values('pk'))
+
+    if cursor:
+        updated_at, pk, tombstone_id, issued_at = decode_sync_cursor(cursor)
+        retention = timedelta(days=getattr(settings, 'SYNC_TOMBSTONE_RETENTION_DAYS', 90))
+        if issued_at < now - retention:
+            # Deletes older than this may have been pruned; the client must start over
+            raise CursorExpired(cursor)
+        if updated_at is not None:
+            rows = rows.filter(Q(updated_at__gt=updated_at) | Q(updated_at=updated_at, pk__gt=pk))
+        tombstones = tombstones.filter(pk__gt=tombstone_id)
+        deleted = list(tombstones.order_by('pk').values_list('pk', 'object_id')[:limit + 1])
+    else:
+        # A first sync downloads every live row, so only deletes from now on matter
+        updated_at, pk = None, 0
+        tombstone_id = SyncTombstone.objects.aggregate(last=Max('pk'))['last'] or 0
+        deleted = []
+
+    changed = list(rows.order_by('updated_at', 'pk')[:limit + 1])
+    has_more = len(changed) > limit or len(deleted) > limit
+    changed, deleted = changed[:limit], deleted[:limit]
+    if changed:
+        updated_at, pk = changed[-1].updated_at, changed[-1].pk
+    if deleted:
+        tombstone_id = deleted[-1][0]
+    return {
+        'changed': changed,
+        'deleted': [object_id for _, object_id in deleted],
+        'cursor': encode_sync_cursor(updated_at, pk, tombstone_id, now),
+        'has_more': has_more,
+    }
+
+
+def record_tombstone(instance):
+    resource = sync_resource_name(type(instance))
+    if resource is None:
+        return
+    if isinstance(instance, Payment):
+        # During a cascade the order row may already be gone; its own tombstone covers this payment
+        customer_id = Order.objects.filter(pk=instance.order_id).values_list('customer_id', flat=True).first()
+    else:
+        customer_id = getattr(instance, 'customer_id', None)
+    SyncTombstone.objects.create(resource=resource, object_id=instance.pk, customer_id=customer_id)
+
+
+def prune_tombstones(days=None):
+    days = days if days is not None else getattr(settings, 'SYNC_TOMBSTONE_RETENTION_DAYS', 90)
+    deleted, _ = SyncTombstone.objects.filter(deleted_at__lt=timezone.now() - timedelta(days=days)).delete()
+    return deleted
@@ -0,0 +1,66 @@
+import threading
+import weakref
+
+from django.core.exceptions import MultipleObjectsReturned
+from django.core.files.storage import default_storage
+from django.db import transaction
+
+from .jobs import background_job
+from .models import Debt, Order
+
+
+def get_or_create_debt(order):
+    try:
+        return Debt.objects.get_or_create(
+            customer=order.customer,
+            order=order,
+            defaults={
+                'outstanding_balance': order.get_total_amount() - order.get_total_paid(),
+                'is_paid': False,
+                'paid_at': None
+            }
+        )
+    except MultipleObjectsReturned:
+        debts = Debt.objects.filter(customer=order.customer, order=order).order_by('pk')
+        debt = debts.first()
+        debts.exclude(pk=debt.pk).delete()
+        return debt, False
+
+
+@background_job
+def recalculate_order_debt(order_id):
+    order = Order.objects.filter(pk=order_id).select_related('customer').first()
+    if order is None:
+        return
+    debt, _ = get_or_create_debt(order)
+    debt.calculate_outstanding_balance()
+
+
+# Not enqueued while media lives on the web service's own disk (see
+# delete_product_image_file); kept so jobs already queued still drain
+@background_job
+def delete_stored_file(name):
+    if name and default_storage.exists(name):
+        default_storage.delete(name)
+
+
+_pending_debts = threading.local()
+
+
+def recalculate_debt_on_commit(order_id):
+    # Every payment and item saved in one transaction shares a single recalculation
+    # per order, run inline as soon as it commits. The callback is only held weakly
+    # here: on rollback Django drops it, and the next save starts a new batch.
+    batch = getattr(_pending_debts, 'batch', None)
+    if batch is not None and batch[1]() is not None:
+        batch[0].add(order_id)
+        return
+    order_ids = {order_id}
+
+    def recalculate():
+        _pending_debts.batch = None
+        for pk in sorted(order_ids):
+            recalculate_order_debt(pk)
+
+    _pending_debts.batch = (order_ids, weakref.ref(recalculate))
+    transaction.on_commit(recalculate)
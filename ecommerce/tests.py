@@ -1,3 +1,1095 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import json
+import os
+import tempfile
+import threading
+from datetime import date, timedelta
+from decimal import Decimal
+from io import StringIO
+from unittest.mock import patch
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.cache import cache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.db.models.signals import post_delete
+from django.template.backends.django import Template as BackendTemplate
+from django.test import AsyncClient, Client, RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.settings import api_settings
+from rest_framework.test import APIClient, APIRequestFactory
+
+from .customer_stats import get_customer_stats, rebuild_all_customer_stats
+from .db_routers import ReportingRouter, _lag_checks, pinned_to_reporting
+from .email_outbox import claim_batch, drain_outbox, enqueue_email
+from .fake_daraja import c2b_confirmation, stk_callback
+from .idempotency import fingerprint
+from .inventory import take_inventory_snapshot
+from .jobs import claim_jobs, enqueue, requeue_dead_jobs, run_pending_jobs
+from .models import (
+    ApiRateLimit, BackgroundJob, Cart, CartItem, Consignment, ConsignmentItem, Customer, CustomerStats, DeadJob, Debt,
+    EmailDigestItem, EmailOutbox, IdempotencyKey, Notification, NotificationArchive, Order, OrderItem, Payment, Product,
+    ProductImage, ProductVelocity, Supplier,
+)
+from .notifications_util import NotificationDispatcher, archive_read_notifications, get_unread_count, send_notification_email
+from .pagination import keyset_page
+from .realtime import LocalBroker, format_event, publish_staff_event, staff_events_url
+from .receivables import aged_receivables_by_customer, aged_receivables_totals
+from .velocity import low_stock_products, refresh_sales_velocity
+from .product_feed import build_feed_rows, publish_feed
+from .profiling import RequestProfile
+from .renderers import convert_rows
+
+
+class ApiQueryCountTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user('staff', password='x', is_staff=True))
+        self.customer, _ = Customer.objects.get_or_create(user=User.objects.create_user('buyer', password='x'))
+        self.product = Product.objects.create(name='Soap', price=Decimal('50'), stock=1000)
+
+    def add_orders(self, count):
+        for _ in range(count):
+            order = Order.objects.create(customer=self.customer, status='processing')
+            OrderItem.objects.create(order=order, product=self.product, quantity=2, price=Decimal('50'))
+            OrderItem.objects.create(order=order, product=self.product, quantity=1, price=Decimal('50'))
+            Payment.objects.create(order=order, amount=Decimal('40'), status='completed')
+            Debt.objects.update_or_create(
+                order=order, defaults={'customer': self.customer, 'outstanding_balance': Decimal('110')},
+            )
+
+    def query_count(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries), response.json()['results']
+
+    def assert_constant_queries(self, url):
+        self.add_orders(2)
+        # Warm the throttle's cached rate overrides so both counts are steady-state
+        self.client.get(url)
+        few, body = self.query_count(url)
+        self.add_orders(5)
+        many, body = self.query_count(url)
+        self.assertEqual(len(body), 7)
+        self.assertEqual(few, many)
+        return body
+
+    def test_orders_list_query_count_is_constant(self):
+        orders = self.assert_constant_queries('/api/orders/')
+        self.assertEqual(Decimal(orders[0]['total_amount']), Decimal('150'))
+        self.assertEqual(Decimal(orders[0]['outstanding_balance']), Decimal('110'))
+        self.assertEqual(len(orders[0]['items']), 2)
+        self.assertEqual(Decimal(str(orders[0]['payments'][0]['outstanding_balance'])), Decimal('110'))
+
+    def test_debts_list_query_count_is_constant(self):
+        # /api/debts/ itself redirects browsers to the my-debts page, so go through the router's format suffix
+        debts = self.assert_constant_queries(reverse('debt-list', kwargs={'format': 'json'}))
+        self.assertEqual(Decimal(debts[0]['order']['total_paid']), Decimal('40'))
+        self.assertEqual(debts[0]['customer']['id'], self.customer.id)
+
+    def test_payments_list_query_count_is_constant(self):
+        payments = self.assert_constant_queries('/api/payments/')
+        self.assertEqual(Decimal(str(payments[0]['outstanding_balance'])), Decimal('110'))
+
+    def test_fields_trim_the_response_and_drop_nested_blocks(self):
+        self.add_orders(1)
+        order_id = Order.objects.get().pk
+        _, orders = self.query_count('/api/orders/?fields=id,status')
+        self.assertEqual(orders, [{'id': order_id, 'status': 'processing'}])
+
+        _, orders = self.query_count('/api/orders/?fields=id,items')
+        self.assertEqual(list(orders[0]), ['id', 'items'])
+        self.assertEqual(len(orders[0]['items']), 2)
+
+        _, debts = self.query_count(reverse('debt-list', kwargs={'format': 'json'}) + '?fields=id,order')
+        self.assertEqual(debts[0]['order']['id'], order_id)
+        self.assertEqual(len(debts[0]['order']['payments']), 1)
+
+
+@override_settings(SYNC_SETTLE_SECONDS=0)
+class SyncApiTests(TestCase):
+    def test_changes_and_deletes_since_cursor(self):
+        client = APIClient()
+        product = Product.objects.create(name='Soap', price=Decimal('50'), stock=10)
+        first = client.get('/api/sync/products/').json()
+        self.assertEqual([row['id'] for row in first['results']], [product.pk])
+
+        unchanged = client.get('/api/sync/products/', {'since': first['next']}).json()
+        self.assertEqual((unchanged['results'], unchanged['deleted']), ([], []))
+
+        product.price = Decimal('55')
+        product.save()
+        changed = client.get('/api/sync/products/', {'since': unchanged['next']}).json()
+        self.assertEqual([row['price'] for row in changed['results']], ['55.00'])
+
+        product_id = product.pk
+        product.delete()
+        deleted = client.get('/api/sync/products/', {'since': changed['next']}).json()
+        self.assertEqual((deleted['results'], deleted['deleted']), ([], [product_id]))
+
+    def test_customer_scoped_resources_need_a_login(self):
+        self.assertEqual(APIClient().get('/api/sync/orders/').status_code, 403)
+
+    @override_settings(SYNC_SETTLE_SECONDS=60)
+    def test_changes_inside_the_settle_window_wait_for_the_next_sync(self):
+        product = Product.objects.create(name='Soap', price=Decimal('50'), stock=10)
+        self.assertEqual(APIClient().get('/api/sync/products/').json()['results'], [])
+        Product.objects.filter(pk=product.pk).update(updated_at=timezone.now() - timedelta(seconds=61))
+        self.assertEqual(len(APIClient().get('/api/sync/products/').json()['results']), 1)
+
+
+class BulkWriteTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user('staff', password='x', is_staff=True))
+        customer, _ = Customer.objects.get_or_create(user=User.objects.create_user('buyer', password='x'))
+        self.order = Order.objects.create(customer=customer, status='processing')
+        self.product = Product.objects.create(name='Soap', price=Decimal('50'), stock=10)
+
+    def test_bulk_order_items_apply_together_or_not_at_all(self):
+        rows = [{'order': self.order.pk, 'product': self.product.pk, 'quantity': 4}] * 3
+        response = self.client.post('/api/order-items/bulk/', rows, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual([row.get('status') for row in response.json()['results']], ['not_applied', 'not_applied', None])
+        self.assertFalse(OrderItem.objects.exists())
+
+        response = self.client.post('/api/order-items/bulk/', rows[:2], format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([row['status'] for row in response.json()['results']], ['created', 'created'])
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 2)
+
+        item_id = response.json()['results'][0]['id']
+        response = self.client.post('/api/order-items/bulk/', [{'id': item_id, 'quantity': 1}], format='json')
+        self.assertEqual(response.json()['results'][0]['status'], 'updated')
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.stock, 5)
+
+    def test_bulk_payments_respect_the_order_total_and_roll_up_status(self):
+        OrderItem.objects.create(order=self.order, product=self.product, quantity=2, price=Decimal('50'))
+        response = self.client.post('/api/payments/bulk/', [
+            {'order': self.order.pk, 'amount': '60'}, {'order': self.order.pk, 'amount': '50'},
+        ], format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('Max allowed is 40', response.json()['results'][1]['errors']['amount'][0])
+        self.assertFalse(Payment.objects.exists())
+
+        first = self.client.post('/api/payments/bulk/', [{'order': self.order.pk, 'amount': '60'}], format='json').json()
+        self.assertEqual(Payment.objects.get().status, 'pending')
+        response = self.client.post('/api/payments/bulk/', [
+            {'id': first['results'][0]['id'], 'amount': '70'}, {'order': self.order.pk, 'amount': '30'},
+        ], format='json')
+        self.assertEqual([row['status'] for row in response.json()['results']], ['updated', 'created'])
+        self.assertEqual(set(Payment.objects.values_list('status', flat=True)), {'completed'})
+        self.assertEqual(sum(Payment.objects.values_list('amount', flat=True)), Decimal('100'))
+        # Settled as part of the batch, not by the worker
+        debt = Debt.objects.get(order=self.order)
+        self.assertEqual((debt.outstanding_balance, debt.is_paid), (Decimal('0'), True))
+        self.assertEqual(Order.objects.get(pk=self.order.pk).payment_status, 'paid')
+
+    def test_bulk_item_edits_update_the_debt_in_the_same_request(self):
+        rows = [{'order': self.order.pk, 'product': self.product.pk, 'quantity': 3}]
+        self.assertEqual(self.client.post('/api/order-items/bulk/', rows, format='json').status_code, 200)
+        self.assertEqual(Debt.objects.get(order=self.order).outstanding_balance, Decimal('150'))
+        self.assertFalse(BackgroundJob.objects.filter(name='ecommerce.tasks.recalculate_order_debt').exists())
+
+
+class ThrottleTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.user = User.objects.create_user('integration', password='x')
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {Token.objects.create(user=self.user).key}')
+
+    def rates(self, **rates):
+        return override_settings(REST_FRAMEWORK={**api_settings.user_settings, 'DEFAULT_THROTTLE_RATES': rates})
+
+    def test_scopes_are_limited_separately(self):
+        with self.rates(user='100/hour', catalog='2/minute'):
+            codes = [self.client.get('/api/products/').status_code for _ in range(3)]
+            self.assertEqual(codes, [200, 200, 429])
+            self.assertIn('Retry-After', self.client.get('/api/products/').headers)
+            self.assertEqual(self.client.get('/api/orders/').status_code, 200)
+
+    def test_per_user_override(self):
+        ApiRateLimit.objects.create(user=self.user, scope='catalog', rate='10/minute')
+        with self.rates(user='100/hour', catalog='2/minute'):
+            codes = [self.client.get('/api/products/').status_code for _ in range(3)]
+        self.assertEqual(codes, [200, 200, 200])
+
+
+class CachedTokenAuthTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.user = User.objects.create_user('pos', password='x')
+        self.token = Token.objects.create(user=self.user)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+
+    def test_warm_requests_skip_the_token_query(self):
+        self.client.get('/api/auth/profile/')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/auth/profile/')
+        self.assertEqual(response.json()['username'], 'pos')
+        self.assertEqual(len(queries), 0)
+
+    def test_user_changes_and_token_deletes_are_seen_at_once(self):
+        self.assertEqual(self.client.get('/api/orders/').status_code, 200)
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.client.get('/api/orders/').status_code, 403)
+        self.user.is_active = True
+        self.user.save()
+        self.assertEqual(self.client.get('/api/orders/').status_code, 200)
+        self.token.delete()
+        self.assertEqual(self.client.get('/api/orders/').status_code, 403)
+
+
+class ProductFeedTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        settings = override_settings(PRODUCT_FEED_BASE_URL='https://shop.example')
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def test_feed_rows_are_published_without_cost_prices(self):
+        self.assertEqual(self.client.get('/api/feeds/products.jsonl').status_code, 404)
+        soap = Product.objects.create(name='Soap', price=Decimal('50'), cost_price=Decimal('20'), stock=3)
+        Product.objects.create(name='Sponge', price=Decimal('10'), stock=0)
+        build_feed_rows()
+        self.assertEqual(publish_feed(), 2)
+
+        response = self.client.get('/api/feeds/products.jsonl')
+        rows = [json.loads(line) for line in response.content.splitlines()]
+        self.assertEqual([row['availability'] for row in rows], ['in_stock', 'out_of_stock'])
+        self.assertEqual(rows[0]['link'], f'https://shop.example/api/store/products/{soap.pk}/')
+        self.assertNotIn('cost_price', rows[0])
+        self.assertEqual(rows[0]['price'], '50.00 KES')
+        self.assertEqual(
+            self.client.get('/api/feeds/products.jsonl', HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304,
+        )
+        compressed = self.client.get('/api/feeds/products.csv', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(compressed['Content-Encoding'], 'gzip')
+        self.assertEqual(len(gzip.decompress(compressed.content).decode().splitlines()), 3)
+        self.assertEqual(self.client.get('/api/feeds/products.xml').status_code, 404)
+
+        soap.delete()
+        self.assertEqual(publish_feed(), 1)
+
+    def test_only_feed_column_changes_queue_a_rebuild(self):
+        soap = Product.objects.create(name='Soap', price=Decimal('50'), stock=3)
+        refreshes = BackgroundJob.objects.filter(name='ecommerce.product_feed.refresh_product_feed')
+        refreshes.delete()
+        soap.stock = 2
+        soap.save()
+        self.assertFalse(refreshes.exists())
+        soap.price = Decimal('55')
+        soap.save()
+        self.assertEqual(refreshes.count(), 1)
+        refreshes.delete()
+        soap.stock = 0
+        soap.save()
+        self.assertEqual(refreshes.count(), 1)
+
+
+class BatchReadTests(TestCase):
+    def test_home_screen_in_one_request_with_shared_product_lookups(self):
+        user = User.objects.create_user('app', password='x')
+        customer = Customer.objects.get(user=user)
+        soap = Product.objects.create(name='Soap', price=Decimal('50'), stock=10)
+        sponge = Product.objects.create(name='Sponge', price=Decimal('10'), stock=10)
+        CartItem.objects.create(cart=Cart.objects.create(customer=customer), product=soap, quantity=2)
+        for _ in range(3):
+            order = Order.objects.create(customer=customer, status='processing')
+            OrderItem.objects.create(order=order, product=sponge, quantity=1, price=sponge.price)
+        client = APIClient()
+        client.force_authenticate(user)
+
+        url = '/api/batch/?q=profile,stats,cart,recent_orders,notifications&recent_orders.limit=2'
+        client.get(url)
+        with CaptureQueriesContext(connection) as queries:
+            body = client.get(url).json()
+        self.assertEqual(list(body), ['profile', 'stats', 'cart', 'recent_orders', 'notifications', 'products'])
+        self.assertEqual(body['cart']['total'], '100.00')
+        self.assertEqual(len(body['recent_orders']), 2)
+        self.assertEqual([product['id'] for product in body['products']], [soap.pk, sponge.pk])
+        # customer, stats, cart, orders + items, notifications, and one product query for both
+        self.assertEqual(len(queries), 7)
+
+        body = client.get('/api/batch/?q=recent_orders,nope&recent_orders.limit=100').json()
+        self.assertEqual(set(body['errors']), {'recent_orders', 'nope'})
+
+
+class IdempotencyKeyTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.staff = User.objects.create_user('staff', password='x', is_staff=True)
+        customer = Customer.objects.get(user=User.objects.create_user('buyer', password='x'))
+        self.order = Order.objects.create(customer=customer, status='processing')
+        OrderItem.objects.create(order=self.order, product=Product.objects.create(name='Soap', price=Decimal('50'), stock=10),
+                                 quantity=2, price=Decimal('50'))
+
+    def test_api_retries_replay_the_first_response(self):
+        client = APIClient()
+        client.force_authenticate(self.staff)
+        body = {'order': self.order.pk, 'amount': '30.00', 'payment_method': 'cash'}
+        first = client.post('/api/payments/', body, format='json', HTTP_IDEMPOTENCY_KEY='pay-1')
+        retry = client.post('/api/payments/', body, format='json', HTTP_IDEMPOTENCY_KEY='pay-1')
+        self.assertEqual((first.status_code, retry.status_code), (201, 201))
+        self.assertEqual(retry.content, first.content)
+        self.assertEqual(retry.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(Payment.objects.count(), 1)
+
+        other = client.post('/api/payments/', {**body, 'amount': '10.00'}, format='json', HTTP_IDEMPOTENCY_KEY='pay-1')
+        self.assertEqual(other.status_code, 422)
+
+    def test_form_double_submit_records_one_payment(self):
+        self.client.force_login(self.staff)
+        data = {'order_id': self.order.pk, 'amount': '20', 'payment_method': 'cash', 'idempotency_key': 'form-1'}
+        for _ in range(2):
+            self.assertEqual(self.client.post('/api/ordering/payment/record/', data).status_code, 302)
+        self.assertEqual(Payment.objects.count(), 1)
+
+    def test_retry_while_the_first_request_runs_gets_409_at_once(self):
+        body = {'order': self.order.pk, 'amount': '30.00', 'payment_method': 'cash'}
+        in_flight = APIRequestFactory().post('/api/payments/', body, format='json')
+        IdempotencyKey.objects.create(user=self.staff, key='pay-1', fingerprint=fingerprint(in_flight))
+        client = APIClient()
+        client.force_authenticate(self.staff)
+        with patch('time.sleep') as sleep:
+            response = client.post('/api/payments/', body, format='json', HTTP_IDEMPOTENCY_KEY='pay-1')
+        sleep.assert_not_called()
+        self.assertEqual((response.status_code, response['Retry-After']), (409, '1'))
+        self.assertFalse(Payment.objects.exists())
+
+        self.client.force_login(self.staff)
+        data = {'order_id': self.order.pk, 'amount': '20', 'payment_method': 'cash', 'idempotency_key': 'form-1'}
+        IdempotencyKey.objects.create(user=self.staff, key='form-1', fingerprint=fingerprint(
+            RequestFactory().post('/api/ordering/payment/record/', data),
+        ))
+        response = self.client.post('/api/ordering/payment/record/', data)
+        self.assertEqual((response.status_code, response['Retry-After']), (409, '1'))
+
+
+class CustomerStatsTests(TestCase):
+    def setUp(self):
+        self.customer = Customer.objects.get(user=User.objects.create_user('buyer', password='x'))
+        self.product = Product.objects.create(name='Soap', price=Decimal('50'), stock=100)
+
+    def test_order_writes_refresh_the_cached_row(self):
+        order = Order.objects.create(customer=self.customer, status='pending')
+        OrderItem.objects.create(order=order, product=self.product, quantity=3, price=Decimal('50'))
+        Payment.objects.create(order=order, amount=Decimal('40'), status='completed')
+        run_pending_jobs()
+        stats = CustomerStats.objects.get(customer=self.customer)
+        self.assertEqual((stats.order_count, stats.pending_count), (1, 1))
+        self.assertEqual((stats.lifetime_spend, stats.outstanding), (Decimal('150'), Decimal('110')))
+
+        order.delete()
+        run_pending_jobs()
+        stats.refresh_from_db()
+        self.assertEqual((stats.order_count, stats.lifetime_spend), (0, Decimal('0')))
+
+    def test_missing_row_is_computed_on_read_and_rebuild_covers_everyone(self):
+        order = Order.objects.create(customer=self.customer, status='delivered')
+        OrderItem.objects.create(order=order, product=self.product, quantity=1, price=Decimal('50'))
+        CustomerStats.objects.all().delete()
+        self.assertEqual(get_customer_stats(self.customer).lifetime_spend, Decimal('50'))
+
+        CustomerStats.objects.all().delete()
+        self.assertEqual(rebuild_all_customer_stats(), Customer.objects.count())
+        self.assertEqual(CustomerStats.objects.get(customer=self.customer).order_count, 1)
+
+
+class StaffEventStreamTests(TestCase):
+    def test_wsgi_requests_are_told_not_to_reconnect(self):
+        self.client.force_login(User.objects.create_user('staff', password='x', is_staff=True))
+        self.assertEqual(self.client.get('/api/admin-dashboard/events/').status_code, 204)
+        self.client.force_login(User.objects.create_user('buyer', password='x'))
+        self.assertEqual(self.client.get('/api/admin-dashboard/events/').status_code, 403)
+
+    def test_signed_url_lets_staff_in_without_a_session(self):
+        staff = User.objects.create_user('staff', password='x', is_staff=True)
+        buyer = User.objects.create_user('buyer', password='x')
+        self.assertEqual(self.client.get(staff_events_url(staff)).status_code, 204)
+        self.assertEqual(self.client.get(staff_events_url(buyer)).status_code, 403)
+        self.assertEqual(self.client.get('/api/admin-dashboard/events/?token=forged').status_code, 403)
+        User.objects.filter(pk=staff.pk).update(is_staff=False)
+        self.assertEqual(self.client.get(staff_events_url(staff)).status_code, 403)
+
+    @override_settings(STAFF_EVENTS_ALLOWED_ORIGINS=['https://shop.example.com'])
+    def test_stream_is_readable_from_the_main_site_origin(self):
+        url = staff_events_url(User.objects.create_user('staff', password='x', is_staff=True))
+
+        async def open_stream(origin):
+            response = await AsyncClient().get(url, headers={'Origin': origin})
+            await response.streaming_content.aclose()
+            return response
+
+        response = async_to_sync(open_stream)('https://shop.example.com')
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        self.assertEqual(response['Access-Control-Allow-Origin'], 'https://shop.example.com')
+        self.assertNotIn('Access-Control-Allow-Origin', async_to_sync(open_stream)('https://evil.example.com'))
+
+
+class PaymentDebtTests(TestCase):
+    def setUp(self):
+        self.staff = User.objects.create_user('staff', password='x', is_staff=True)
+        customer = Customer.objects.get(user=User.objects.create_user('buyer', password='x'))
+        product = Product.objects.create(name='Soap', price=Decimal('50'), stock=10)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.order = Order.objects.create(customer=customer, status='pending', payment_type='cash')
+            OrderItem.objects.create(order=self.order, product=product, quantity=2, price=Decimal('50'))
+        self.client.force_login(self.staff)
+
+    def test_recording_a_payment_updates_the_debt_before_the_worker_runs(self):
+        data = {'order_id': self.order.pk, 'amount': '100', 'payment_method': 'cash'}
+        self.assertEqual(self.client.post('/api/ordering/payment/record/', data).status_code, 302)
+        debt = Debt.objects.get(order=self.order)
+        self.assertEqual((debt.outstanding_balance, debt.is_paid), (Decimal('0'), True))
+
+    def test_confirming_payment_settles_the_debt_inline(self):
+        url = reverse('approve_order', args=[self.order.pk])
+        self.client.post(url, {'action': 'confirm_payment'})
+        debt = Debt.objects.get(order=self.order)
+        self.assertEqual((debt.outstanding_balance, debt.is_paid), (Decimal('0'), True))
+
+    def test_debt_is_recalculated_once_per_order_when_the_transaction_commits(self):
+        self.assertEqual(Debt.objects.get(order=self.order).outstanding_balance, Decimal('100'))
+        with patch('ecommerce.tasks.recalculate_order_debt') as recalculate:
+            with self.captureOnCommitCallbacks(execute=True):
+                with transaction.atomic():
+                    Payment.objects.create(order=self.order, amount=Decimal('30'), status='completed')
+                    Payment.objects.create(order=self.order, amount=Decimal('70'), status='completed')
+                    recalculate.assert_not_called()
+        recalculate.assert_called_once_with(self.order.pk)
+        self.assertFalse(BackgroundJob.objects.filter(name='ecommerce.tasks.recalculate_order_debt').exists())
+
+    def test_rolled_back_saves_do_not_hold_up_the_next_recalculation(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    Payment.objects.create(order=self.order, amount=Decimal('100'), status='completed')
+                    raise ValueError
+            except ValueError:
+                pass
+            Payment.objects.create(order=self.order, amount=Decimal('100'), status='completed')
+        debt = Debt.objects.get(order=self.order)
+        self.assertEqual((debt.outstanding_balance, debt.is_paid), (Decimal('0'), True))
+
+
+class BackgroundJobTests(TestCase):
+    name = 'ecommerce.tasks.recalculate_order_debt'
+
+    def test_unclaimed_identical_job_is_rearmed_but_a_claimed_one_is_not(self):
+        BackgroundJob.objects.all().delete()
+        job = enqueue(self.name, 1)
+        self.assertIsNone(enqueue(self.name, 1))
+        self.assertEqual(BackgroundJob.objects.count(), 1)
+
+        self.assertEqual([claimed.pk for claimed in claim_jobs(10)], [job.pk])
+        # The claimed job may already have read the old rows, so the change needs its own run
+        self.assertIsNotNone(enqueue(self.name, 1))
+        self.assertEqual(BackgroundJob.objects.count(), 2)
+
+    def test_claimed_jobs_are_leased_until_they_run_or_the_lease_runs_out(self):
+        BackgroundJob.objects.all().delete()
+        job = enqueue(self.name, 999)
+        self.assertEqual(len(claim_jobs(10, lease_seconds=60)), 1)
+        self.assertEqual(claim_jobs(10), [])
+        # The worker died; the job comes back once the lease expires
+        BackgroundJob.objects.filter(pk=job.pk).update(run_at=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(run_pending_jobs(), 1)
+        self.assertFalse(BackgroundJob.objects.exists())
+
+    def retry_until_dead(self):
+        for attempt, delay in ((1, 30), (2, 60)):
+            started = timezone.now()
+            self.assertEqual(run_pending_jobs(), 0)
+            job = BackgroundJob.objects.get()
+            self.assertEqual(job.attempts, attempt)
+            self.assertIn('unexpected', job.last_error)
+            self.assertGreaterEqual(job.run_at, started + timedelta(seconds=delay))
+            # Not retried before its backoff is up
+            self.assertEqual(claim_jobs(10), [])
+            BackgroundJob.objects.update(run_at=timezone.now())
+
+        run_pending_jobs()
+        self.assertFalse(BackgroundJob.objects.exists())
+
+    @override_settings(JOB_MAX_ATTEMPTS=3, JOB_RETRY_BASE_SECONDS=30)
+    def test_failing_job_backs_off_then_moves_to_the_dead_letter_table(self):
+        BackgroundJob.objects.all().delete()
+        enqueue(self.name, 1, unexpected=True)
+        with self.assertLogs('ecommerce.jobs', 'WARNING') as logs:
+            self.retry_until_dead()
+        self.assertEqual(len(logs.output), 3)
+        dead = DeadJob.objects.get()
+        self.assertEqual((dead.name, dead.args, dead.kwargs, dead.attempts), (self.name, [1], {'unexpected': True}, 3))
+
+        requeue_dead_jobs([dead])
+        self.assertFalse(DeadJob.objects.exists())
+        self.assertEqual(list(BackgroundJob.objects.values_list('args', 'attempts')), [([1], 0)])
+
+
+class EmailDigestTests(TestCase):
+    def setUp(self):
+        user = User.objects.create_user('buyer', email='buyer@example.com', password='x')
+        Customer.objects.filter(user=user).update(email_digest=True)
+        self.user = User.objects.get(pk=user.pk)
+        self.digests = BackgroundJob.objects.filter(name='ecommerce.notifications_util.send_email_digest')
+
+    def send_due_digests(self):
+        self.digests.update(run_at=timezone.now())
+        run_pending_jobs()
+
+    def test_notifications_in_one_window_go_out_as_one_email(self):
+        send_notification_email(self.user, 'Order shipped', 'Your order shipped.')
+        send_notification_email(self.user, 'Order delivered', 'Your order was delivered.')
+        self.assertEqual(EmailOutbox.objects.count(), 0)
+        self.assertEqual(self.digests.count(), 1)
+
+        self.send_due_digests()
+        email = EmailOutbox.objects.get()
+        self.assertEqual(email.subject, '2 updates on your orders - H&I Store')
+        self.assertIn('Your order was delivered.', email.body_text)
+        self.assertFalse(EmailDigestItem.objects.exists())
+
+        # The window closed, so the next notification opens a new one
+        send_notification_email(self.user, 'Order cancelled', 'Your order was cancelled.')
+        self.assertEqual(self.digests.count(), 1)
+
+    def test_items_left_behind_by_a_digest_get_a_window_of_their_own(self):
+        def late_write(sender, instance, **kwargs):
+            # Lands while the digest is deleting what it sent
+            post_delete.disconnect(late_write, sender=EmailDigestItem)
+            EmailDigestItem.objects.create(user=self.user, subject='Late', message='Late update.')
+        post_delete.connect(late_write, sender=EmailDigestItem)
+        self.addCleanup(post_delete.disconnect, late_write, sender=EmailDigestItem)
+
+        send_notification_email(self.user, 'Order shipped', 'Your order shipped.')
+        self.send_due_digests()
+        self.assertEqual(EmailOutbox.objects.count(), 1)
+        self.assertEqual(self.digests.count(), 1)
+
+        self.send_due_digests()
+        self.assertEqual(EmailOutbox.objects.last().subject, 'Late')
+        self.assertFalse(EmailDigestItem.objects.exists())
+
+
+@override_settings(MPESA_CALLBACK_TOKEN='callback-secret')
+class MpesaCallbackTests(TestCase):
+    url = '/api/mpesa/callback/callback-secret/'
+
+    def setUp(self):
+        customer = Customer.objects.get(user=User.objects.create_user('buyer', password='x'))
+        self.order = Order.objects.create(customer=customer, status='pending_payment', payment_type='mpesa', mpesa_code='QK12ABC345')
+        OrderItem.objects.create(order=self.order, product=Product.objects.create(name='Soap', price=Decimal('50'), stock=10),
+                                 quantity=2, price=Decimal('50'))
+
+    def post(self, payload):
+        return self.client.post(self.url, json.dumps(payload), content_type='application/json')
+
+    def test_replayed_callback_records_one_payment(self):
+        payload = stk_callback(100, receipt='QK12ABC345')
+        for _ in range(2):
+            self.assertEqual(self.post(payload).status_code, 200)
+            run_pending_jobs()
+        payment = Payment.objects.get()
+        self.assertEqual((payment.amount, payment.mpesa_receipt), (Decimal('100'), 'QK12ABC345'))
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.status, 'pending')
+
+    def test_amount_mismatch_is_left_for_staff(self):
+        self.assertEqual(self.post(c2b_confirmation(60, account_reference=self.order.pk)).status_code, 200)
+        run_pending_jobs()
+        self.assertFalse(Payment.objects.exists())
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.status, 'pending_payment')
+
+    def test_malformed_stk_callbacks_are_rejected(self):
+        for body in ({'stkCallback': 'oops'}, {'stkCallback': {'ResultCode': 0, 'CallbackMetadata': []}}):
+            self.assertEqual(self.post({'Body': body}).status_code, 400)
+
+
+class UnreachableMailServer:
+    def open(self):
+        raise ConnectionRefusedError('Connection refused')
+
+
+class EmailOutboxTests(TestCase):
+    def test_claimed_rows_are_leased_until_sent_or_expired(self):
+        enqueue_email('a@example.com', 'Hello', 'Hi')
+        self.assertEqual(len(claim_batch(10)), 1)
+        self.assertEqual(claim_batch(10), [])
+        # The worker died mid-batch: the row comes back once the lease runs out
+        EmailOutbox.objects.update(next_attempt_at=timezone.now())
+        self.assertEqual(drain_outbox(), 1)
+        self.assertEqual(EmailOutbox.objects.get().status, 'sent')
+        self.assertEqual(len(mail.outbox), 1)
+
+    @override_settings(EMAIL_OUTBOX_MAX_ATTEMPTS=2)
+    def test_unreachable_smtp_backs_off_the_batch_without_raising(self):
+        for address in ('a@example.com', 'b@example.com'):
+            enqueue_email(address, 'Hello', 'Hi')
+        with patch('ecommerce.email_outbox.get_connection', return_value=UnreachableMailServer()):
+            self.assertEqual(drain_outbox(), 0)
+            self.assertEqual(set(EmailOutbox.objects.values_list('status', 'attempts')), {('pending', 1)})
+            self.assertEqual(EmailOutbox.objects.filter(next_attempt_at__gt=timezone.now()).count(), 2)
+            EmailOutbox.objects.update(next_attempt_at=timezone.now())
+            drain_outbox()
+        self.assertEqual(set(EmailOutbox.objects.values_list('status', 'attempts')), {('failed', 2)})
+        self.assertIn('Connection refused', EmailOutbox.objects.first().last_error)
+
+
+class UnreadCountTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.user = User.objects.create_user('buyer', password='x')
+        self.client.force_login(self.user)
+
+    def notify(self, count):
+        with self.captureOnCommitCallbacks(execute=True):
+            dispatcher = NotificationDispatcher()
+            for _ in range(count):
+                dispatcher.notify(self.user, 'new_order', 'Order placed')
+
+    def test_counter_follows_new_and_read_notifications(self):
+        self.assertEqual(get_unread_count(self.user.pk), 0)
+        self.notify(3)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(get_unread_count(self.user.pk), 3)
+        self.assertEqual(len(queries), 0)
+
+        notification = Notification.objects.filter(user=self.user).first()
+        self.client.post('/api/admin-dashboard/notifications/', {'action': 'mark_read', 'notification_id': notification.pk})
+        self.assertEqual(get_unread_count(self.user.pk), 2)
+        self.client.post('/api/admin-dashboard/notifications/', {'action': 'mark_all_read'})
+        self.assertEqual(get_unread_count(self.user.pk), 0)
+
+    @override_settings(UNREAD_COUNT_CACHE_SECONDS=0)
+    def test_unshared_cache_recounts_instead_of_trusting_a_stale_counter(self):
+        self.notify(2)
+        # Another process marking them read can't reach this process's cache
+        Notification.objects.update(is_read=True)
+        self.assertEqual(get_unread_count(self.user.pk), 0)
+
+
+class ReportingDatabaseTests(TestCase):
+    def setUp(self):
+        _lag_checks.clear()
+        self.addCleanup(_lag_checks.clear)
+
+    def test_reads_fall_back_to_the_primary_unless_the_replica_is_caught_up(self):
+        router = ReportingRouter()
+        with pinned_to_reporting() as alias:
+            self.assertEqual((alias, router.db_for_read(Order)), ('default', None))
+
+        with patch.dict(settings.DATABASES, {'reporting': {}}):
+            with patch('ecommerce.db_routers.replica_lag_seconds', return_value=120):
+                with pinned_to_reporting() as alias:
+                    self.assertEqual(alias, 'default')
+            _lag_checks.clear()
+            with patch('ecommerce.db_routers.replica_lag_seconds', return_value=1):
+                with pinned_to_reporting() as alias:
+                    self.assertEqual((alias, router.db_for_read(Order)), ('reporting', 'reporting'))
+                    self.assertEqual(router.db_for_write(Order), 'default')
+        self.assertIsNone(router.db_for_read(Order))
+
+    async def test_csv_export_streams_asynchronously_under_asgi(self):
+        staff = await User.objects.acreate(username='staff', is_staff=True)
+        await self.async_client.aforce_login(staff)
+        response = await self.async_client.get('/api/admin-dashboard/receivables/?export=csv')
+        self.assertTrue(response.is_async)
+        body = b''.join([chunk async for chunk in response.streaming_content]).decode()
+        self.assertEqual(body.splitlines()[-1].split(',')[0], 'TOTAL')
+
+
+class StockHistoryTests(TestCase):
+    def test_history_is_filtered_by_date_and_rejects_bad_dates(self):
+        soap = Product.objects.create(name='Soap', price=Decimal('50'), cost_price=Decimal('20'), stock=4)
+        for day in (date(2026, 1, 1), date(2026, 2, 1)):
+            with patch('django.utils.timezone.localdate', return_value=day):
+                take_inventory_snapshot()
+        self.client.force_login(User.objects.create_user('staff', password='x', is_staff=True))
+        url = f'/api/admin-dashboard/product/{soap.pk}/stock-history/'
+
+        history = self.client.get(url, {'from': '2026-01-15'}).json()['history']
+        self.assertEqual(history, [{'date': '2026-02-01', 'stock': 4, 'cost_value': 80.0, 'retail_value': 200.0}])
+        for bad in ({'from': 'yesterday'}, {'to': '2026-02-30'}):
+            self.assertEqual(self.client.get(url, bad).status_code, 400)
+
+
+class AgedReceivablesTests(TestCase):
+    def test_debts_fall_into_buckets_by_order_age(self):
+        now = timezone.now()
+        customers = [Customer.objects.get(user=User.objects.create_user(name, password='x')) for name in ('amy', 'ben')]
+        for customer, days, balance in [
+            (customers[0], 0, '10'), (customers[0], 30, '20'), (customers[0], 31, '40'),
+            (customers[1], 60, '80'), (customers[1], 61, '160'), (customers[1], 90, '320'), (customers[1], 91, '640'),
+        ]:
+            order = Order.objects.create(customer=customer, status='processing')
+            Order.objects.filter(pk=order.pk).update(order_date=now - timedelta(days=days))
+            Debt.objects.filter(order=order).update(outstanding_balance=Decimal(balance))
+        paid = Order.objects.create(customer=customers[0], status='delivered')
+        Debt.objects.filter(order=paid).update(outstanding_balance=Decimal('999'), is_paid=True)
+
+        totals = aged_receivables_totals(Debt.objects.all(), as_of=now)
+        self.assertEqual(
+            [totals[key] for key in ('days_0_30', 'days_31_60', 'days_61_90', 'days_90_plus', 'total')],
+            [Decimal('30'), Decimal('120'), Decimal('480'), Decimal('640'), Decimal('1270')],
+        )
+        self.assertEqual(totals['debt_count'], 7)
+
+        rows = list(aged_receivables_by_customer(Debt.objects.all(), as_of=now))
+        self.assertEqual([row['customer__user__username'] for row in rows], ['ben', 'amy'])
+        self.assertEqual((rows[1]['days_0_30'], rows[1]['days_31_60'], rows[1]['total']), (Decimal('30'), Decimal('40'), Decimal('70')))
+
+
+@override_settings(STOCK_VELOCITY_WINDOW_DAYS=30, SAFETY_STOCK_DAYS=3, DEFAULT_LEAD_TIME_DAYS=7, LOW_STOCK_THRESHOLD=5)
+class SalesVelocityTests(TestCase):
+    def setUp(self):
+        self.customer = Customer.objects.get(user=User.objects.create_user('buyer', password='x'))
+
+    def sell(self, product, quantity, status='delivered', days_ago=0):
+        order = Order.objects.create(customer=self.customer, status=status)
+        OrderItem.objects.create(order=order, product=product, quantity=quantity, price=product.price)
+        Order.objects.filter(pk=order.pk).update(order_date=timezone.now() - timedelta(days=days_ago))
+
+    def test_reorder_point_comes_from_recent_sales_and_observed_lead_time(self):
+        fast = Product.objects.create(name='Fast', price=Decimal('10'), stock=500)
+        slow = Product.objects.create(name='Slow', price=Decimal('10'), stock=500)
+        today = date.today()
+        supplier = Supplier.objects.create(name='Acme', lead_time_days=20)
+        consignment = Consignment.objects.create(
+            reference_number='C-1', supplier=supplier, date_ordered=today - timedelta(days=10), date_received=today - timedelta(days=4),
+        )
+        ConsignmentItem.objects.create(consignment=consignment, product=fast, quantity=1)
+        self.sell(fast, 60)
+        self.sell(fast, 100, status='cancelled')
+        self.sell(fast, 30, days_ago=45)
+
+        self.assertEqual(refresh_sales_velocity(), 2)
+        velocity = ProductVelocity.objects.get(product=fast)
+        # 60 units over 30 days, a 6-day observed lead time instead of the supplier's 20, plus 3 safety days
+        self.assertEqual((velocity.units_sold, velocity.daily_velocity), (60, Decimal('2')))
+        self.assertEqual((velocity.lead_time_days, velocity.reorder_point), (6, 18))
+        self.assertEqual(ProductVelocity.objects.get(product=slow).lead_time_days, 7)
+
+    def test_low_stock_falls_back_from_manual_threshold_to_reorder_point_to_default(self):
+        fast = Product.objects.create(name='Fast', price=Decimal('10'), stock=500)
+        slow = Product.objects.create(name='Slow', price=Decimal('10'), stock=500)
+        self.sell(fast, 60)
+        refresh_sales_velocity()
+        Product.objects.create(name='New', price=Decimal('10'), stock=5)
+        Product.objects.filter(pk=fast.pk).update(stock=18)
+        Product.objects.filter(pk=slow.pk).update(stock=8)
+        self.assertEqual([p.name for p in low_stock_products()], ['Fast', 'New'])
+
+        Product.objects.filter(pk=slow.pk).update(low_stock_threshold=10)
+        products = list(low_stock_products())
+        self.assertEqual([p.name for p in products], ['Fast', 'New', 'Slow'])
+        self.assertEqual(products[0].days_of_cover, Decimal('9'))
+
+    def test_nightly_refresh_only_recomputes_products_with_new_activity(self):
+        fast = Product.objects.create(name='Fast', price=Decimal('10'), stock=500)
+        Product.objects.create(name='Slow', price=Decimal('10'), stock=500)
+        out = StringIO()
+        call_command('refresh_sales_velocity', stdout=out)
+        self.assertIn('for 2 products', out.getvalue())
+        ProductVelocity.objects.update(computed_at=timezone.now() - timedelta(hours=1))
+
+        self.sell(fast, 30)
+        call_command('refresh_sales_velocity', stdout=out)
+        self.assertIn('for 1 products', out.getvalue())
+        self.assertEqual(ProductVelocity.objects.get(product=fast).units_sold, 30)
+
+
+class NotificationPagingTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('buyer', password='x')
+        now = timezone.now()
+        for minutes in (0, 5, 5, 5, 5, 10, 15):
+            notification = Notification.objects.create(user=self.user, notification_type='new_order', message='Order placed')
+            Notification.objects.filter(pk=notification.pk).update(created_at=now - timedelta(minutes=minutes))
+
+    def test_pages_walk_newest_first_without_gaps_across_timestamp_ties(self):
+        seen, cursor = [], None
+        while True:
+            rows, cursor = keyset_page(Notification.objects.all(), cursor, page_size=3)
+            seen.extend(rows)
+            if cursor is None:
+                break
+        expected = list(Notification.objects.order_by('-created_at', '-pk'))
+        self.assertEqual(seen, expected)
+        self.assertEqual(keyset_page(Notification.objects.all(), 'not-a-cursor', page_size=3)[0], expected[:3])
+
+    def test_old_read_notifications_move_to_the_archive(self):
+        Notification.objects.filter(pk__in=Notification.objects.order_by('pk').values('pk')[:5]).update(is_read=True)
+        Notification.objects.update(created_at=timezone.now() - timedelta(days=100))
+        Notification.objects.filter(pk=Notification.objects.order_by('pk').first().pk).update(created_at=timezone.now())
+        self.assertEqual(archive_read_notifications(days=90, batch_size=2), 4)
+        self.assertEqual(NotificationArchive.objects.count(), 4)
+        self.assertEqual(Notification.objects.count(), 3)
+
+
+class LocalBrokerTests(TestCase):
+    def test_published_message_reaches_every_listener(self):
+        broker = LocalBroker()
+
+        async def listen_twice():
+            first, second = broker.listen(keepalive=5), broker.listen(keepalive=5)
+            pending = [asyncio.ensure_future(anext(first)), asyncio.ensure_future(anext(second))]
+            while len(broker._subscribers) < 2:
+                await asyncio.sleep(0)
+            # Writers publish from request threads, not the listeners' loop
+            threading.Thread(target=broker.publish, args=('hello',)).start()
+            received = await asyncio.gather(*pending)
+            await first.aclose()
+            await second.aclose()
+            return received
+
+        self.assertEqual(asyncio.run(listen_twice()), ['hello', 'hello'])
+        self.assertEqual(broker._subscribers, set())
+
+    def test_idle_listener_gets_a_keepalive(self):
+        broker = LocalBroker()
+
+        async def wait_once():
+            listener = broker.listen(keepalive=0.01)
+            try:
+                return await anext(listener)
+            finally:
+                await listener.aclose()
+
+        self.assertIsNone(asyncio.run(wait_once()))
+
+    def test_staff_event_is_published_only_on_commit(self):
+        broker = LocalBroker()
+        with patch('ecommerce.realtime.get_broker', return_value=broker), \
+                patch.object(broker, 'publish') as publish:
+            with self.captureOnCommitCallbacks(execute=True):
+                publish_staff_event('order_status', {'order_id': 1})
+                publish.assert_not_called()
+        publish.assert_called_once_with(format_event('order_status', {'order_id': 1}))
+
+
+class NotificationDispatcherTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.user = User.objects.create_user('buyer', password='x')
+
+    def test_notifications_are_written_with_one_insert_after_commit(self):
+        self.assertEqual(get_unread_count(self.user.pk), 0)
+        with self.captureOnCommitCallbacks(execute=True):
+            dispatcher = NotificationDispatcher()
+            dispatcher.notify(self.user, 'new_order', 'Order placed')
+            dispatcher.notify(self.user, 'order_status', 'Order approved')
+            dispatcher.notify_staff('new_order', 'New order from buyer')
+            self.assertEqual(Notification.objects.count(), 0)
+        self.assertEqual(Notification.objects.count(), 3)
+        # Staff broadcasts are one row without a user
+        self.assertEqual(Notification.objects.filter(user__isnull=True).count(), 1)
+        self.assertEqual(get_unread_count(self.user.pk), 2)
+
+    def test_flush_issues_a_single_insert(self):
+        dispatcher = NotificationDispatcher()
+        with self.captureOnCommitCallbacks() as callbacks:
+            for _ in range(5):
+                dispatcher.notify(self.user, 'new_order', 'Order placed')
+        self.assertEqual(len(callbacks), 1)
+        with CaptureQueriesContext(connection) as queries:
+            callbacks[0]()
+        inserts = [query['sql'] for query in queries if query['sql'].startswith('INSERT')]
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual(Notification.objects.filter(user=self.user).count(), 5)
+
+    def test_rolled_back_notifications_are_dropped(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    NotificationDispatcher().notify(self.user, 'new_order', 'Order placed')
+                    raise ValueError
+            except ValueError:
+                pass
+        self.assertEqual(Notification.objects.count(), 0)
+
+
+class LowStockAlertTests(TestCase):
+    def setUp(self):
+        self.product = Product.objects.create(name='Soap', price=Decimal('50'), stock=20, low_stock_threshold=5)
+
+    def set_stock(self, stock):
+        with self.captureOnCommitCallbacks(execute=True):
+            product = Product.objects.get(pk=self.product.pk)
+            product.stock = stock
+            product.save()
+
+    def alerts(self):
+        return Notification.objects.filter(notification_type='low_stock', user__isnull=True).count()
+
+    def test_alerts_once_while_low_and_again_after_a_restock(self):
+        self.set_stock(6)
+        self.assertEqual(self.alerts(), 0)
+        self.set_stock(5)
+        self.set_stock(3)
+        self.set_stock(0)
+        self.assertEqual(self.alerts(), 1)
+        self.assertTrue(Product.objects.get(pk=self.product.pk).low_stock_alerted)
+
+        self.set_stock(30)
+        self.assertFalse(Product.objects.get(pk=self.product.pk).low_stock_alerted)
+        self.set_stock(4)
+        self.assertEqual(self.alerts(), 2)
+
+    def test_stale_instance_does_not_repeat_an_alert(self):
+        # Two saves that both loaded the product before either flipped the flag
+        first, second = Product.objects.get(pk=self.product.pk), Product.objects.get(pk=self.product.pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            first.stock = 4
+            first.save()
+            second.stock = 3
+            second.save()
+        self.assertEqual(self.alerts(), 1)
+
+    def test_flag_can_be_reset_by_naming_it_in_update_fields(self):
+        self.set_stock(4)
+        product = Product.objects.get(pk=self.product.pk)
+        product.low_stock_alerted = False
+        product.save()
+        self.assertTrue(Product.objects.get(pk=self.product.pk).low_stock_alerted)
+        product.save(update_fields=['low_stock_alerted'])
+        self.assertFalse(Product.objects.get(pk=self.product.pk).low_stock_alerted)
+        # Re-armed, so the next drop alerts again
+        self.set_stock(3)
+        self.assertEqual(self.alerts(), 2)
+
+
+@override_settings(REQUEST_PROFILING=True)
+class RequestProfilingTests(TestCase):
+    url = '/api/admin-dashboard/notifications/'
+
+    def get(self, user):
+        # A fresh client loads the middleware under the overridden setting
+        client = Client()
+        client.force_login(user)
+        with self.assertLogs('ecommerce.profiling', 'INFO') as logs:
+            response = client.get(self.url)
+        self.assertEqual(len(logs.records), 1)
+        return response, logs.records[0], json.loads(logs.records[0].getMessage())
+
+    def test_logs_one_line_per_request_and_times_it_for_staff(self):
+        response, record, line = self.get(User.objects.create_user('staff', password='x', is_staff=True))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((line['method'], line['path'], line['status']), ('GET', self.url, 200))
+        self.assertGreater(line['db_queries'], 0)
+        self.assertEqual(record.levelname, 'INFO')
+        self.assertIn(f'db;dur={line["db_ms"]:.1f};desc="{line["db_queries"]} queries"', response['Server-Timing'])
+
+    def test_customers_get_no_server_timing(self):
+        response, _, _ = self.get(User.objects.create_user('buyer', password='x'))
+        self.assertNotIn('Server-Timing', response)
+
+    @override_settings(PROFILING_REPEATED_QUERY_THRESHOLD=1)
+    def test_repeated_query_shapes_are_flagged(self):
+        _, record, line = self.get(User.objects.create_user('staff', password='x', is_staff=True))
+        self.assertEqual(record.levelname, 'WARNING')
+        self.assertTrue(line['repeated_queries'])
+
+    def test_profiled_backends_report_template_time_and_cache_hits(self):
+        templates = [{**settings.TEMPLATES[0], 'BACKEND': 'ecommerce.profiling.ProfiledDjangoTemplates'}]
+        caches_config = {'default': {'BACKEND': 'ecommerce.profiling.ProfiledLocMemCache'}}
+        self.url = reverse('orders_list')
+        with override_settings(TEMPLATES=templates, CACHES=caches_config):
+            staff = User.objects.create_user('staff', password='x', is_staff=True)
+            self.get(staff)
+            response, _, line = self.get(staff)
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(line['template_ms'], 0)
+        # The navbar's unread count, cached by the first request
+        self.assertGreater(line['cache_hits'], 0)
+
+    def test_library_classes_are_left_alone(self):
+        self.url = reverse('orders_list')
+        self.get(User.objects.create_user('staff', password='x', is_staff=True))
+        # Profiling swaps in subclasses from settings rather than patching these
+        self.assertEqual(LocMemCache.get.__qualname__, 'LocMemCache.get')
+        self.assertEqual(BackendTemplate.render.__qualname__, 'Template.render')
+
+    def test_in_lists_of_any_length_are_one_shape(self):
+        profile = RequestProfile()
+        execute = lambda sql, params, many, context: None
+        profile(execute, 'SELECT * FROM t WHERE id IN (%s, %s)', [1, 2], False, {})
+        profile(execute, 'SELECT * FROM t WHERE id IN (%s, %s, %s)', [1, 2, 3], False, {})
+        self.assertEqual(profile.repeated_queries(2), [('SELECT * FROM t WHERE id IN (...)', 2)])
+
+
+class FastListTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user('staff', password='x', is_staff=True))
+        customer = Customer.objects.get(user=User.objects.create_user('buyer', password='x'))
+        soap = Product.objects.create(name='Soap', price=Decimal('50'), cost_price=Decimal('20.5'), sku='S-1', stock=10)
+        Product.objects.create(name='Brush', price=Decimal('120.99'), stock=0)
+        for status in ('processing', 'delivered'):
+            order = Order.objects.create(customer=customer, status=status)
+            OrderItem.objects.create(order=order, product=soap, quantity=3, price=soap.price)
+            Payment.objects.create(order=order, amount=Decimal('40'), payment_method='mpesa', notes='Part payment')
+            Debt.objects.update_or_create(order=order, defaults={'customer': customer, 'outstanding_balance': Decimal('110')})
+
+    def both_ways(self, url):
+        with patch('ecommerce.views.convert_rows', wraps=convert_rows) as fast:
+            with override_settings(API_FAST_LISTS=True):
+                fast_body = self.client.get(url).json()
+            self.assertTrue(fast.called, f'{url} did not take the fast path')
+        with override_settings(API_FAST_LISTS=False):
+            serializer_body = self.client.get(url).json()
+        return fast_body, serializer_body
+
+    def test_fast_lists_match_the_serializer_output(self):
+        for url in (
+            '/api/products/',
+            # profile_picture needs the serializer to build its URL
+            '/api/customers/?fields=id,user,phone_number,address,email_digest',
+            '/api/order-items/',
+            '/api/payments/',
+            '/api/payments/?fields=id,amount,outstanding_balance',
+            '/api/orders/?fields=id,status,order_date,total_amount,total_paid,outstanding_balance',
+            reverse('debt-list', kwargs={'format': 'json'}) + '?fields=id,outstanding_balance,is_paid,paid_at',
+        ):
+            with self.subTest(url=url):
+                fast_body, serializer_body = self.both_ways(url)
+                self.assertTrue(fast_body['results'])
+                self.assertEqual(fast_body, serializer_body)
+
+
+class ProductImageFileTests(TestCase):
+    def test_deleting_an_image_removes_its_file_from_the_web_process(self):
+        with tempfile.TemporaryDirectory() as media, override_settings(MEDIA_ROOT=media):
+            product = Product.objects.create(name='Soap', price=Decimal('50'), stock=10)
+            image = ProductImage.objects.create(product=product, image=SimpleUploadedFile('soap.gif', b'GIF89a'))
+            path = image.image.path
+            self.assertTrue(os.path.exists(path))
+            with self.captureOnCommitCallbacks(execute=True):
+                image.delete()
+                self.assertTrue(os.path.exists(path))
+            self.assertFalse(os.path.exists(path))
+        self.assertFalse(BackgroundJob.objects.filter(name='ecommerce.tasks.delete_stored_file').exists())
@@ -0,0 +1,99 @@
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from rest_framework.settings import api_settings
+from rest_framework.throttling import BaseThrottle
+
+# Views pick one of these with throttle_scope, or per action with throttle_scopes
+THROTTLE_SCOPES = ('catalog', 'orders', 'checkout', 'payments', 'account', 'sync', 'api')
+
+_DURATIONS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def parse_rate(rate):
+    requests, period = rate.split('/')
+    return int(requests), _DURATIONS[period[0]]
+
+
+def incr(key, timeout):
+    # add() is SET NX and incr() is INCRBY on the Redis cache backend, so
+    # concurrent workers never lose a count
+    cache.add(key, 0, timeout)
+    try:
+        return cache.incr(key)
+    except ValueError:
+        # expired between add() and incr()
+        cache.add(key, 1, timeout)
+        return 1
+
+
+def rate_overrides(user_id):
+    from .models import ApiRateLimit
+    return cache.get_or_set(
+        f'api-rate-limits:{user_id}',
+        lambda: dict(ApiRateLimit.objects.filter(user_id=user_id).values_list('scope', 'rate')),
+        300,
+    )
+
+
+def usage_key(hour, scope, user_id, throttled=False):
+    return f"api-usage:{hour}:{scope}:{user_id}{':throttled' if throttled else ''}"
+
+
+def record_usage(user_id, scope, allowed):
+    hour = int(time.time() // 3600)
+    timeout = getattr(settings, 'API_USAGE_RETENTION_HOURS', 168) * 3600
+    incr(usage_key(hour, scope, user_id), timeout)
+    if not allowed:
+        incr(usage_key(hour, scope, user_id, throttled=True), timeout)
+
+
+class ScopedSlidingWindowThrottle(BaseThrottle):
+    # Sliding-window counter: the previous fixed window's count, weighted by how
+    # much of it still overlaps the last `window` seconds, plus the current
+    # window's count. Two small cache keys per client and scope instead of a
+    # timestamp log, and rejected requests count too so a flood stays shed.
+    def get_scope(self, view):
+        scopes = getattr(view, 'throttle_scopes', {})
+        return scopes.get(getattr(view, 'action', None)) or getattr(view, 'throttle_scope', None) or 'api'
+
+    def get_rate(self, request, scope):
+        rates = api_settings.DEFAULT_THROTTLE_RATES
+        if request.user and request.user.is_authenticated:
+            overrides = rate_overrides(request.user.pk)
+            return overrides.get(scope) or overrides.get('') or rates.get(scope) or rates.get('user')
+        return rates.get(f'{scope}_anon') or rates.get('anon')
+
+    def allow_request(self, request, view):
+        scope = self.get_scope(view)
+        rate = self.get_rate(request, scope)
+        if rate is None:
+            return True
+        limit, window = parse_rate(rate)
+        if request.user and request.user.is_authenticated:
+            ident = f'user:{request.user.pk}'
+        else:
+            ident = f'ip:{self.get_ident(request)}'
+
+        now = time.time()
+        bucket = int(now // window)
+        key = f'throttle:{scope}:{ident}:{window}'
+        current = incr(f'{key}:{bucket}', window * 2)
+        previous = cache.get(f'{key}:{bucket - 1}', 0)
+        elapsed = now - bucket * window
+        allowed = previous * (window - elapsed) / window + current <= limit
+
+        if request.auth is not None:
+            # Token clients are the integrations the usage report is about
+            record_usage(request.user.pk, scope, allowed)
+        if not allowed:
+            # Time until the previous window's weight has decayed enough, or the window rolls over
+            if previous and current <= limit:
+                self.retry_after = max(window * (1 - (limit - current) / previous) - elapsed, 1)
+            else:
+                self.retry_after = window - elapsed
+        return allowed
+
+    def wait(self):
+        return getattr(self, 'retry_after', None)
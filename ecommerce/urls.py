@@ -9,13 +9,13 @@ from .views import (
     CustomerViewSet, ProductViewSet, OrderViewSet, OrderItemViewSet,
     PaymentViewSet, DebtViewSet, add_payment, add_payment_standalone, update_payment, delete_payment,
     register_view, login_view, logout_view,
-    dashboard_view, my_stats_view, orders_list_view, order_detail_view, debts_list_view,
-    profile_view, ProfileView, order_product_view, change_password_view,
+    dashboard_view, my_stats_view, orders_list_view, order_detail_view, debts_list_view, aged_receivables_view,
+    profile_view, ProfileView, CustomerStatsView, SyncView, BatchView, order_product_view, change_password_view,
     custom_login, admin_dashboard, payment_list_view, update_order_status, add_product, update_product, delete_product, product_list, admin_products_list, reports_view,
-    admin_update_order, admin_delete_order, adjust_stock, record_payment, create_category, create_brand, cart_view, add_to_cart, remove_from_cart, update_cart_item, checkout_from_cart,
+    admin_update_order, admin_delete_order, adjust_stock, product_stock_history, record_payment, create_category, create_brand, cart_view, add_to_cart, remove_from_cart, update_cart_item, checkout_from_cart,
     product_detail, mark_payment_paid,
     consignment_list, add_consignment, add_supplier, add_expense, expense_list, financial_report,
-    notifications_view, approve_order, receipt_view,
+    notifications_view, staff_events, mpesa_callback, product_feed_view, approve_order, receipt_view,
     admin_users_list, admin_reset_user_password
 )
 
@@ -39,6 +39,10 @@ urlpatterns = [
 
     path('dashboard/', dashboard_view, name='dashboard'),
     path('my-stats/', my_stats_view, name='my_stats'),
+    path('my-stats/summary/', CustomerStatsView.as_view(), name='customer_stats_api'),
+    path('sync/<str:resource>/', SyncView.as_view(), name='sync'),
+    path('batch/', BatchView.as_view(), name='batch'),
+    path('feeds/products.<str:fmt>', product_feed_view, name='product_feed'),
     path('orders/list', orders_list_view, name='orders_list'),
     path('orders/detail/<int:pk>/', order_detail_view, name='order_detail'),
     path('orders/receipt/<int:pk>/', receipt_view, name='order_receipt'),
@@ -58,6 +62,7 @@ urlpatterns = [
 
     path('admin-dashboard/', admin_dashboard, name='admin_dashboard'),
     path('admin-dashboard/reports/', reports_view, name='reports'),
+    path('admin-dashboard/receivables/', aged_receivables_view, name='aged_receivables'),
     path('admin-dashboard/update-order/<int:pk>/', update_order_status, name='update_order_status'),
     path('admin-dashboard/orders/<int:pk>/mark-paid/', mark_payment_paid, name='mark_payment_paid'),
     path('admin-dashboard/orders/<int:pk>/update/', admin_update_order, name='admin_update_order'),
@@ -74,6 +79,7 @@ urlpatterns = [
     path("admin-dashboard/product/<int:pk>/delete/", delete_product, name="delete_product"),
     path("admin-dashboard/products/", admin_products_list, name="admin_products_list"),
     path("admin-dashboard/product/<int:pk>/adjust-stock/", adjust_stock, name="adjust_stock"),
+    path("admin-dashboard/product/<int:pk>/stock-history/", product_stock_history, name="product_stock_history"),
 
     path("admin-dashboard/consignments/", consignment_list, name="consignment_list"),
     path("admin-dashboard/consignment/add/", add_consignment, name="add_consignment"),
@@ -87,6 +93,8 @@ urlpatterns = [
     path('admin-dashboard/users/', admin_users_list, name='admin_users_list'),
     path('admin-dashboard/users/<int:user_id>/reset-password/', admin_reset_user_password, name='admin_reset_user_password'),
     path('admin-dashboard/notifications/', notifications_view, name='notifications'),
+    path('admin-dashboard/events/', staff_events, name='staff_events'),
+    path('mpesa/callback/<str:token>/', mpesa_callback, name='mpesa_callback'),
     path('ordering/payment/record/', record_payment, name='record_payment'),
     path('category/create/', create_category, name='create_category'),
     path('brand/create/', create_brand, name='create_brand'),
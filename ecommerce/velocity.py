@@ -0,0 +1,124 @@
+import math
+from datetime import timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.db.models import Case, DecimalField, F, Max, Q, Sum, Value, When
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import Consignment, ConsignmentItem, OrderItem, Product, ProductVelocity, Supplier
+
+# Orders in these states never shipped, so they don't count as demand
+EXCLUDED_STATUSES = ['cancelled', 'rejected']
+
+
+def _window_days():
+    return getattr(settings, 'STOCK_VELOCITY_WINDOW_DAYS', 30)
+
+
+def default_low_stock_threshold():
+    # Used for products with neither a manual threshold nor a computed reorder point yet
+    return getattr(settings, 'LOW_STOCK_THRESHOLD', 5)
+
+
+def supplier_lead_times():
+    # Observed lead time from consignments that recorded when they were ordered,
+    # falling back to the lead time configured on the supplier
+    observed = {}
+    for supplier_id, ordered, received in Consignment.objects.filter(
+        supplier__isnull=False, date_ordered__isnull=False,
+    ).values_list('supplier_id', 'date_ordered', 'date_received'):
+        observed.setdefault(supplier_id, []).append(max((received - ordered).days, 0))
+    lead_times = {
+        supplier_id: days
+        for supplier_id, days in Supplier.objects.filter(lead_time_days__isnull=False).values_list('id', 'lead_time_days')
+    }
+    for supplier_id, samples in observed.items():
+        lead_times[supplier_id] = math.ceil(sum(samples) / len(samples))
+    return lead_times
+
+
+def product_lead_times(product_ids):
+    default = getattr(settings, 'DEFAULT_LEAD_TIME_DAYS', 7)
+    by_supplier = supplier_lead_times()
+    lead_times = {}
+    # The most recent consignment decides which supplier restocks a product
+    for product_id, supplier_id in ConsignmentItem.objects.filter(
+        product_id__in=product_ids, consignment__supplier__isnull=False,
+    ).order_by('product_id', '-consignment__date_received').values_list('product_id', 'consignment__supplier_id'):
+        lead_times.setdefault(product_id, by_supplier.get(supplier_id, default))
+    return {product_id: lead_times.get(product_id, default) for product_id in product_ids}
+
+
+def products_needing_refresh(now):
+    last_run = ProductVelocity.objects.aggregate(last=Max('computed_at'))['last']
+    if last_run is None:
+        return None
+    window = timedelta(days=_window_days())
+    changed = OrderItem.objects.filter(
+        # sold since the last run, or aged out of the window since then
+        Q(order__order_date__gt=last_run) | Q(order__order_date__gt=last_run - window, order__order_date__lte=now - window)
+    ).values_list('product_id', flat=True)
+    received = ConsignmentItem.objects.filter(consignment__date_received__gte=last_run.date()).values_list('product_id', flat=True)
+    missing = Product.objects.filter(velocity__isnull=True).values_list('id', flat=True)
+    return set(changed) | set(received) | set(missing)
+
+
+def refresh_sales_velocity(product_ids=None, now=None):
+    now = now or timezone.now()
+    window_days = _window_days()
+    safety_days = getattr(settings, 'SAFETY_STOCK_DAYS', 3)
+
+    sales = OrderItem.objects.filter(order__order_date__gt=now - timedelta(days=window_days)).exclude(
+        order__status__in=EXCLUDED_STATUSES,
+    )
+    if product_ids is None:
+        product_ids = list(Product.objects.values_list('id', flat=True))
+    else:
+        product_ids = list(product_ids)
+        sales = sales.filter(product_id__in=product_ids)
+    units = dict(sales.order_by().values('product_id').annotate(units=Sum('quantity')).values_list('product_id', 'units'))
+    lead_times = product_lead_times(product_ids)
+
+    rows = []
+    for product_id in product_ids:
+        sold = units.get(product_id) or 0
+        velocity = (Decimal(sold) / window_days).quantize(Decimal('0.001'))
+        lead_time = lead_times[product_id]
+        rows.append(ProductVelocity(
+            product_id=product_id,
+            units_sold=sold,
+            window_days=window_days,
+            daily_velocity=velocity,
+            lead_time_days=lead_time,
+            reorder_point=math.ceil(velocity * (lead_time + safety_days)),
+            computed_at=now,
+        ))
+    ProductVelocity.objects.bulk_create(
+        rows,
+        batch_size=500,
+        update_conflicts=True,
+        unique_fields=['product'],
+        update_fields=['units_sold', 'window_days', 'daily_velocity', 'lead_time_days', 'reorder_point', 'computed_at'],
+    )
+    return len(rows)
+
+
+def with_stock_cover(products):
+    return products.annotate(
+        reorder_point=Coalesce('low_stock_threshold', 'velocity__reorder_point', Value(default_low_stock_threshold())),
+        daily_velocity=F('velocity__daily_velocity'),
+        days_of_cover=Case(
+            When(velocity__daily_velocity__gt=0, then=F('stock') / F('velocity__daily_velocity')),
+            default=None,
+            output_field=DecimalField(max_digits=12, decimal_places=1),
+        ),
+    )
+
+
+def low_stock_products(products=None, limit=10):
+    # Products at or below their reorder point, soonest to run out first
+    products = with_stock_cover(products if products is not None else Product.objects.all())
+    products = products.filter(stock__lte=F('reorder_point')).order_by(F('days_of_cover').asc(nulls_last=True), 'stock')
+    return products[:limit] if limit else products
@@ -1,8 +1,12 @@
+import csv
+import gzip
 import json
-from django.db.models import Sum, Count
+import uuid
+from django.db.models import Sum, Count, Q, Prefetch
 from datetime import date
 from dateutil.relativedelta import relativedelta
 from rest_framework import viewsets, permissions
+from rest_framework.decorators import action
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated, SAFE_METHODS
@@ -10,25 +14,48 @@ from django.contrib.auth.models import User
 from django.contrib.auth import get_user_model
 from django.db import transaction, IntegrityError
 from django.utils import timezone
+from django.utils.functional import cached_property
 from decimal import Decimal
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth import login, authenticate, logout
 from django.contrib.auth.forms import UserCreationForm, AuthenticationForm
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
-from django.http import HttpResponseRedirect, JsonResponse
+from django.http import Http404, HttpResponse, HttpResponseForbidden, HttpResponseNotModified, HttpResponseRedirect, JsonResponse, StreamingHttpResponse
+from django.core.paginator import Paginator
 from django.urls import reverse
-from django.utils.http import url_has_allowed_host_and_scheme
-from django.views.decorators.http import require_POST
+from django.utils.cache import patch_vary_headers
+from django.utils.dateparse import parse_date
+from django.utils.http import http_date, url_has_allowed_host_and_scheme
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST, require_safe
+from django.utils.crypto import constant_time_compare
 from django.contrib import messages
+from django.conf import settings
 from django.core.exceptions import ValidationError
+from django.core.handlers.asgi import ASGIRequest
 
 from .models import Customer, Product, Order, OrderItem, Payment, Debt, ProductImage, StockAdjustment, Category, Brand, Supplier, Consignment, ConsignmentItem, Expense, Cart, CartItem, Notification
 from .forms import OrderForm, PaymentForm, ProductForm, ProductImageFormSet, CustomUserCreationForm, CustomAuthenticationForm, ConsignmentForm, SupplierForm, ExpenseForm
-from .notifications_util import send_notification_email
+from .notifications_util import NotificationDispatcher, adjust_unread_count, get_unread_count, reset_unread_count, send_notification_email
+from .customer_stats import get_customer_stats
+from .inventory import current_stock_valuation, stock_history, valuation_on, valuation_series
+from .velocity import low_stock_products
+from .pagination import keyset_page
+from .realtime import get_broker, staff_events_user_id
+from .mpesa import InvalidCallback, reconcile_mpesa_receipt, record_callback
+from .db_routers import reporting_astream, reporting_stream, use_reporting_db
+from .bulk import BulkRequestError, bulk_write_order_items, bulk_write_payments
+from .renderers import FastJSONRenderer, convert_rows, fast_list_plan, fast_list_values, orjson
+from .sync import SYNC_RESOURCES, CursorExpired, InvalidCursor, changes_since
+from .batch import BATCH_QUERIES, profile_data, run_batch
+from .idempotency import IdempotentMixin, idempotent
+from .tasks import get_or_create_debt
+from .product_feed import FEED_FORMATS, published_feed
+from .receivables import AGEING_BUCKETS, aged_receivables_by_customer, aged_receivables_totals
 from .serializers import (
     CustomerSerializer, ProductSerializer, OrderSerializer,
-    OrderItemSerializer, PaymentSerializer, DebtSerializer
+    OrderItemSerializer, PaymentSerializer, DebtSerializer, CustomerStatsSerializer, sparse_fieldset
 )
 
 # -------------------
@@ -44,55 +71,162 @@ class StaffOrReadPublic(permissions.BasePermission):
             return True
         return request.user and request.user.is_staff
 
-class CustomerViewSet(viewsets.ModelViewSet):
+class SyncPermission(permissions.BasePermission):
+    # Products are public like ProductViewSet; everything else is scoped to the signed-in customer
+    def has_permission(self, request, view):
+        return view.kwargs.get('resource') == 'products' or request.user.is_authenticated
+
+class SparseFieldsetMixin:
+    # Loads only what ?fields= will render (see SparseFieldsMixin)
+    @cached_property
+    def fieldset(self):
+        return sparse_fieldset(self.request)
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context.update(self.fieldset)
+        return context
+
+    def wants(self, *names):
+        fields = self.fieldset['fields']
+        return fields is None or any(name in fields for name in names)
+
+    def trim(self, queryset):
+        fields = self.fieldset['fields']
+        if not fields:
+            return queryset
+        columns = {field.name for field in queryset.model._meta.concrete_fields}
+        return queryset.only('pk', *(columns & fields))
+
+def writable_orders(user):
+    return Order.objects.all() if user.is_staff else Order.objects.filter(customer__user=user)
+
+def bulk_response(view, rows, write):
+    # POST a list of rows; all are validated first and applied together, or none are
+    try:
+        errors, written = write()
+    except BulkRequestError as exc:
+        return Response({'detail': str(exc)}, status=400)
+    if errors:
+        return Response({'applied': False, 'results': [
+            {'index': index, 'errors': errors[index]} if index in errors else {'index': index, 'status': 'not_applied'}
+            for index in range(len(rows))
+        ]}, status=400)
+    fresh = view.get_queryset().in_bulk([instance.pk for _, instance in written])
+    data = view.get_serializer([fresh[instance.pk] for _, instance in written], many=True).data
+    return Response({'applied': True, 'results': [
+        {'index': index, 'status': status, 'id': instance.pk, 'data': row}
+        for index, ((status, instance), row) in enumerate(zip(written, data))
+    ]})
+
+class FastListMixin:
+    # GET lists with only plain columns skip per-row serializer instances: rows come
+    # straight from .values() on the annotated queryset and FastJSONRenderer encodes them
+    fast_list_sources = {}
+
+    def list(self, request, *args, **kwargs):
+        plan = None
+        if settings.API_FAST_LISTS and orjson is not None and isinstance(request.accepted_renderer, FastJSONRenderer):
+            plan = fast_list_plan(self.get_serializer(), self.fast_list_sources)
+        if plan is None:
+            return super().list(request, *args, **kwargs)
+        # cursor pagination reads the id off each row, even if ?fields= left it out
+        extra = [] if 'id' in plan[0] else ['id']
+        rows = fast_list_values(self.filter_queryset(self.get_queryset()), plan, *extra)
+        page = self.paginate_queryset(rows)
+        rows = convert_rows(page if page is not None else list(rows), plan)
+        for row in rows:
+            for name in extra:
+                del row[name]
+        return self.get_paginated_response(rows) if page is not None else Response(rows)
+
+class CustomerViewSet(IdempotentMixin, FastListMixin, SparseFieldsetMixin, viewsets.ModelViewSet):
     queryset = Customer.objects.all()
     serializer_class = CustomerSerializer
     permission_classes = [StaffOnly]
+    throttle_scope = 'account'
 
-class ProductViewSet(viewsets.ModelViewSet):
+    def get_queryset(self):
+        return self.trim(super().get_queryset())
+
+class ProductViewSet(IdempotentMixin, FastListMixin, SparseFieldsetMixin, viewsets.ModelViewSet):
     queryset = Product.objects.all()
     serializer_class = ProductSerializer
     permission_classes = [StaffOrReadPublic]
+    throttle_scope = 'catalog'
 
-class OrderViewSet(viewsets.ModelViewSet):
+    def get_queryset(self):
+        return self.trim(super().get_queryset())
+
+class OrderViewSet(IdempotentMixin, FastListMixin, SparseFieldsetMixin, viewsets.ModelViewSet):
     serializer_class = OrderSerializer
     permission_classes = [permissions.IsAuthenticated]
+    throttle_scope = 'orders'
+    throttle_scopes = {'create': 'checkout'}
 
     def get_queryset(self):
         user = self.request.user
+        orders = self.trim(Order.objects.for_api(
+            # nested payments read their balance from the order's annotation
+            totals=self.wants('total_amount', 'total_paid', 'outstanding_balance', 'payments'),
+            items=self.wants('items'),
+            payments=self.wants('payments'),
+        ))
         if user.is_staff:
-            return Order.objects.all()
-        return Order.objects.filter(customer__user=user)
+            return orders
+        return orders.filter(customer__user=user)
 
-class OrderItemViewSet(viewsets.ModelViewSet):
+class OrderItemViewSet(IdempotentMixin, FastListMixin, SparseFieldsetMixin, viewsets.ModelViewSet):
     serializer_class = OrderItemSerializer
     permission_classes = [permissions.IsAuthenticated]
+    throttle_scope = 'orders'
+    throttle_scopes = {'create': 'checkout', 'bulk': 'checkout'}
 
     def get_queryset(self):
         user = self.request.user
+        items = self.trim(OrderItem.objects.all())
         if user.is_staff:
-            return OrderItem.objects.all()
-        return OrderItem.objects.filter(order__customer__user=user)
+            return items
+        return items.filter(order__customer__user=user)
+
+    @action(detail=False, methods=['post'])
+    def bulk(self, request):
+        return bulk_response(self, request.data, lambda: bulk_write_order_items(request.data, writable_orders(request.user)))
 
-class PaymentViewSet(viewsets.ModelViewSet):
+class PaymentViewSet(IdempotentMixin, FastListMixin, SparseFieldsetMixin, viewsets.ModelViewSet):
     serializer_class = PaymentSerializer
     permission_classes = [permissions.IsAuthenticated]
+    throttle_scope = 'payments'
+    fast_list_sources = {'outstanding_balance': 'order_outstanding'}
 
     def get_queryset(self):
         user = self.request.user
+        payments = self.trim(Payment.objects.all())
+        if self.wants('outstanding_balance'):
+            payments = payments.with_order_outstanding()
         if user.is_staff:
-            return Payment.objects.all()
-        return Payment.objects.filter(order__customer__user=user)
+            return payments
+        return payments.filter(order__customer__user=user)
 
-class DebtViewSet(viewsets.ModelViewSet):
+    @action(detail=False, methods=['post'])
+    def bulk(self, request):
+        return bulk_response(self, request.data, lambda: bulk_write_payments(request.data, writable_orders(request.user), request.user))
+
+class DebtViewSet(IdempotentMixin, FastListMixin, SparseFieldsetMixin, viewsets.ModelViewSet):
     serializer_class = DebtSerializer
     permission_classes = [permissions.IsAuthenticated]
+    throttle_scope = 'account'
 
     def get_queryset(self):
         user = self.request.user
+        debts = self.trim(Debt.objects.all())
+        if self.wants('customer'):
+            debts = debts.select_related('customer')
+        if self.wants('order'):
+            debts = debts.prefetch_related(Prefetch('order', queryset=Order.objects.for_api()))
         if user.is_staff:
-            return Debt.objects.all()
-        return Debt.objects.filter(customer__user=user)
+            return debts
+        return debts.filter(customer__user=user)
 
 def register_view(request):
     if request.method == 'POST':
@@ -160,13 +294,13 @@ def dashboard_view(request):
 def my_stats_view(request):
     try:
         customer = Customer.objects.get(user=request.user)
-        orders = Order.objects.filter(customer=customer).order_by('-order_date')
+        stats = get_customer_stats(customer)
 
-        total_orders = orders.count()
-        total_spent = sum(o.get_total_amount() for o in orders)
-        outstanding = sum(o.get_outstanding_balance() for o in orders)
-        pending_orders = orders.filter(status='pending').count()
-        recent_orders = orders[:5]
+        total_orders = stats.order_count
+        total_spent = stats.lifetime_spend
+        outstanding = stats.outstanding
+        pending_orders = stats.pending_count
+        recent_orders = Order.objects.filter(customer=customer).order_by('-order_date')[:5]
 
     except Customer.DoesNotExist:
         total_orders = 0
@@ -239,32 +373,70 @@ def order_detail_view(request, pk):
 
 
 @login_required
+@use_reporting_db
 def debts_list_view(request):
     if request.user.is_staff:
         debts = Debt.objects.select_related('customer__user', 'order').order_by('-outstanding_balance')
         is_admin = True
     else:
-        try:
-            customer = Customer.objects.get(user=request.user)
-            debts = Debt.objects.filter(customer=customer).select_related('order')
-        except Customer.DoesNotExist:
-            debts = []
+        debts = Debt.objects.filter(customer__user=request.user).select_related('order')
         is_admin = False
 
-    total_outstanding = sum(d.outstanding_balance for d in debts if not d.is_paid)
-    paid_count = debts.filter(is_paid=True).count()
-
-    for debt in debts:
-        debt.amount_paid = debt.order.get_total_amount() - debt.outstanding_balance
+    debts = debts.with_order_totals()
+    summary = debts.aggregate(
+        total_outstanding=Sum('outstanding_balance', filter=Q(is_paid=False), default=0),
+        paid_count=Count('id', filter=Q(is_paid=True)),
+    )
 
     return render(request, 'ecommerce/debts_list.html', {
         'debts': debts,
-        'total_outstanding': total_outstanding,
-        'paid_count': paid_count,
+        'total_outstanding': summary['total_outstanding'],
+        'paid_count': summary['paid_count'],
         'is_admin': is_admin,
     })
 
 
+class Echo:
+    # File-like object for csv.writer that hands each row back instead of buffering it
+    def write(self, value):
+        return value
+
+
+@staff_member_required
+@use_reporting_db
+def aged_receivables_view(request):
+    rows = aged_receivables_by_customer(Debt.objects.all())
+    totals = aged_receivables_totals(Debt.objects.all())
+
+    if request.GET.get('export') == 'csv':
+        writer = csv.writer(Echo())
+
+        def csv_rows():
+            yield writer.writerow(['Customer', 'Phone', 'Open debts'] + [label for _k, label, *_ in AGEING_BUCKETS] + ['Total'])
+            for row in rows.iterator():
+                yield writer.writerow(
+                    [row['customer__user__username'], row['customer__phone_number'], row['debt_count']]
+                    + [row[key] for key, *_ in AGEING_BUCKETS] + [row['total']]
+                )
+            yield writer.writerow(['TOTAL', '', totals['debt_count']] + [totals[key] for key, *_ in AGEING_BUCKETS] + [totals['total']])
+
+        stream = reporting_astream if isinstance(request, ASGIRequest) else reporting_stream
+        response = StreamingHttpResponse(stream(csv_rows()), content_type='text/csv')
+        response['Content-Disposition'] = f'attachment; filename="aged-receivables-{date.today()}.csv"'
+        return response
+
+    page_obj = Paginator(rows, 25).get_page(request.GET.get('page'))
+    buckets = [{'key': key, 'label': label, 'total': totals[key]} for key, label, *_ in AGEING_BUCKETS]
+    for row in page_obj:
+        row['buckets'] = [row[key] for key, *_ in AGEING_BUCKETS]
+
+    return render(request, 'ecommerce/aged_receivables.html', {
+        'page_obj': page_obj,
+        'buckets': buckets,
+        'totals': totals,
+    })
+
+
 @login_required
 @login_required
 def profile_view(request):
@@ -275,10 +447,10 @@ def profile_view(request):
 
     # Calculate stats
     if customer:
-        orders = Order.objects.filter(customer=customer)
-        total_orders = orders.count()
-        total_spent = sum(o.get_total_amount() for o in orders)
-        outstanding = sum(o.get_outstanding_balance() for o in orders)
+        stats = get_customer_stats(customer)
+        total_orders = stats.order_count
+        total_spent = stats.lifetime_spend
+        outstanding = stats.outstanding
     else:
         total_orders = 0
         total_spent = 0
@@ -309,6 +481,7 @@ def profile_view(request):
                     'phone_number', ''
                 )
                 customer.address = request.POST.get('address', '')
+                customer.email_digest = request.POST.get('email_digest') == 'on'
                 customer.save()
 
             messages.success(request, 'Profile updated successfully!')
@@ -365,6 +538,7 @@ def change_password_view(request):
     return render(request, 'ecommerce/change_password.html', {'form': form})
 
 @login_required
+@transaction.atomic
 def order_product_view(request):
     preselected_product = None
     product_id = request.GET.get('product')
@@ -398,25 +572,26 @@ def order_product_view(request):
                 quantity=quantity, price=product.price
             )
 
-            Notification.objects.create(
-                notification_type='new_order',
+            total = order.get_total_amount()
+            notifications = NotificationDispatcher()
+            notifications.notify_staff(
+                'new_order',
+                f"New order #{order.id} from {customer.user.username} for KSh {total} via CASH",
                 order=order,
-                message=f"New order #{order.id} from {customer.user.username} "
-                        f"for KSh {order.get_total_amount()} via CASH"
             )
-            Notification.objects.create(
-                notification_type='new_order',
-                user=request.user,
+            notifications.notify(
+                request.user, 'new_order',
+                f"Order #{order.id} placed successfully for "
+                f"{product.name} x{quantity}. Awaiting payment confirmation.",
                 order=order,
-                message=f"Order #{order.id} placed successfully for "
-                        f"{product.name} x{quantity}. Awaiting payment confirmation."
             )
             send_notification_email(
                 user=request.user,
                 subject=f"Order #{order.id} Placed - H&I Store",
                 message=f"Your order #{order.id} for {product.name} x{quantity} has been placed. "
-                        f"Total: KSh {order.get_total_amount()}. Awaiting payment confirmation.",
+                        f"Total: KSh {total}. Awaiting payment confirmation.",
                 order=order,
+                order_total=total,
                 request=request,
             )
 
@@ -447,20 +622,65 @@ User = get_user_model()
 
 class ProfileView(APIView):
     permission_classes = [IsAuthenticated]
+    throttle_scope = 'account'
 
     def get(self, request):
-        user = request.user
-        data = {
-            "id": user.id,
-            "username": user.username,
-            "email": user.email,
-            "date_of_birth": getattr(user, "date_of_birth", None),
-            "profile_photo": getattr(user, "profile_photo", None),
-        }
-        return Response(data)
+        return Response(profile_data(request.user))
+
+
+class CustomerStatsView(APIView):
+    permission_classes = [IsAuthenticated]
+    throttle_scope = 'account'
+
+    def get(self, request):
+        customer_id = request.query_params.get('customer')
+        if customer_id and request.user.is_staff:
+            customer = get_object_or_404(Customer, pk=customer_id)
+        else:
+            customer = get_object_or_404(Customer, user=request.user)
+        return Response(CustomerStatsSerializer(get_customer_stats(customer)).data)
+
+
+class SyncView(APIView):
+    # /api/sync/<resource>/?since=<cursor>: rows changed and ids deleted since the cursor
+    permission_classes = [SyncPermission]
+    throttle_scope = 'sync'
+
+    def get(self, request, resource):
+        if resource not in SYNC_RESOURCES:
+            raise Http404
+        try:
+            changes = changes_since(resource, request.user, request.query_params.get('since'))
+        except InvalidCursor:
+            return Response({'detail': 'Invalid sync cursor.'}, status=400)
+        except CursorExpired:
+            return Response({'detail': 'Sync cursor expired; start a full sync without since.'}, status=410)
+        serializer_class = SYNC_RESOURCES[resource][1]
+        # Rows are served flat; nested blocks have their own sync feeds
+        context = {**sparse_fieldset(request), 'request': request, 'nested': set()}
+        return Response({
+            'results': serializer_class(changes['changed'], many=True, context=context).data,
+            'deleted': changes['deleted'],
+            'next': changes['cursor'],
+            'has_more': changes['has_more'],
+        })
+
+
+class BatchView(APIView):
+    # /api/batch/?q=profile,stats,cart,recent_orders,notifications: several reads in one
+    # round trip, with per-query params as <query>.<param> (e.g. recent_orders.limit=10)
+    permission_classes = [IsAuthenticated]
+    throttle_scope = 'account'
+
+    def get(self, request):
+        names = [name.strip() for name in request.query_params.get('q', '').split(',') if name.strip()]
+        if not names:
+            return Response({'detail': f"Name the sub-queries in ?q=, from: {', '.join(BATCH_QUERIES)}."}, status=400)
+        return Response(run_batch(request, dict.fromkeys(names)))
 
 
 @staff_member_required
+@use_reporting_db
 def admin_dashboard(request):
     total_revenue = Payment.objects.aggregate(total=Sum('amount'))['total'] or 0
     total_orders = Order.objects.count()
@@ -468,7 +688,7 @@ def admin_dashboard(request):
     outstanding_debt = Debt.objects.filter(is_paid=False).aggregate(total=Sum('outstanding_balance'))['total'] or 0
     unpaid_debt_count = Debt.objects.filter(is_paid=False).count()
     total_products = Product.objects.count()
-    low_stock_products = Product.objects.filter(stock__lte=5).order_by('stock')[:10]
+    low_stock = low_stock_products(limit=10)
 
     today = date.today()
     revenue_trend = []
@@ -510,7 +730,7 @@ def admin_dashboard(request):
         'outstanding_debt': outstanding_debt,
         'unpaid_debt_count': unpaid_debt_count,
         'total_products': total_products,
-        'low_stock_products': low_stock_products,
+        'low_stock_products': low_stock,
         'revenue_trend': revenue_trend,
         'recent_payments': recent_payments,
         'top_debtors': top_debtors,
@@ -549,6 +769,7 @@ def admin_reset_user_password(request, user_id):
 
 
 @staff_member_required
+@use_reporting_db
 def reports_view(request):
     from datetime import datetime
     today = date.today()
@@ -616,6 +837,7 @@ def reports_view(request):
 
 
 @staff_member_required
+@use_reporting_db
 def payment_list_view(request):
     payments = Payment.objects.all().order_by('-payment_date').select_related(
         'order', 'order__customer', 'order__customer__user'
@@ -680,6 +902,7 @@ def custom_login(request):
 
 @staff_member_required
 @require_POST
+@transaction.atomic
 def update_order_status(request, pk):
     order = get_object_or_404(Order, pk=pk)
     if request.method == 'POST':
@@ -698,20 +921,20 @@ def update_order_status(request, pk):
                 pass
         
         if new_status == 'shipped':
-            Notification.objects.create(
-                notification_type='order_shipped',
-                user=order.customer.user,
+            total = order.get_total_amount()
+            NotificationDispatcher().notify(
+                order.customer.user, 'order_shipped',
+                f"Your order #{order.id} has been shipped! Track your delivery for updates.",
                 order=order,
-                message=f"Your order #{order.id} has been shipped! "
-                        f"Track your delivery for updates."
             )
             send_notification_email(
                 user=order.customer.user,
                 subject=f"Order #{order.id} Shipped - H&I Store",
                 message=f"Your order #{order.id} has been shipped! "
-                        f"Total: KSh {order.get_total_amount()}. "
+                        f"Total: KSh {total}. "
                         f"Track your delivery for updates.",
                 order=order,
+                order_total=total,
                 request=request,
             )
         messages.success(request, f"Order #{order.id} status updated to {new_status}.")
@@ -792,6 +1015,7 @@ def delete_payment(request, pk):
 
 
 @staff_member_required
+@idempotent
 def add_payment_standalone(request):
     orders = Order.objects.all().order_by('-order_date')
     unpaid_orders = [o for o in orders if o.get_outstanding_balance() > 0]
@@ -828,10 +1052,12 @@ def add_payment_standalone(request):
         'order': None,
         'orders': unpaid_orders,
         'payment': None,
+        'idempotency_key': uuid.uuid4().hex,
     })
 
 
 @staff_member_required
+@idempotent
 def add_payment(request, order_id=None):
     order = get_object_or_404(Order, id=order_id)
     orders = Order.objects.all().order_by('-order_date')
@@ -864,6 +1090,7 @@ def add_payment(request, order_id=None):
         'orders': unpaid_orders,
         'payment': None,
         'payments': payments,
+        'idempotency_key': uuid.uuid4().hex,
     })
 
 
@@ -968,6 +1195,26 @@ def adjust_stock(request, pk):
     return redirect('admin_products_list')
 
 
+@staff_member_required
+def product_stock_history(request, pk):
+    product = get_object_or_404(Product, pk=pk)
+    bounds = []
+    for param in ('from', 'to'):
+        value = request.GET.get(param)
+        try:
+            parsed = parse_date(value) if value else None
+        except ValueError:
+            parsed = None
+        if value and parsed is None:
+            return JsonResponse({'error': f"'{param}' must be a date in YYYY-MM-DD format."}, status=400)
+        bounds.append(parsed)
+    history = [
+        {'date': row['snapshot_date'].isoformat(), 'stock': row['stock'], 'cost_value': float(row['cost_value']), 'retail_value': float(row['retail_value'])}
+        for row in stock_history(product.pk, *bounds)
+    ]
+    return JsonResponse({'product': product.id, 'name': product.name, 'current_stock': product.stock, 'history': history})
+
+
 @staff_member_required
 def admin_update_order(request, pk):
     order = get_object_or_404(Order, pk=pk)
@@ -1013,6 +1260,7 @@ def admin_delete_order(request, pk):
 
 
 @staff_member_required
+@idempotent
 def record_payment(request):
     if request.method != 'POST':
         return JsonResponse({'error': 'POST required.'}, status=405)
@@ -1055,6 +1303,8 @@ def record_payment(request):
     except ValidationError as e:
         messages.error(request, str(e))
         return redirect('orders_list')
+    debt, _ = get_or_create_debt(order)
+    debt.calculate_outstanding_balance()
 
     messages.success(request, f'Payment of KSh {amount} recorded for Order #{order.id}. Outstanding: KSh {order.get_outstanding_balance()}')
     return redirect('orders_list')
@@ -1114,7 +1364,7 @@ def admin_products_list(request):
     products = Product.objects.all().prefetch_related('images')
     in_stock_count = products.filter(stock__gt=0).count()
     out_of_stock_count = products.filter(stock=0).count()
-    total_value = sum(p.price * p.stock for p in products)
+    total_value = current_stock_valuation()['total_retail_value']
     categories = Category.objects.all()
     brands = Brand.objects.all().select_related('category')
 
@@ -1176,6 +1426,7 @@ def cart_view(request):
     return render(request, 'ecommerce/cart.html', {
         'cart': cart,
         'items': items,
+        'idempotency_key': uuid.uuid4().hex,
     })
 
 
@@ -1238,6 +1489,8 @@ def update_cart_item(request, item_id):
 
 
 @login_required
+@idempotent
+@transaction.atomic
 def checkout_from_cart(request):
     if request.method == 'POST':
         try:
@@ -1283,57 +1536,61 @@ def checkout_from_cart(request):
                     price=item.product.price
                 )
 
+            total = order.get_total_amount()
+
             # Create debt record
             Debt.objects.create(
                 customer=customer,
                 order=order,
-                outstanding_balance=order.get_total_amount()
+                outstanding_balance=total
             )
 
             # Clear cart
             cart.items.all().delete()
 
+            # The M-Pesa confirmation may already be in the callback log
+            if payment_type == 'mpesa' and mpesa_code:
+                reconcile_mpesa_receipt.delay(mpesa_code)
+
+            notifications = NotificationDispatcher()
             # Notify admin
-            Notification.objects.create(
-                notification_type='new_order',
+            notifications.notify_staff(
+                'new_order',
+                f"New {'credit request' if payment_type == 'credit' else 'order'} "
+                f"#{order.id} from {customer.user.username} "
+                f"for KSh {total} via {payment_type.upper()}",
                 order=order,
-                message=f"New {'credit request' if payment_type == 'credit' else 'order'} "
-                        f"#{order.id} from {customer.user.username} "
-                        f"for KSh {order.get_total_amount()} "
-                        f"via {payment_type.upper()}"
             )
             # Notify customer
             if payment_type == 'credit':
-                Notification.objects.create(
-                    notification_type='new_order',
-                    user=request.user,
+                notifications.notify(
+                    request.user, 'new_order',
+                    f"Credit request #{order.id} submitted. Waiting for admin approval.",
                     order=order,
-                    message=f"Credit request #{order.id} submitted. "
-                            f"Waiting for admin approval."
                 )
                 send_notification_email(
                     user=request.user,
                     subject=f"Credit Request #{order.id} Submitted - H&I Store",
-                    message=f"Your credit request #{order.id} for KSh {order.get_total_amount()} "
+                    message=f"Your credit request #{order.id} for KSh {total} "
                             f"has been submitted. Waiting for admin approval.",
                     order=order,
+                    order_total=total,
                     request=request,
                 )
             else:
-                Notification.objects.create(
-                    notification_type='new_order',
-                    user=request.user,
+                notifications.notify(
+                    request.user, 'new_order',
+                    f"Order #{order.id} placed. Awaiting payment confirmation.",
                     order=order,
-                    message=f"Order #{order.id} placed. "
-                            f"Awaiting payment confirmation."
                 )
                 send_notification_email(
                     user=request.user,
                     subject=f"Order #{order.id} Placed - H&I Store",
-                    message=f"Your order #{order.id} for KSh {order.get_total_amount()} "
+                    message=f"Your order #{order.id} for KSh {total} "
                             f"has been placed via {payment_type.upper()}. "
                             f"Awaiting payment confirmation.",
                     order=order,
+                    order_total=total,
                     request=request,
                 )
 
@@ -1360,12 +1617,15 @@ def checkout_from_cart(request):
 
 
 @staff_member_required
+@transaction.atomic
 def approve_order(request, order_id):
     order = get_object_or_404(Order, id=order_id)
     if request.method == 'POST':
         action = request.POST.get('action')
         note = request.POST.get('admin_note', '')
         from django.utils import timezone
+        total = order.get_total_amount()
+        notifications = NotificationDispatcher()
 
         if action == 'approve':
             if order.payment_type == 'credit':
@@ -1384,27 +1644,24 @@ def approve_order(request, order_id):
                             request,
                             f"Warning: {item.product.name} has insufficient stock."
                         )
-                Notification.objects.create(
-                    notification_type='new_order',
+                notifications.notify_staff(
+                    'new_order',
+                    f"Credit order #{order.id} approved for {order.customer.user.username}. Stock deducted.",
                     order=order,
-                    message=f"Credit order #{order.id} approved for "
-                            f"{order.customer.user.username}. "
-                            f"Stock deducted."
                 )
-                Notification.objects.create(
-                    notification_type='order_approved',
-                    user=order.customer.user,
+                notifications.notify(
+                    order.customer.user, 'order_approved',
+                    f"Your credit order #{order.id} has been approved "
+                    f"for KSh {total}. Please arrange payment.",
                     order=order,
-                    message=f"Your credit order #{order.id} has been approved "
-                            f"for KSh {order.get_total_amount()}. "
-                            f"Please arrange payment."
                 )
                 send_notification_email(
                     user=order.customer.user,
                     subject=f"Credit Order #{order.id} Approved - H&I Store",
-                    message=f"Your credit order #{order.id} for KSh {order.get_total_amount()} "
+                    message=f"Your credit order #{order.id} for KSh {total} "
                             f"has been approved. Please arrange payment.",
                     order=order,
+                    order_total=total,
                     request=request,
                 )
                 messages.success(
@@ -1419,37 +1676,37 @@ def approve_order(request, order_id):
                 order.confirmed_at = timezone.now()
                 order.save()
                 # Create a payment record for accounting (skip if already fully paid)
-                if order.get_total_paid() < order.get_total_amount():
+                if order.get_total_paid() < total:
                     Payment.objects.create(
                         order=order,
-                        amount=order.get_total_amount(),
+                        amount=total,
                         payment_method=order.payment_type,
                         status='completed',
                         created_by=request.user,
                         notes=note or 'Payment confirmed by admin'
                     )
-                Notification.objects.create(
-                    notification_type='new_order',
+                    debt, _ = get_or_create_debt(order)
+                    debt.calculate_outstanding_balance()
+                notifications.notify_staff(
+                    'new_order',
+                    f"Payment confirmed for order #{order.id} "
+                    f"({order.payment_type.upper()}) from {order.customer.user.username}.",
                     order=order,
-                    message=f"Payment confirmed for order #{order.id} "
-                            f"({order.payment_type.upper()}) from "
-                            f"{order.customer.user.username}."
                 )
-                Notification.objects.create(
-                    notification_type='payment_received',
-                    user=order.customer.user,
+                notifications.notify(
+                    order.customer.user, 'payment_received',
+                    f"Payment confirmed for your order #{order.id} "
+                    f"via {order.get_payment_type_display()}. KSh {total} received.",
                     order=order,
-                    message=f"Payment confirmed for your order #{order.id} "
-                            f"via {order.get_payment_type_display()}. "
-                            f"KSh {order.get_total_amount()} received."
                 )
                 send_notification_email(
                     user=order.customer.user,
                     subject=f"Payment Confirmed for Order #{order.id} - H&I Store",
-                    message=f"Payment of KSh {order.get_total_amount()} for your order "
+                    message=f"Payment of KSh {total} for your order "
                             f"#{order.id} via {order.get_payment_type_display()} "
                             f"has been confirmed.",
                     order=order,
+                    order_total=total,
                     request=request,
                 )
                 messages.success(
@@ -1465,17 +1722,12 @@ def approve_order(request, order_id):
                 for item in order.items.all():
                     item.product.stock += item.quantity
                     item.product.save()
-            Notification.objects.create(
-                notification_type='new_order',
-                order=order,
-                message=f"Order #{order.id} rejected by admin."
-            )
-            Notification.objects.create(
-                notification_type='new_order',
-                user=order.customer.user,
+            notifications.notify_staff('new_order', f"Order #{order.id} rejected by admin.", order=order)
+            notifications.notify(
+                order.customer.user, 'new_order',
+                f"Your order #{order.id} has been rejected. "
+                f"{'Reason: ' + note if note else 'Contact admin for details.'}",
                 order=order,
-                message=f"Your order #{order.id} has been rejected. "
-                        f"{'Reason: ' + note if note else 'Contact admin for details.'}"
             )
             send_notification_email(
                 user=order.customer.user,
@@ -1483,6 +1735,7 @@ def approve_order(request, order_id):
                 message=f"Your order #{order.id} has been rejected. "
                         f"{'Reason: ' + note if note else 'Please contact admin for more information.'}",
                 order=order,
+                order_total=total,
                 request=request,
             )
             messages.warning(
@@ -1496,37 +1749,37 @@ def approve_order(request, order_id):
             order.confirmed_at = timezone.now()
             order.save()
             # Create a payment record for accounting (skip if already fully paid)
-            if order.get_total_paid() < order.get_total_amount():
+            if order.get_total_paid() < total:
                 Payment.objects.create(
                     order=order,
-                    amount=order.get_total_amount(),
+                    amount=total,
                     payment_method=order.payment_type,
                     status='completed',
                     created_by=request.user,
                     notes=note or 'Payment confirmed by admin'
                 )
-            Notification.objects.create(
-                notification_type='new_order',
+                debt, _ = get_or_create_debt(order)
+                debt.calculate_outstanding_balance()
+            notifications.notify_staff(
+                'new_order',
+                f"Payment confirmed for order #{order.id} "
+                f"({order.payment_type.upper()}) from {order.customer.user.username}.",
                 order=order,
-                message=f"Payment confirmed for order #{order.id} "
-                        f"({order.payment_type.upper()}) from "
-                        f"{order.customer.user.username}."
             )
-            Notification.objects.create(
-                notification_type='payment_received',
-                user=order.customer.user,
+            notifications.notify(
+                order.customer.user, 'payment_received',
+                f"Payment confirmed for your order #{order.id} "
+                f"via {order.get_payment_type_display()}. KSh {total} received.",
                 order=order,
-                message=f"Payment confirmed for your order #{order.id} "
-                        f"via {order.get_payment_type_display()}. "
-                        f"KSh {order.get_total_amount()} received."
             )
             send_notification_email(
                 user=order.customer.user,
                 subject=f"Payment Confirmed for Order #{order.id} - H&I Store",
-                message=f"Payment of KSh {order.get_total_amount()} for your order "
+                message=f"Payment of KSh {total} for your order "
                         f"#{order.id} via {order.get_payment_type_display()} "
                         f"has been confirmed.",
                 order=order,
+                order_total=total,
                 request=request,
             )
             messages.success(
@@ -1542,23 +1795,102 @@ def notifications_view(request):
         action = request.POST.get('action')
         if action == 'mark_all_read':
             Notification.objects.filter(user=request.user, is_read=False).update(is_read=True)
+            reset_unread_count(request.user.pk, 0)
             messages.success(request, 'All notifications marked as read.')
         elif action == 'mark_read':
             notif_id = request.POST.get('notification_id')
-            Notification.objects.filter(pk=notif_id, user=request.user, is_read=False).update(is_read=True)
+            updated = Notification.objects.filter(pk=notif_id, user=request.user, is_read=False).update(is_read=True)
+            if updated:
+                adjust_unread_count(request.user.pk, -updated)
         return redirect('notifications')
 
     if request.user.is_staff:
         notifications = Notification.objects.all()
     else:
         notifications = Notification.objects.filter(user=request.user)
-    unread_count = Notification.objects.filter(user=request.user, is_read=False).count()
+    notifications, next_cursor = keyset_page(notifications, request.GET.get('before'), page_size=25)
     return render(request, 'ecommerce/notifications.html', {
         'notifications': notifications,
-        'unread_count': unread_count,
+        'next_cursor': next_cursor,
+        'is_first_page': not request.GET.get('before'),
+        'unread_count': get_unread_count(request.user.pk),
     })
 
 
+@csrf_exempt
+@require_POST
+def mpesa_callback(request, token):
+    # Daraja callbacks are unsigned, so the URL carries a shared secret
+    expected = settings.MPESA_CALLBACK_TOKEN
+    if not expected or not constant_time_compare(token, expected):
+        raise Http404
+    try:
+        record_callback(json.loads(request.body))
+    except (ValueError, InvalidCallback) as exc:
+        logger.warning('Rejected M-Pesa callback: %s', exc)
+        return JsonResponse({'ResultCode': 1, 'ResultDesc': 'Rejected'}, status=400)
+    # Acknowledge straight away; matching to an order happens in the worker
+    return JsonResponse({'ResultCode': 0, 'ResultDesc': 'Accepted'})
+
+
+@require_safe
+def product_feed_view(request, fmt):
+    # Public: the file build_product_feed last published, straight from the cache
+    if fmt not in FEED_FORMATS:
+        raise Http404
+    published = published_feed(f'products.{fmt}')
+    if published is None:
+        raise Http404
+    content, etag, updated_at = published
+    etag = f'"{etag}"'
+    if etag in request.headers.get('If-None-Match', ''):
+        response = HttpResponseNotModified()
+    elif 'gzip' in request.headers.get('Accept-Encoding', ''):
+        response = HttpResponse(content, content_type=f'{FEED_FORMATS[fmt]}; charset=utf-8')
+        response['Content-Encoding'] = 'gzip'
+    else:
+        response = HttpResponse(gzip.decompress(content), content_type=f'{FEED_FORMATS[fmt]}; charset=utf-8')
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(updated_at.timestamp())
+    response['Cache-Control'] = 'public, max-age=300'
+    patch_vary_headers(response, ['Accept-Encoding'])
+    return response
+
+async def _is_staff_listener(request):
+    user = await request.auser()
+    if user.is_active and user.is_staff:
+        return True
+    # Pages link to the events service with a signed token (realtime.staff_events_url)
+    user_id = staff_events_user_id(request.GET.get('token', ''))
+    return user_id is not None and await User.objects.filter(pk=user_id, is_active=True, is_staff=True).aexists()
+
+
+async def staff_events(request):
+    # Async so an idle staff tab holds an event-loop slot instead of a worker thread
+    if not await _is_staff_listener(request):
+        return HttpResponseForbidden()
+    if not isinstance(request, ASGIRequest):
+        # Under WSGI (runserver, or the main gthread service when STAFF_EVENTS_URL is
+        # unset) Django would buffer this endless stream and hang the thread; 204 tells
+        # EventSource to stop reconnecting. Live events need the ASGI events service.
+        return HttpResponse(status=204)
+
+    async def stream():
+        yield 'retry: 5000\n\n'
+        async for message in get_broker().listen(keepalive=settings.SSE_KEEPALIVE_SECONDS):
+            yield message if message is not None else ': keepalive\n\n'
+
+    response = StreamingHttpResponse(stream(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    origin = request.headers.get('Origin')
+    if origin in settings.STAFF_EVENTS_ALLOWED_ORIGINS:
+        # Pages on the main site open the stream cross-origin
+        response['Access-Control-Allow-Origin'] = origin
+        patch_vary_headers(response, ['Origin'])
+    return response
+
+
 # -------------------
 # Consignment Views
 # -------------------
@@ -1623,7 +1955,7 @@ def expense_list(request):
 # Financial Reports
 # -------------------
 @staff_member_required
-@staff_member_required
+@use_reporting_db
 def financial_report(request):
     from datetime import datetime
 
@@ -1656,7 +1988,12 @@ def financial_report(request):
     total_expenses = sum(e.amount for e in expenses)
 
     # Current stock value (based on product cost_price, independent of consignments)
-    current_stock_value = sum((p.cost_price or 0) * p.stock for p in Product.objects.all())
+    current_stock_value = current_stock_valuation()['total_cost_value']
+    opening_snapshot = valuation_on(start)
+    inventory_trend = [
+        {'date': row['snapshot_date'].isoformat(), 'cost': float(row['total_cost_value']), 'retail': float(row['total_retail_value'])}
+        for row in valuation_series(start, end)
+    ]
 
     # COGS — use consignment average if available, otherwise fall back to product cost_price
     total_units_received = sum(
@@ -1678,7 +2015,7 @@ def financial_report(request):
     net_profit = gross_profit - total_expenses
 
     # Low stock alerts
-    low_stock_products = Product.objects.filter(stock__lte=5, stock__gt=0)
+    low_stock = low_stock_products(Product.objects.filter(stock__gt=0), limit=None)
 
     context = {
         'start_date': start,
@@ -1691,8 +2028,10 @@ def financial_report(request):
         'gross_profit': gross_profit,
         'total_expenses': total_expenses,
         'net_profit': net_profit,
-        'low_stock_products': low_stock_products,
+        'low_stock_products': low_stock,
         'current_stock_value': current_stock_value,
+        'opening_snapshot': opening_snapshot,
+        'inventory_trend': inventory_trend,
     }
 
     return render(request, 'ecommerce/financial_report.html', context)
@@ -94,6 +94,11 @@ LOGGING = {
             'level': 'ERROR',
             'propagate': False,
         },
+        'ecommerce.profiling': {
+            'handlers': ['console'],
+            'level': 'INFO',
+            'propagate': False,
+        },
     },
 }
 
@@ -110,9 +115,12 @@ INSTALLED_APPS = [
     'django.contrib.staticfiles',
     'ecommerce.apps.EcommerceConfig',
     'rest_framework',
+    'rest_framework.authtoken',
 ]
 
 MIDDLEWARE = [
+    # First so its timings cover the whole stack; removes itself unless REQUEST_PROFILING is on
+    'ecommerce.profiling.RequestProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -123,6 +131,10 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+# Per-request timing/SQL log lines and a Server-Timing header for staff
+REQUEST_PROFILING = os.environ.get('REQUEST_PROFILING', 'False') == 'True'
+PROFILING_REPEATED_QUERY_THRESHOLD = int(os.environ.get('PROFILING_REPEATED_QUERY_THRESHOLD', 5))
+
 ROOT_URLCONF = 'ecommerce_manager.urls'
 
 TEMPLATES = [
@@ -207,13 +219,29 @@ database_url = (
     or os.environ.get('RENDER_DATABASE_URL')
     or os.environ.get('POSTGRESQL_URL')
 )
+# Persistent connections for the gthread web service and the worker. The ASGI
+# events service (start_events.sh) sets DB_CONN_MAX_AGE=0: under ASGI a connection
+# opened by one request's thread is never closed by another's, so they pile up.
+DB_CONN_MAX_AGE = int(os.environ.get('DB_CONN_MAX_AGE', 600))
 if database_url and not database_url.startswith('sqlite'):
     DATABASES['default'] = dj_database_url.parse(
-        database_url, conn_max_age=600
+        database_url, conn_max_age=DB_CONN_MAX_AGE
     )
 else:
     logging.warning('No DATABASE_URL found — falling back to SQLite. Tables may not persist.')
 
+# Optional read replica for reports and exports (see ecommerce.db_routers)
+reporting_database_url = os.environ.get('REPORTING_DATABASE_URL')
+if reporting_database_url:
+    DATABASES['reporting'] = dj_database_url.parse(
+        reporting_database_url, conn_max_age=DB_CONN_MAX_AGE
+    )
+    # Tests run against a single database; the replica mirrors it
+    DATABASES['reporting']['TEST'] = {'MIRROR': 'default'}
+DATABASE_ROUTERS = ['ecommerce.db_routers.ReportingRouter']
+REPORTING_MAX_LAG_SECONDS = int(os.environ.get('REPORTING_MAX_LAG_SECONDS', 30))
+REPORTING_LAG_CHECK_INTERVAL = int(os.environ.get('REPORTING_LAG_CHECK_INTERVAL', 10))
+
 # Email configuration
 EMAIL_HOST = os.environ.get('EMAIL_HOST', 'smtp.gmail.com')
 EMAIL_PORT = int(os.environ.get('EMAIL_PORT', 587))
@@ -221,6 +249,30 @@ EMAIL_HOST_USER = os.environ.get('EMAIL_HOST_USER', '')
 EMAIL_HOST_PASSWORD = os.environ.get('EMAIL_HOST_PASSWORD', '')
 EMAIL_USE_TLS = os.environ.get('EMAIL_USE_TLS', 'True') == 'True'
 DEFAULT_FROM_EMAIL = EMAIL_HOST_USER
+# Notification emails are queued in EmailOutbox and sent by `manage.py send_outbox_emails`
+EMAIL_OUTBOX_BATCH_SIZE = int(os.environ.get('EMAIL_OUTBOX_BATCH_SIZE', 50))
+EMAIL_OUTBOX_MAX_ATTEMPTS = int(os.environ.get('EMAIL_OUTBOX_MAX_ATTEMPTS', 5))
+EMAIL_OUTBOX_RETRY_BASE_SECONDS = int(os.environ.get('EMAIL_OUTBOX_RETRY_BASE_SECONDS', 60))
+
+# Background jobs (ecommerce.jobs) are run by `manage.py run_worker`, which also drains the outbox
+JOB_BATCH_SIZE = int(os.environ.get('JOB_BATCH_SIZE', 20))
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', 5))
+JOB_RETRY_BASE_SECONDS = int(os.environ.get('JOB_RETRY_BASE_SECONDS', 30))
+
+# Secret path segment for the Daraja callback URL: /api/mpesa/callback/<token>/ (disabled when unset)
+MPESA_CALLBACK_TOKEN = os.environ.get('MPESA_CALLBACK_TOKEN', '')
+
+# Customers who opt into digests get one email per window instead of one per update
+EMAIL_DIGEST_WINDOW_MINUTES = int(os.environ.get('EMAIL_DIGEST_WINDOW_MINUTES', 30))
+
+# Stock planning: rolling sales window and reorder point inputs
+STOCK_VELOCITY_WINDOW_DAYS = int(os.environ.get('STOCK_VELOCITY_WINDOW_DAYS', 30))
+DEFAULT_LEAD_TIME_DAYS = int(os.environ.get('DEFAULT_LEAD_TIME_DAYS', 7))
+SAFETY_STOCK_DAYS = int(os.environ.get('SAFETY_STOCK_DAYS', 3))
+LOW_STOCK_THRESHOLD = int(os.environ.get('LOW_STOCK_THRESHOLD', 5))
+
+# Read notifications older than this are moved to NotificationArchive nightly
+NOTIFICATION_RETENTION_DAYS = int(os.environ.get('NOTIFICATION_RETENTION_DAYS', 90))
 
 # Media files for production
 MEDIA_URL = '/media/'
@@ -246,21 +298,97 @@ else:
         }
     }
 
-# DRF throttling (uses cache)
+if REQUEST_PROFILING:
+    # Backends that also report template time and cache hits to ecommerce.profiling
+    TEMPLATES[0]['BACKEND'] = 'ecommerce.profiling.ProfiledDjangoTemplates'
+    profiled_cache_backends = {
+        'django.core.cache.backends.locmem.LocMemCache': 'ecommerce.profiling.ProfiledLocMemCache',
+        'django.core.cache.backends.redis.RedisCache': 'ecommerce.profiling.ProfiledRedisCache',
+    }
+    for cache_config in CACHES.values():
+        cache_config['BACKEND'] = profiled_cache_backends.get(cache_config['BACKEND'], cache_config['BACKEND'])
+
+# Cached unread notification counts are kept in step by every process that writes
+# notifications. A local-memory cache isn't shared with the worker or the other web
+# workers, so there a count is only trusted briefly before being recounted.
+UNREAD_COUNT_CACHE_SECONDS = int(os.environ.get('UNREAD_COUNT_CACHE_SECONDS', 24 * 60 * 60 if REDIS_URL else 30))
+
+# Staff event stream: comment line sent on idle connections so proxies keep them open
+SSE_KEEPALIVE_SECONDS = int(os.environ.get('SSE_KEEPALIVE_SECONDS', 15))
+# Where staff pages open the stream: the events service's full URL in production,
+# empty for the same-origin path (live under uvicorn, 204 under runserver). The
+# events service lets the main site's origins read it.
+STAFF_EVENTS_URL = os.environ.get('STAFF_EVENTS_URL', '')
+STAFF_EVENTS_ALLOWED_ORIGINS = [
+    origin for origin in os.environ.get('STAFF_EVENTS_ALLOWED_ORIGINS', ','.join(CSRF_TRUSTED_ORIGINS)).split(',') if origin
+]
+STAFF_EVENTS_TOKEN_SECONDS = int(os.environ.get('STAFF_EVENTS_TOKEN_SECONDS', 12 * 60 * 60))
+
+# Largest ?page_size= a client may ask the REST API for
+API_MAX_PAGE_SIZE = int(os.environ.get('API_MAX_PAGE_SIZE', 200))
+# Rows accepted by one /api/order-items/bulk/ or /api/payments/bulk/ request
+API_BULK_MAX_ROWS = int(os.environ.get('API_BULK_MAX_ROWS', 500))
+# Serve plain-column API lists from .values() rows instead of serializer instances
+# (needs orjson; see ecommerce.renderers and the benchmark_api_lists command)
+API_FAST_LISTS = os.environ.get('API_FAST_LISTS', 'True') == 'True'
+
+# /api/sync/ change feeds: rows per response, how long to wait before serving a
+# change, and how long delete tombstones are kept before stale clients must do a
+# full sync. The settle window must outlast any transaction that writes synced
+# rows, or a change committed out of timestamp order can be skipped (see
+# ecommerce.sync.changes_since).
+SYNC_PAGE_SIZE = int(os.environ.get('SYNC_PAGE_SIZE', 200))
+SYNC_SETTLE_SECONDS = int(os.environ.get('SYNC_SETTLE_SECONDS', 60))
+SYNC_TOMBSTONE_RETENTION_DAYS = int(os.environ.get('SYNC_TOMBSTONE_RETENTION_DAYS', 90))
+
+# Public product feed (build_product_feed command and ecommerce.product_feed), served
+# at /api/feeds/products.jsonl and /api/feeds/products.csv; links and image URLs in it
+# are made absolute with PRODUCT_FEED_BASE_URL
+PRODUCT_FEED_BASE_URL = os.environ.get(
+    'PRODUCT_FEED_BASE_URL', f'https://{RENDER_EXTERNAL_HOSTNAME}' if RENDER_EXTERNAL_HOSTNAME else '',
+)
+PRODUCT_FEED_CURRENCY = os.environ.get('PRODUCT_FEED_CURRENCY', 'KES')
+
+# Idempotency-Key handling (ecommerce.idempotency): how long a stored response is
+# replayed, the Retry-After on the 409 a retry gets while the first request is still
+# running, and when an unfinished first request is presumed dead (gunicorn's --timeout)
+IDEMPOTENCY_KEY_TTL_HOURS = int(os.environ.get('IDEMPOTENCY_KEY_TTL_HOURS', 24))
+IDEMPOTENCY_RETRY_AFTER_SECONDS = int(os.environ.get('IDEMPOTENCY_RETRY_AFTER_SECONDS', 1))
+IDEMPOTENCY_PENDING_TIMEOUT_SECONDS = int(os.environ.get('IDEMPOTENCY_PENDING_TIMEOUT_SECONDS', 120))
+
+# Hourly per-token request counts for the api_usage_report command are kept this long
+API_USAGE_RETENTION_HOURS = int(os.environ.get('API_USAGE_RETENTION_HOURS', 168))
+
+# How long CachedTokenAuthentication keeps a token's user in the cache. Deleting the
+# token or saving the user drops it sooner.
+API_TOKEN_CACHE_SECONDS = int(os.environ.get('API_TOKEN_CACHE_SECONDS', 60))
+
+# DRF throttling (uses cache). Counters live in the cache, so without REDIS_URL each
+# worker process keeps its own and the limits are per worker rather than global.
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
         'rest_framework.authentication.SessionAuthentication',
-        'rest_framework.authentication.TokenAuthentication',
+        'ecommerce.authentication.CachedTokenAuthentication',
     ],
     'DEFAULT_RENDERER_CLASSES': [
-        'rest_framework.renderers.JSONRenderer',
+        'ecommerce.renderers.FastJSONRenderer',
     ],
+    'DEFAULT_PAGINATION_CLASS': 'ecommerce.pagination.ApiCursorPagination',
+    'PAGE_SIZE': int(os.environ.get('API_PAGE_SIZE', 50)),
     'DEFAULT_THROTTLE_CLASSES': [
-        'rest_framework.throttling.AnonRateThrottle',
-        'rest_framework.throttling.UserRateThrottle',
+        'ecommerce.throttling.ScopedSlidingWindowThrottle',
     ],
+    # Per scope (see ecommerce.throttling.THROTTLE_SCOPES); <scope>_anon for anonymous
+    # clients, falling back to user/anon. ApiRateLimit rows override these per user.
     'DEFAULT_THROTTLE_RATES': {
         'anon': '100/hour',
         'user': '1000/hour',
+        'catalog_anon': '600/hour',
+        'catalog': '3000/hour',
+        'orders': '1000/hour',
+        'checkout': '30/minute',
+        'payments': '60/minute',
+        'account': '1000/hour',
+        'sync': '120/minute',
     },
 }
\ No newline at end of file
@@ -0,0 +1,9 @@
+#!/usr/bin/env bash
+set -o errexit
+# Serves only the staff event stream (/api/admin-dashboard/events/). ASGI, so each open
+# tab holds an event-loop slot instead of a thread; the main site stays on gthread.
+gunicorn ecommerce_manager.asgi:application \
+  --workers 1 \
+  --worker-class uvicorn.workers.UvicornWorker \
+  --worker-tmp-dir /dev/shm \
+  --timeout 120